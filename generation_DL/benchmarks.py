@@ -0,0 +1,987 @@
+#!/usr/bin/env python
+"""
+CPU benchmarks for the drum generation helpers.
+
+Run from this folder, e.g.:
+
+    python benchmarks.py sampling --lengths 8 16 32 64 128 --batch-size 16
+    python benchmarks.py sampler --batch-sizes 1 16 256
+    python benchmarks.py constraints --checkpoint Drum_Transformer_Checkpoint_0.pt
+    python benchmarks.py generate --checkpoint Drum_Transformer_Checkpoint_0.pt
+    python benchmarks.py conditioning --num-samples 256 --num-styles 4
+    python benchmarks.py strategies --checkpoint Drum_Transformer_Checkpoint_0.pt --widths 2 4 8
+    python benchmarks.py embedding --batch-size 128 --length 64
+    python benchmarks.py training --modes eager bf16 compile compile-bf16
+    python benchmarks.py ddp --max-ranks 8 --threads-per-rank 2
+    python benchmarks.py profiling --num-batches 20 --trace train_trace.json
+    python benchmarks.py loss --batch-size 128 --length 40
+    python benchmarks.py quantization --checkpoint Drum_Transformer_Checkpoint_0.pt \
+        --heldout heldout_batches.pyc
+    python benchmarks.py segmentation --num-bars 16 128 1024
+    python benchmarks.py loading --directory ./groove-v1.0.0-midionly --max-files 200
+    python benchmarks.py codec --directory ./groove-v1.0.0-midionly --settings legacy 16 16/8 32/8/8
+
+The suite times the hot paths of the generation pipeline on synthetic
+Groove shaped data, writes the results as JSON and flags regressions 
+against a previous result (exit code 1):
+
+    python benchmarks.py suite --out baseline.json
+    python benchmarks.py suite --baseline baseline.json --threshold 0.15
+"""
+
+import argparse
+import contextlib
+import copy
+import io
+import json
+import multiprocessing
+import os
+import pickle
+import platform
+import socket
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from groove_corpus import GrooveCatalog, load_sequences
+from generation_helpers import (
+    TOKENS2DIMS,
+    FusedMultiEmbedding,
+    MicrotimingCodec,
+    MultiEmbedding,
+    StageProfiler,
+    TokenConstraints,
+    Transformer,
+    batch_data,
+    beam_search,
+    batches_to_tensors,
+    decode_tokens,
+    evaluate_loss,
+    generate,
+    generate_best_of,
+    generate_conditioned,
+    generate_tokenized_data,
+    is_valid_tokens,
+    load_model,
+    measure_segmentation,
+    multi_field_loss,
+    peak_rss_mb,
+    quantize_model,
+    sample_from_logits,
+    sample_loop,
+    save_notearray_2_midifile,
+    tokenize,
+    tokens_2_notearray,
+    train_loop,
+    write_drum_midi
+    )
+
+
+def build_model(tokens2dims=TOKENS2DIMS,
+                num_heads=6,
+                num_decoder_layers=6,
+                dropout_p=0.1,
+                device="cpu",
+                embedding=MultiEmbedding):
+    # untrained model with the notebook's model_spec, weights don't matter for timing
+    model = Transformer(
+        tokens2dims = tokens2dims,
+        MultiEmbedding = embedding,
+        num_heads = num_heads,
+        num_decoder_layers = num_decoder_layers,
+        dropout_p = dropout_p,
+    ).to(device)
+    model.eval()
+    return model
+
+
+def timeit(fn, repeats=3):
+    # best of repeats, after one warm up call
+    fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+########################################## SAMPLING ##########################################
+
+
+def check_cache(model, tokens, atol=1e-4):
+    # the logits of decode_step, one token at a time, match forward(causal=True)
+    with torch.no_grad():
+        full = model(tokens, causal=True).permute(1, 0, 2)
+        cache = model.init_cache()
+        cached = torch.cat([model.decode_step(tokens[:, i:i + 1], cache)
+                            for i in range(tokens.size(1))], dim=1)
+    assert torch.allclose(full, cached, atol=atol), float((full - cached).abs().max())
+
+
+def bench_sampling(model, lengths, batch_size=16, repeats=3, device="cpu"):
+    """
+    tokens/s of sample_loop with full recomputation vs. KV cache
+    for sequences of increasing length, after checking that both give 
+    the same logits on a sampled batch
+    """
+    results = []
+    print(f"{'length':>8} {'full tok/s':>12} {'cached tok/s':>14} {'speedup':>9}")
+    for length in lengths:
+        check_cache(model, sample_loop(model, model.tokens2dims, device, 
+                                       num_samples=batch_size, num_steps=length))
+        row = {"length": length, "batch_size": batch_size}
+        for use_cache in (False, True):
+            elapsed = timeit(lambda: sample_loop(model,
+                                                 model.tokens2dims,
+                                                 device,
+                                                 num_samples=batch_size,
+                                                 num_steps=length,
+                                                 use_cache=use_cache),
+                             repeats)
+            row["cached" if use_cache else "full"] = batch_size * length / elapsed
+        print(f"{length:>8} {row['full']:>12.1f} {row['cached']:>14.1f} "
+              f"{row['cached'] / row['full']:>8.2f}x")
+        results.append(row)
+    return results
+
+
+def sample_from_logits_per_field(pred, pred_dims):
+    # reference: one softmax + multinomial per field (the previous sample_from_logits)
+    out = list()
+    for k in range(len(pred_dims) - 1):
+        out.append(
+            torch.reshape(
+                torch.multinomial(
+                torch.nn.functional.softmax(pred[:,-1,pred_dims[k]:pred_dims[k+1]], dim = -1),
+                1),(-1, 1, 1)
+            )
+        ) 
+    return torch.cat(out, dim=-1)
+
+
+def bench_sampler(batch_sizes, tokens2dims=TOKENS2DIMS, sequence_length=32, 
+                  iterations=200):
+    """
+    per step cost (us) of the per-field sampler vs. the fused sampler
+    """
+    t2d = np.array(tokens2dims)
+    pred_dims = np.concatenate(([0],np.cumsum(t2d[:,0])))
+    results = []
+    print(f"{'batch':>8} {'per field us':>14} {'fused us':>10} {'fused top-k/p us':>18}")
+    for batch_size in batch_sizes:
+        pred = torch.randn(batch_size, sequence_length, pred_dims[-1])
+        row = {"batch_size": batch_size}
+        for name, fn in (
+                ("per_field", lambda: sample_from_logits_per_field(pred, pred_dims)),
+                ("fused", lambda: sample_from_logits(pred, pred_dims)),
+                ("fused_filtered", lambda: sample_from_logits(pred, pred_dims, 
+                                                              temperature=0.9, 
+                                                              top_k=3, 
+                                                              top_p=0.9))):
+            elapsed = timeit(lambda: [fn() for _ in range(iterations)])
+            row[name] = elapsed / iterations * 1e6
+        print(f"{batch_size:>8} {row['per_field']:>14.1f} {row['fused']:>10.1f} "
+              f"{row['fused_filtered']:>18.1f}")
+        results.append(row)
+    return results
+
+
+def bench_constraints(model, num_samples=256, num_steps=31, device="cpu"):
+    """
+    share of well-formed samples (see is_valid_tokens) and sampling time
+    with and without TokenConstraints
+    """
+    constraints = TokenConstraints(model.tokens2dims, device=device)
+    results = []
+    print(f"{'mode':>12} {'valid':>8} {'seconds':>9}")
+    for name, c in (("free", None), ("constrained", constraints)):
+        start = time.perf_counter()
+        y = sample_loop(model, model.tokens2dims, device, 
+                        num_samples=num_samples, num_steps=num_steps, constraints=c)
+        elapsed = time.perf_counter() - start
+        valid = np.mean([is_valid_tokens(seq[1:]) for seq in y.cpu().numpy()])
+        print(f"{name:>12} {valid:>8.3f} {elapsed:>9.3f}")
+        results.append({"mode": name, "valid": float(valid), "seconds": elapsed})
+    return results
+
+
+def bench_generate(model, num_samples=256, max_len=64, device="cpu"):
+    """
+    fixed length sample_loop vs. early stopping generate, 
+    both constrained so that sequences terminate
+    """
+    constraints = TokenConstraints(model.tokens2dims, device=device)
+    start = time.perf_counter()
+    sample_loop(model, model.tokens2dims, device, num_samples=num_samples, 
+                num_steps=max_len, constraints=constraints)
+    fixed = time.perf_counter() - start
+    start = time.perf_counter()
+    sequences, lengths = generate(model, model.tokens2dims, device, num_samples=num_samples, 
+                                  max_len=max_len, constraints=constraints)
+    early = time.perf_counter() - start
+    print(f"fixed length: {num_samples * max_len} tokens in {fixed:.3f} s")
+    print(f"early stop:   {lengths.sum()} tokens in {early:.3f} s "
+          f"(mean length {lengths.mean():.1f}, {fixed / early:.2f}x)")
+    return {"fixed_seconds": fixed, "early_seconds": early, 
+            "tokens": int(lengths.sum()), "mean_length": float(lengths.mean())}
+
+
+def bench_conditioning(model, num_samples=256, num_styles=4, max_len=64, seed=0, device="cpu"):
+    """
+    mixed condition requests (style prompts of different lengths, tempo 
+    and beat): one generate_conditioned call per distinct condition vs. 
+    one call for the whole mixed batch
+    """
+    rng = np.random.default_rng(seed)
+    constraints = TokenConstraints(model.tokens2dims, device=device)
+    # random prompt bars, the time fields are irrelevant for the cost
+    prompts = {f"style{i}": random_tokens(1, int(rng.integers(8, 33)), model.tokens2dims)[0].numpy()
+               for i in range(num_styles)}
+    styles = [f"style{i}" for i in rng.integers(0, num_styles, num_samples)]
+    tempo = rng.integers(0, 8, num_samples).tolist()
+    beat = rng.integers(0, 2, num_samples).tolist()
+
+    start = time.perf_counter()
+    groups = {}
+    for i, key in enumerate(zip(styles, tempo, beat)):
+        groups.setdefault(key, []).append(i)
+    for (style, t, b), idx in groups.items():
+        generate_conditioned(model, model.tokens2dims, device, styles=[style] * len(idx),
+                             tempo=[t] * len(idx), beat=[b] * len(idx), prompts=prompts,
+                             max_len=max_len, constraints=constraints)
+    grouped = time.perf_counter() - start
+    start = time.perf_counter()
+    sequences, lengths = generate_conditioned(model, model.tokens2dims, device, styles=styles,
+                                              tempo=tempo, beat=beat, prompts=prompts,
+                                              max_len=max_len, constraints=constraints)
+    mixed = time.perf_counter() - start
+    print(f"{len(groups)} distinct conditions, {num_styles} prompts")
+    print(f"one call per condition: {grouped:.3f} s")
+    print(f"one mixed batch:        {mixed:.3f} s ({grouped / mixed:.2f}x), "
+          f"{lengths.sum() / mixed:.0f} tokens/s")
+    return {"conditions": len(groups), "grouped_seconds": grouped, 
+            "mixed_seconds": mixed, "tokens": int(lengths.sum())}
+
+
+def bench_strategies(model, num_samples=32, widths=(2, 4, 8), max_len=64, device="cpu"):
+    """
+    time per request and mean log likelihood per token of ancestral sampling,
+    best-of-N sampling and beam search (N, beam width in widths), all constrained
+    """
+    constraints = TokenConstraints(model.tokens2dims, device=device)
+    runs = [("sample", 1, lambda n: generate(model, model.tokens2dims, device, num_samples=num_samples,
+                                              max_len=max_len, constraints=constraints,
+                                              return_scores=True))]
+    for width in widths:
+        runs.append(("best-of", width, lambda n: generate_best_of(
+            model, model.tokens2dims, device, num_samples=num_samples, best_of=n, 
+            max_len=max_len, constraints=constraints)))
+    for width in widths:
+        runs.append(("beam", width, lambda n: beam_search(
+            model, model.tokens2dims, device, num_samples=num_samples, beam_width=n, 
+            max_len=max_len, constraints=constraints)))
+
+    results = []
+    print(f"{'strategy':>9} {'N':>4} {'ms/request':>11} {'log lik/token':>14} {'mean len':>9} {'valid':>6}")
+    for name, width, run in runs:
+        start = time.perf_counter()
+        sequences, lengths, scores = run(width)
+        elapsed = time.perf_counter() - start
+        row = {"strategy": name, "width": width, 
+               "ms_per_request": elapsed * 1e3 / num_samples,
+               "log_likelihood_per_token": float(np.mean(scores / np.maximum(lengths, 1))),
+               "mean_length": float(np.mean(lengths)),
+               "valid": float(np.mean([is_valid_tokens(seq) for seq in sequences]))}
+        print(f"{name:>9} {width:>4} {row['ms_per_request']:>11.2f} "
+              f"{row['log_likelihood_per_token']:>14.3f} {row['mean_length']:>9.1f} {row['valid']:>6.2f}")
+        results.append(row)
+    return results
+
+
+def random_tokens(batch_size, length, tokens2dims=TOKENS2DIMS):
+    # random valid token ids of size (batch, sequence, fields)
+    vocab_sizes = torch.as_tensor([num for num, dim in tokens2dims])
+    return (torch.rand(batch_size, length, len(tokens2dims)) * vocab_sizes).long()
+
+
+def bench_embedding(batch_size=128, length=64, iterations=100, tokens2dims=TOKENS2DIMS):
+    """
+    forward + backward time of MultiEmbedding vs. FusedMultiEmbedding
+    """
+    multi = MultiEmbedding(tokens2dims)
+    fused = FusedMultiEmbedding.from_multiembedding(multi, tokens2dims)
+    x = random_tokens(batch_size, length, tokens2dims)
+    assert torch.allclose(multi(x), fused(x))
+    results = {}
+    for name, module in (("multi", multi), ("fused", fused)):
+        elapsed = timeit(lambda: [module(x).sum().backward() for _ in range(iterations)])
+        results[name] = elapsed / iterations * 1e6
+    print(f"MultiEmbedding: {results['multi']:.1f} us, "
+          f"FusedMultiEmbedding: {results['fused']:.1f} us "
+          f"({results['multi'] / results['fused']:.2f}x)")
+    return results
+
+
+########################################## TRAINING ##########################################
+
+
+def multi_field_loss_per_field(pred, y_expected, pred_dims):
+    # reference: one cross entropy per field slice (the notebook's train_loop)
+    pred = pred.permute(1, 2, 0)
+    loss = 0
+    for k in range(len(pred_dims) - 1):
+        loss += torch.nn.functional.cross_entropy(pred[:,pred_dims[k]:pred_dims[k+1],:], 
+                                                  y_expected[:,:,k])
+    return loss
+
+
+def bench_loss(batch_size=128, length=40, iterations=50, tokens2dims=TOKENS2DIMS):
+    """
+    forward + backward time of the per field loss vs. multi_field_loss
+    """
+    t2d = np.array(tokens2dims)
+    pred_dims = np.concatenate(([0],np.cumsum(t2d[:,0])))
+    pred = torch.randn(length, batch_size, pred_dims[-1], requires_grad=True)
+    y_expected = random_tokens(batch_size, length, tokens2dims)
+    results = {}
+    for name, fn in (("per_field", lambda: multi_field_loss_per_field(pred, y_expected, pred_dims)),
+                     ("vectorized", lambda: multi_field_loss(pred, y_expected, pred_dims)[0])):
+        elapsed = timeit(lambda: [fn().backward() for _ in range(iterations)])
+        results[name] = elapsed / iterations * 1e6
+    print(f"per field loss: {results['per_field']:.1f} us, "
+          f"multi_field_loss: {results['vectorized']:.1f} us "
+          f"({results['per_field'] / results['vectorized']:.2f}x)")
+    return results
+
+
+# autocast dtype and torch.compile per training mode
+TRAINING_MODES = {
+    "eager": (None, False),
+    "bf16": (torch.bfloat16, False),
+    "compile": (None, True),
+    "compile-bf16": (torch.bfloat16, True),
+}
+
+
+def synthetic_batches(num_batches, batch_size=128, length=40, tokens2dims=TOKENS2DIMS, seed=0):
+    # random token batches shaped like the tokenized Groove bars
+    torch.manual_seed(seed)
+    return [random_tokens(batch_size, length, tokens2dims).numpy() for _ in range(num_batches)]
+
+
+def _train_mode(mode, num_batches, batch_size, length, accum_steps, threads, queue):
+    # runs in its own process so that the peak RSS belongs to this mode only
+    if threads is not None:
+        torch.set_num_threads(threads)
+    autocast_dtype, compile_model = TRAINING_MODES[mode]
+    model = build_model(embedding=FusedMultiEmbedding)
+    opt = torch.optim.Adam(model.parameters(), lr=0.002)
+    forward = torch.compile(model) if compile_model else model
+    batches = batches_to_tensors(synthetic_batches(num_batches, batch_size, length), "cpu")
+
+    # warm up (and compile) on the first batches
+    train_loop(model, opt, batches[:accum_steps], model.tokens2dims, "cpu",
+               accum_steps, autocast_dtype, forward)
+    start = time.perf_counter()
+    train_loop(model, opt, batches, model.tokens2dims, "cpu",
+               accum_steps, autocast_dtype, forward)
+    elapsed = time.perf_counter() - start
+    queue.put({"mode": mode,
+               "samples_per_s": num_batches * batch_size / elapsed,
+               "peak_rss_mb": peak_rss_mb()})
+
+
+def bench_training(modes, num_batches=20, batch_size=128, length=40, accum_steps=1, threads=None):
+    """
+    samples/s and peak memory of train_loop per training mode
+    """
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    print(f"{'mode':>14} {'samples/s':>11} {'peak RSS MB':>13}")
+    for mode in modes:
+        queue = ctx.Queue()
+        process = ctx.Process(target=_train_mode, 
+                              args=(mode, num_batches, batch_size, length, 
+                                    accum_steps, threads, queue))
+        process.start()
+        row = queue.get()
+        process.join()
+        rss = "n/a" if row["peak_rss_mb"] is None else f"{row['peak_rss_mb']:.1f}"
+        print(f"{mode:>14} {row['samples_per_s']:>11.1f} {rss:>13}")
+        results.append(row)
+    return results
+
+
+def bench_profiling(num_batches=20, batch_size=128, length=40, trace=None):
+    """
+    train_loop and generate without and with a StageProfiler (with and 
+    without module hooks): the overhead of the profiler and its reports
+    """
+    model = build_model(embedding=FusedMultiEmbedding)
+    opt = torch.optim.Adam(model.parameters(), lr=0.002)
+    batches = batches_to_tensors(synthetic_batches(num_batches, batch_size, length), "cpu")
+    # warm up
+    train_loop(model, opt, batches[:2], model.tokens2dims)
+
+    results = {}
+    for name in ("off", "stages", "modules"):
+        profiler = None
+        if name != "off":
+            profiler = StageProfiler(trace=trace if name == "stages" else None)
+            if name == "modules":
+                profiler.attach(model)
+            profiler.start()
+        start = time.perf_counter()
+        train_loop(model, opt, batches, model.tokens2dims, profiler=profiler)
+        results[name] = time.perf_counter() - start
+        if profiler is not None:
+            profiler.stop()
+            profiler.detach()
+            print(f"train_loop, {name}:")
+            print(profiler.report())
+            print()
+    for name in ("stages", "modules"):
+        print(f"overhead with {name}: {results[name] / results['off'] - 1:+.1%}")
+
+    constraints = TokenConstraints(model.tokens2dims)
+    profiler = StageProfiler()
+    with profiler:
+        generate(model, model.tokens2dims, "cpu", num_samples=batch_size, 
+                 constraints=constraints, profiler=profiler)
+    print("\ngenerate:")
+    print(profiler.report())
+    return results
+
+
+def _ddp_rank(rank, world_size, port, num_batches, batch_size, length, threads, queue):
+    import torch.distributed as dist
+    from train_ddp import setup, train
+    setup(rank, world_size, f"tcp://127.0.0.1:{port}")
+    model_spec = dict(tokens2dims=TOKENS2DIMS, num_heads=6, num_decoder_layers=6, dropout_p=0.1)
+    batches = batches_to_tensors(synthetic_batches(num_batches, batch_size, length), "cpu")
+    # one warm up epoch, then the timed one
+    train(rank, world_size, batches[:world_size], model_spec, 1, threads=threads, log=False)
+    throughput = train(rank, world_size, batches, model_spec, 1, threads=threads, log=False)
+    if rank == 0:
+        queue.put(throughput)
+    dist.destroy_process_group()
+
+
+def bench_ddp(max_ranks, num_batches=32, batch_size=64, length=40, threads_per_rank=1):
+    """
+    samples/s of data parallel training with 1 to max_ranks local processes
+    """
+    import torch.multiprocessing as mp
+    ctx = mp.get_context("spawn")
+    results = []
+    print(f"{'ranks':>6} {'samples/s':>11} {'speedup':>9} {'efficiency':>11}")
+    for world_size in range(1, max_ranks + 1):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        queue = ctx.SimpleQueue()
+        mp.spawn(_ddp_rank, 
+                 args=(world_size, port, num_batches, batch_size, length, 
+                       threads_per_rank, queue), 
+                 nprocs=world_size)
+        throughput = queue.get()
+        speedup = throughput / results[0]["samples_per_s"] if results else 1.0
+        print(f"{world_size:>6} {throughput:>11.1f} {speedup:>8.2f}x {speedup / world_size:>11.2f}")
+        results.append({"ranks": world_size, "samples_per_s": throughput})
+    return results
+
+
+########################################## QUANTIZATION ##########################################
+
+
+def bench_quantization(model, heldout=None, batch_sizes=(1, 16, 256), num_steps=32, repeats=3):
+    """
+    fp32 vs. int8 dynamic quantization: per field NLL on held out batches 
+    and latency / throughput of cached sampling per batch size
+    """
+    quantized = quantize_model(model)
+    if heldout is not None:
+        fp32_loss, fp32_fields = evaluate_loss(model, heldout, model.tokens2dims)
+        int8_loss, int8_fields = evaluate_loss(quantized, heldout, model.tokens2dims)
+        print(f"{'field':>6} {'fp32 NLL':>9} {'int8 NLL':>9} {'diff':>8}")
+        for k, (a, b) in enumerate(zip(fp32_fields, int8_fields)):
+            print(f"{k:>6} {a:>9.4f} {b:>9.4f} {b - a:>8.4f}")
+        print(f"{'total':>6} {fp32_loss:>9.4f} {int8_loss:>9.4f} {int8_loss - fp32_loss:>8.4f}")
+
+    results = []
+    print(f"{'batch':>6} {'fp32 ms/step':>13} {'int8 ms/step':>13} "
+          f"{'fp32 tok/s':>11} {'int8 tok/s':>11}")
+    for batch_size in batch_sizes:
+        row = {"batch_size": batch_size}
+        for name, m in (("fp32", model), ("int8", quantized)):
+            elapsed = timeit(lambda: sample_loop(m, m.tokens2dims, "cpu", 
+                                                 num_samples=batch_size, 
+                                                 num_steps=num_steps), repeats)
+            row[name + "_ms_per_step"] = elapsed / num_steps * 1e3
+            row[name + "_tokens_per_s"] = batch_size * num_steps / elapsed
+        print(f"{batch_size:>6} {row['fp32_ms_per_step']:>13.2f} {row['int8_ms_per_step']:>13.2f} "
+              f"{row['fp32_tokens_per_s']:>11.1f} {row['int8_tokens_per_s']:>11.1f}")
+        results.append(row)
+    return results
+
+
+########################################## DATA ##########################################
+
+
+def synthetic_performance(num_bars, notes_per_bar=24, ppq=480, seed=0):
+    # sequence dict with a random time sorted note array, as load_data in the notebook
+    rng = np.random.default_rng(seed)
+    n = num_bars * notes_per_bar
+    na = np.zeros(n, dtype=[("onset_tick", int), ("duration_tick", int),
+                            ("pitch", int), ("velocity", int)])
+    na["onset_tick"] = np.sort(rng.integers(0, num_bars * 4 * ppq, n))
+    na["duration_tick"] = ppq // 8
+    na["pitch"] = rng.choice([36, 38, 42, 46, 49, 51], n)
+    na["velocity"] = rng.integers(20, 128, n)
+    namax = (na["onset_tick"] + na["duration_tick"]).max()
+    return {"id": "synthetic", "na": na, "ppq": ppq, "tempo": 120, "beat_type": "beat",
+            "namax": namax, "namin": na["onset_tick"].min(), "dur_in_q": namax / ppq}
+
+
+def measure_segmentation_per_bar(seq, beats = 4, minimal_notes = 1):
+    # reference: the notebook's measure_segmentation, one mask over all notes per bar
+    mod = beats * seq['ppq']
+    no_of_measures = int(seq["namax"] // mod + 1)
+    segmented_seq = list()
+    for measure_idx in range(no_of_measures):
+        na = seq["na"] 
+        new_na = np.copy(na[na["onset_tick"] // mod == measure_idx])
+        if len(new_na) >= minimal_notes:
+            new_seq = copy.copy(seq)
+            new_seq["na"] = new_na
+            segmented_seq.append(new_seq)
+    return segmented_seq
+
+
+def bench_segmentation(bar_counts, notes_per_bar=24, minimal_notes=1, repeats=3):
+    """
+    per bar masks vs. single pass measure_segmentation on performances
+    of increasing length
+    """
+    results = []
+    print(f"{'bars':>6} {'per bar ms':>11} {'single pass ms':>15} {'speedup':>8}")
+    for num_bars in bar_counts:
+        seq = synthetic_performance(num_bars, notes_per_bar)
+        reference = measure_segmentation_per_bar(seq, minimal_notes=minimal_notes)
+        fast = measure_segmentation(seq, minimal_notes=minimal_notes)
+        assert len(reference) == len(fast)
+        assert all((a["na"] == b["na"]).all() for a, b in zip(reference, fast))
+        row = {"num_bars": num_bars}
+        row["per_bar_ms"] = timeit(lambda: measure_segmentation_per_bar(
+            seq, minimal_notes=minimal_notes), repeats) * 1e3
+        row["single_pass_ms"] = timeit(lambda: measure_segmentation(
+            seq, minimal_notes=minimal_notes), repeats) * 1e3
+        print(f"{num_bars:>6} {row['per_bar_ms']:>11.2f} {row['single_pass_ms']:>15.2f} "
+              f"{row['per_bar_ms'] / row['single_pass_ms']:>7.1f}x")
+        results.append(row)
+    return results
+
+
+def bench_loading(directory, max_files=None, min_seq_length=10):
+    """
+    corpus load time with partitura vs. the native MIDI reader, the
+    note arrays are checked to be equal (seconds up to float32 rounding)
+    """
+    files = GrooveCatalog(directory).select(time_signature="4-4")[:max_files]
+    results = {"num_files": len(files)}
+    sequences = {}
+    for backend in ("partitura", "native"):
+        start = time.perf_counter()
+        sequences[backend] = load_sequences(files, min_seq_length, backend)
+        results[backend + "_seconds"] = time.perf_counter() - start
+    assert len(sequences["partitura"]) == len(sequences["native"])
+    for a, b in zip(sequences["partitura"], sequences["native"]):
+        assert a["ppq"] == b["ppq"]
+        assert len(a["na"]) == len(b["na"]), a["id"]
+        for field in a["na"].dtype.names:
+            if field.endswith("_sec"):
+                assert np.allclose(a["na"][field], b["na"][field], atol=1e-5), (a["id"], field)
+            else:
+                assert (a["na"][field] == b["na"][field]).all(), (a["id"], field)
+    print(f"{len(files)} files: partitura {results['partitura_seconds']:.2f} s, "
+          f"native {results['native_seconds']:.2f} s "
+          f"({results['partitura_seconds'] / results['native_seconds']:.1f}x)")
+    return results
+
+
+# grid steps per bar / offset bins / duration bins, or the notebook's tokenizer
+CODEC_SETTINGS = ["legacy", "16", "32", "48", "16/8", "16/16", "32/8", "16/8/8", "48/8/16"]
+
+
+def parse_codec(setting):
+    if setting == "legacy":
+        return None
+    return MicrotimingCodec(*[int(v) for v in setting.split("/")])
+
+
+def bench_codec(sequences, settings=CODEC_SETTINGS, minimal_notes=1):
+    """
+    onset and duration reconstruction error (ms) of every codec setting
+    on whole performances, with its fields, vocabulary sizes and the
+    token sequence lengths of the bars
+    """
+    bars = [s for seq in sequences for s in measure_segmentation(seq, minimal_notes=minimal_notes)]
+    lengths = np.array([len(s["na"]) + 2 for s in bars])
+    results = []
+    print(f"{'setting':>9} {'fields':>6} {'vocab':>6} {'onset ms':>9} {'max ms':>8} "
+          f"{'duration ms':>12} {'mean len':>9} {'max len':>8}")
+    for setting in settings:
+        codec = parse_codec(setting)
+        onset_err, duration_err = [], []
+        for seq in sequences:
+            na, ppq = seq["na"], seq["ppq"]
+            ms_per_tick = 60000 / (seq["tempo"] * ppq)
+            bar_start = na["onset_tick"] - na["onset_tick"] % (ppq * 4)
+            if codec is None:
+                tokens = tokenize(seq)
+                onset = (tokens[:, :7] * 2.0 ** (1 - np.arange(7))).sum(1) * ppq
+                duration = np.full(len(na), 0.25 * ppq)
+            else:
+                onset, duration, _, _ = codec.decode(codec.encode(seq), ppq)
+            onset_err.append(np.abs(bar_start + onset - na["onset_tick"]) * ms_per_tick)
+            duration_err.append(np.abs(duration - na["duration_tick"]) * ms_per_tick)
+        onset_err = np.concatenate(onset_err)
+        duration_err = np.concatenate(duration_err)
+        vocab = [v for v, _ in TOKENS2DIMS] if codec is None else codec.vocab_sizes()
+        row = {"setting": setting, "fields": len(vocab), "vocab_sizes": vocab,
+               "vocab": int(sum(vocab)), "onset_ms": float(onset_err.mean()),
+               "onset_max_ms": float(onset_err.max()), "duration_ms": float(duration_err.mean()),
+               "mean_length": float(lengths.mean()), "max_length": int(lengths.max())}
+        print(f"{setting:>9} {row['fields']:>6} {row['vocab']:>6} {row['onset_ms']:>9.2f} "
+              f"{row['onset_max_ms']:>8.2f} {row['duration_ms']:>12.2f} "
+              f"{row['mean_length']:>9.1f} {row['max_length']:>8}")
+        results.append(row)
+    return results
+
+
+########################################## SUITE ##########################################
+
+
+def measure(fn, repeats=5, min_time=0.05):
+    """
+    seconds per call of fn: after a warm up call, every repeat runs fn 
+    often enough to take about min_time. Returns the best and the median.
+    """
+    start = time.perf_counter()
+    fn()
+    number = max(1, int(min_time / max(time.perf_counter() - start, 1e-9)))
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+    return min(times), float(np.median(times))
+
+
+def suite_cases(quick=False, out_dir="."):
+    """
+    the benchmarks of the suite as name: (function, work per call, unit),
+    all on synthetic performances shaped like the Groove corpus
+    """
+    num_seqs, num_bars = (2, 16) if quick else (8, 64)
+    sequences = [synthetic_performance(num_bars, notes_per_bar=12 + 4 * (i % 4), seed=i) 
+                 for i in range(num_seqs)]
+    bars = [s for seq in sequences for s in measure_segmentation(seq)]
+    num_notes = sum(len(s["na"]) for s in bars)
+    data = generate_tokenized_data(sequences, measure_segmentation, tokenize)
+    batch_size = 16 if quick else 64
+
+    def batched():
+        # batch_data pads the list in place and prints
+        with contextlib.redirect_stdout(io.StringIO()):
+            batch_data(list(data), batch_size)
+
+    cases = {
+        "measure_segmentation": (lambda: [measure_segmentation(seq) for seq in sequences],
+                                 len(bars), "bars"),
+        "tokenize": (lambda: [tokenize(s) for s in bars], num_notes, "notes"),
+        "batch_data": (batched, len(data), "sequences"),
+    }
+
+    model = build_model(embedding=FusedMultiEmbedding)
+    opt = torch.optim.Adam(model.parameters(), lr=0.002)
+    train_batch = batches_to_tensors(synthetic_batches(1, batch_size, 40), "cpu")
+    cases["train_step"] = (lambda: train_loop(model, opt, train_batch, model.tokens2dims),
+                           batch_size, "samples")
+
+    sampler = build_model(embedding=FusedMultiEmbedding)
+    sizes = (1, 16) if quick else (1, 16, 64)
+    lengths = (16, 32) if quick else (16, 64)
+    for size in sizes:
+        for length in lengths:
+            cases[f"sample_loop/b{size}_l{length}"] = (
+                lambda size=size, length=length: sample_loop(sampler, sampler.tokens2dims, "cpu",
+                                                             num_samples=size, num_steps=length),
+                size * length, "tokens")
+
+    # generated bars are tokens without SOS, ending with EOS
+    generated = [tokens[1:] for tokens in data[:8 if quick else 32]]
+    def notearray_midi():
+        for i, tokens in enumerate(generated):
+            save_notearray_2_midifile(tokens_2_notearray(tokens), i, 
+                                      os.path.join(out_dir, "suite_partitura_"))
+    def decode_midi():
+        onset, pitch, velocity, valid = decode_tokens(batch_data_padded)
+        for i in range(len(generated)):
+            write_drum_midi(os.path.join(out_dir, f"suite_native_{i}.mid"), 
+                            onset[i][valid[i]], pitch[i][valid[i]], velocity[i][valid[i]])
+    max_len = max(len(t) for t in generated)
+    batch_data_padded = np.stack([np.pad(t, ((0, max_len - len(t)), (0, 0)), constant_values=-1) 
+                                  for t in generated])
+    cases["tokens_2_notearray+midi"] = (notearray_midi, len(generated), "files")
+    cases["decode_tokens+midi"] = (decode_midi, len(generated), "files")
+    return cases
+
+
+def environment():
+    # what the timings depend on, stored with the results
+    return {"python": platform.python_version(), "torch": torch.__version__, 
+            "numpy": np.__version__, "threads": torch.get_num_threads(), 
+            "machine": platform.machine(), "processor": platform.processor(),
+            "system": platform.platform(), "host": socket.gethostname()}
+
+
+def run_suite(names=None, quick=False, repeats=5, min_time=0.05):
+    """
+    runs the suite (or the benchmarks whose names start with one of names)
+    and returns the results as a JSON serializable dict
+    """
+    results = {"environment": environment(), "quick": quick, 
+               "created": time.strftime("%Y-%m-%d %H:%M:%S"), "benchmarks": {}}
+    print(f"{'benchmark':>26} {'best ms':>10} {'median ms':>10} {'per second':>18}")
+    with tempfile.TemporaryDirectory() as out_dir:
+        cases = suite_cases(quick, out_dir)
+        for name, (fn, work, unit) in cases.items():
+            if names and not any(name.startswith(n) for n in names):
+                continue
+            best, median = measure(fn, repeats, min_time)
+            results["benchmarks"][name] = {"seconds": best, "median_seconds": median, 
+                                           "work": work, "unit": unit, 
+                                           "per_second": work / best}
+            print(f"{name:>26} {best * 1e3:>10.3f} {median * 1e3:>10.3f} "
+                  f"{work / best:>11.0f} {unit}/s")
+    return results
+
+
+def compare_results(results, baseline, threshold=0.1):
+    """
+    compares the best times with a baseline result, benchmarks that got 
+    slower by more than threshold (relative) are regressions.
+    Returns the names of the regressions.
+    """
+    for key in ("threads", "torch", "machine"):
+        if results["environment"].get(key) != baseline["environment"].get(key):
+            print(f"warning: {key} differs from the baseline "
+                  f"({results['environment'].get(key)} vs. {baseline['environment'].get(key)})")
+    if results.get("quick") != baseline.get("quick"):
+        print("warning: the baseline was run with a different --quick setting")
+
+    regressions = []
+    print(f"{'benchmark':>26} {'baseline ms':>12} {'ms':>10} {'change':>8}")
+    for name, row in results["benchmarks"].items():
+        base = baseline["benchmarks"].get(name)
+        if base is None:
+            print(f"{name:>26} {'-':>12} {row['seconds'] * 1e3:>10.3f}      new")
+            continue
+        change = row["seconds"] / base["seconds"] - 1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(f"{name:>26} {base['seconds'] * 1e3:>12.3f} {row['seconds'] * 1e3:>10.3f} "
+              f"{change:>+8.1%}{flag}")
+    print(f"{len(regressions)} regressions over {threshold:.0%}")
+    return regressions
+
+
+########################################## MAIN ##########################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description="drum transformer benchmarks (CPU)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="number of torch intra-op threads")
+    parser.add_argument("--seed", type=int, default=0)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    p = subparsers.add_parser("sampling", help="tokens/s vs. sequence length")
+    p.add_argument("--lengths", type=int, nargs="+", default=[8, 16, 32, 64, 128, 256])
+    p.add_argument("--batch-size", type=int, default=16)
+    p.add_argument("--repeats", type=int, default=3)
+
+    p = subparsers.add_parser("sampler", help="per step cost of sample_from_logits")
+    p.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 16, 256])
+    p.add_argument("--iterations", type=int, default=200)
+
+    p = subparsers.add_parser("constraints", help="valid sample rate with constrained decoding")
+    p.add_argument("--checkpoint", default=None, 
+                   help="trained checkpoint, an untrained model is used otherwise")
+    p.add_argument("--num-samples", type=int, default=256)
+    p.add_argument("--num-steps", type=int, default=31)
+
+    p = subparsers.add_parser("generate", help="fixed length vs. early stopping generation")
+    p.add_argument("--checkpoint", default=None, 
+                   help="trained checkpoint, an untrained model is used otherwise")
+    p.add_argument("--num-samples", type=int, default=256)
+    p.add_argument("--max-len", type=int, default=64)
+
+    p = subparsers.add_parser("conditioning", help="per condition vs. mixed conditioned batches")
+    p.add_argument("--checkpoint", default=None, 
+                   help="trained checkpoint, an untrained model is used otherwise")
+    p.add_argument("--num-samples", type=int, default=256)
+    p.add_argument("--num-styles", type=int, default=4)
+    p.add_argument("--max-len", type=int, default=64)
+
+    p = subparsers.add_parser("strategies", help="sampling vs. best-of-N vs. beam search")
+    p.add_argument("--checkpoint", default=None, 
+                   help="trained checkpoint, an untrained model is used otherwise")
+    p.add_argument("--num-samples", type=int, default=32)
+    p.add_argument("--widths", type=int, nargs="+", default=[2, 4, 8],
+                   help="best-of N and beam widths")
+    p.add_argument("--max-len", type=int, default=64)
+
+    p = subparsers.add_parser("embedding", help="MultiEmbedding vs. FusedMultiEmbedding")
+    p.add_argument("--batch-size", type=int, default=128)
+    p.add_argument("--length", type=int, default=64)
+    p.add_argument("--iterations", type=int, default=100)
+
+    p = subparsers.add_parser("training", help="samples/s and peak memory per training mode")
+    p.add_argument("--modes", nargs="+", default=list(TRAINING_MODES), 
+                   choices=list(TRAINING_MODES))
+    p.add_argument("--num-batches", type=int, default=20)
+    p.add_argument("--batch-size", type=int, default=128)
+    p.add_argument("--length", type=int, default=40)
+    p.add_argument("--accum-steps", type=int, default=1)
+
+    p = subparsers.add_parser("ddp", help="data parallel scaling from 1 to N ranks")
+    p.add_argument("--max-ranks", type=int, default=4)
+    p.add_argument("--threads-per-rank", type=int, default=1)
+    p.add_argument("--num-batches", type=int, default=32)
+    p.add_argument("--batch-size", type=int, default=64)
+    p.add_argument("--length", type=int, default=40)
+
+    p = subparsers.add_parser("profiling", help="per stage times and profiler overhead")
+    p.add_argument("--num-batches", type=int, default=20)
+    p.add_argument("--batch-size", type=int, default=128)
+    p.add_argument("--length", type=int, default=40)
+    p.add_argument("--trace", default=None, help="also write a Chrome trace of the training")
+
+    p = subparsers.add_parser("loss", help="per field vs. vectorized loss")
+    p.add_argument("--batch-size", type=int, default=128)
+    p.add_argument("--length", type=int, default=40)
+    p.add_argument("--iterations", type=int, default=50)
+
+    p = subparsers.add_parser("quantization", help="fp32 vs. int8 accuracy and speed")
+    p.add_argument("--checkpoint", default=None, 
+                   help="trained checkpoint, an untrained model is used otherwise")
+    p.add_argument("--heldout", default=None, 
+                   help="pickled list of held out token batches for the NLL comparison")
+    p.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 16, 256])
+    p.add_argument("--num-steps", type=int, default=32)
+
+    p = subparsers.add_parser("segmentation", help="per bar vs. single pass measure segmentation")
+    p.add_argument("--num-bars", type=int, nargs="+", default=[16, 128, 1024])
+    p.add_argument("--notes-per-bar", type=int, default=24)
+    p.add_argument("--minimal-notes", type=int, default=1)
+
+    p = subparsers.add_parser("loading", help="partitura vs. native Groove corpus loading")
+    p.add_argument("--directory", default="./groove-v1.0.0-midionly")
+    p.add_argument("--max-files", type=int, default=None)
+
+    p = subparsers.add_parser("codec", help="reconstruction error and vocabulary per token codec")
+    p.add_argument("--directory", default=None,
+                   help="Groove dataset, synthetic performances are used otherwise")
+    p.add_argument("--max-files", type=int, default=100)
+    p.add_argument("--settings", nargs="+", default=CODEC_SETTINGS,
+                   help="legacy or grid[/offset bins[/duration bins]]")
+
+    p = subparsers.add_parser("suite", help="pipeline benchmarks with baseline comparison")
+    p.add_argument("names", nargs="*", help="only run benchmarks starting with these names")
+    p.add_argument("--out", default=None, help="write the results (e.g. a new baseline) as JSON")
+    p.add_argument("--baseline", default=None, help="JSON results to compare with")
+    p.add_argument("--threshold", type=float, default=0.1,
+                   help="relative slowdown that counts as a regression")
+    p.add_argument("--quick", action="store_true", help="smaller inputs, for a fast check")
+    p.add_argument("--repeats", type=int, default=5)
+    p.add_argument("--min-time", type=float, default=0.05,
+                   help="seconds per repeat, fast benchmarks are called repeatedly")
+
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+
+    if args.benchmark == "sampling":
+        model = build_model()
+        bench_sampling(model, args.lengths, args.batch_size, args.repeats)
+    elif args.benchmark == "sampler":
+        bench_sampler(args.batch_sizes, iterations=args.iterations)
+    elif args.benchmark == "constraints":
+        model = load_model(args.checkpoint) if args.checkpoint else build_model()
+        bench_constraints(model, args.num_samples, args.num_steps)
+    elif args.benchmark == "generate":
+        model = load_model(args.checkpoint) if args.checkpoint else build_model()
+        bench_generate(model, args.num_samples, args.max_len)
+    elif args.benchmark == "conditioning":
+        model = load_model(args.checkpoint) if args.checkpoint else build_model()
+        bench_conditioning(model, args.num_samples, args.num_styles, args.max_len, args.seed)
+    elif args.benchmark == "strategies":
+        model = load_model(args.checkpoint) if args.checkpoint else build_model()
+        bench_strategies(model, args.num_samples, args.widths, args.max_len)
+    elif args.benchmark == "embedding":
+        bench_embedding(args.batch_size, args.length, args.iterations)
+    elif args.benchmark == "training":
+        bench_training(args.modes, args.num_batches, args.batch_size, args.length,
+                       args.accum_steps, args.threads)
+    elif args.benchmark == "profiling":
+        bench_profiling(args.num_batches, args.batch_size, args.length, args.trace)
+    elif args.benchmark == "loss":
+        bench_loss(args.batch_size, args.length, args.iterations)
+    elif args.benchmark == "quantization":
+        model = load_model(args.checkpoint) if args.checkpoint else build_model()
+        heldout = None
+        if args.heldout is not None:
+            with open(args.heldout, "rb") as fh:
+                heldout = pickle.load(fh)
+        bench_quantization(model, heldout, args.batch_sizes, args.num_steps)
+    elif args.benchmark == "segmentation":
+        bench_segmentation(args.num_bars, args.notes_per_bar, args.minimal_notes)
+    elif args.benchmark == "loading":
+        bench_loading(args.directory, args.max_files)
+    elif args.benchmark == "codec":
+        if args.directory is not None:
+            files = GrooveCatalog(args.directory).select(time_signature="4-4")[:args.max_files]
+            sequences = load_sequences(files)
+        else:
+            sequences = [synthetic_performance(32, seed=i) for i in range(args.max_files)]
+        bench_codec(sequences, args.settings)
+    elif args.benchmark == "ddp":
+        bench_ddp(args.max_ranks, args.num_batches, args.batch_size, args.length,
+                  args.threads_per_rank)
+    elif args.benchmark == "suite":
+        results = run_suite(args.names, args.quick, args.repeats, args.min_time)
+        if args.out is not None:
+            with open(args.out, "w") as fh:
+                json.dump(results, fh, indent=1)
+            print(f"wrote {args.out}")
+        if args.baseline is not None:
+            with open(args.baseline) as fh:
+                baseline = json.load(fh)
+            print()
+            if compare_results(results, baseline, args.threshold):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""
+Statistics of the Groove corpus in one parallel pass over the files:
+every file is summarized by histograms that are merged by adding them,
+and the merged summary is written as a JSON report (for choosing
+minimal_notes, vocabulary sizes and bucket boundaries) plus an NPZ
+file with the raw histograms.
+
+Run from this folder, e.g.:
+
+    python corpus_stats.py --time-signature 4-4 --out groove_stats
+    python corpus_stats.py --split train --style funk rock --workers 8
+"""
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from generation_helpers import PITCH_DICT, PITCH_DICT_SIMPLE
+from groove_corpus import GrooveCatalog
+
+
+class CorpusStats(object):
+    """
+    mergeable histograms of a set of performances: MIDI pitch, velocity,
+    onset position in the bar (grid steps per bar), notes per bar,
+    tempo (bpm per file) and beat type, with file, note and bar totals
+    """
+    # histogram name and number of bins
+    HISTOGRAMS = {
+        "pitch": 128,
+        "velocity": 128,
+        "notes_per_bar": 257,
+        "bpm": 301,
+        "beat_type": 2,
+    }
+    TOTALS = ("files", "notes", "bars", "seconds", "quarters")
+
+    def __init__(self, grid = 192, beats = 4):
+        self.grid = grid
+        self.beats = beats
+        self.hist = {name: np.zeros(size, dtype=np.int64) for name, size in self.HISTOGRAMS.items()}
+        self.hist["onset_grid"] = np.zeros(grid, dtype=np.int64)
+        self.totals = dict.fromkeys(self.TOTALS, 0)
+
+    def add(self, seq):
+        """
+        adds one sequence dict (load_groove_file)
+        """
+        na = seq["na"]
+        onset = na["onset_tick"].astype(np.int64)
+        ticks_per_bar = seq["ppq"] * self.beats
+        bar = onset // ticks_per_bar
+        position = (onset % ticks_per_bar) * self.grid // ticks_per_bar
+        notes_per_bar = np.bincount(bar, minlength=int(seq["namax"] // ticks_per_bar + 1))
+
+        self.hist["pitch"] += np.bincount(na["pitch"], minlength=128)
+        self.hist["velocity"] += np.bincount(na["velocity"], minlength=128)
+        self.hist["onset_grid"] += np.bincount(position, minlength=self.grid)
+        self.hist["notes_per_bar"] += np.bincount(np.minimum(notes_per_bar, 256), minlength=257)
+        self.hist["bpm"][min(int(seq["tempo"]), 300)] += 1
+        self.hist["beat_type"][int(seq["beat_type"] == "fill")] += 1
+        self.totals["files"] += 1
+        self.totals["notes"] += len(na)
+        self.totals["bars"] += len(notes_per_bar)
+        self.totals["seconds"] += float((na["onset_sec"] + na["duration_sec"]).max())
+        self.totals["quarters"] += float(seq["dur_in_q"])
+        return self
+
+    def merge(self, other):
+        if (self.grid, self.beats) != (other.grid, other.beats):
+            raise ValueError("can only merge statistics with the same grid and beats")
+        for name in self.hist:
+            self.hist[name] += other.hist[name]
+        for name in self.totals:
+            self.totals[name] += other.totals[name]
+        return self
+
+    def save(self, fn):
+        np.savez(fn, grid=self.grid, beats=self.beats,
+                 totals=json.dumps(self.totals), **self.hist)
+
+    @classmethod
+    def load(cls, fn):
+        with np.load(fn) as data:
+            stats = cls(int(data["grid"]), int(data["beats"]))
+            for name in stats.hist:
+                stats.hist[name] = data[name]
+            stats.totals = json.loads(str(data["totals"]))
+        return stats
+
+    def report(self, pitch_dicts = None, minimal_notes = (1, 5, 10, 15, 20, 25, 30),
+               num_buckets = 8):
+        """
+        summary as a JSON serializable dict: class frequencies per pitch
+        dict, the bars kept per minimal_notes, quantile bucket boundaries
+        of velocity and bpm and the occupied onset grid steps
+        """
+        if pitch_dicts is None:
+            pitch_dicts = {"PITCH_DICT": PITCH_DICT, "PITCH_DICT_SIMPLE": PITCH_DICT_SIMPLE}
+        report = {"totals": self.totals}
+
+        pitch = self.hist["pitch"]
+        report["pitches"] = {int(p): int(c) for p, c in enumerate(pitch) if c}
+        for name, pitch_dict in pitch_dicts.items():
+            classes = {}
+            for p, c in enumerate(pitch):
+                if c:
+                    cl = int(pitch_dict.get(p, pitch_dict["default"]))
+                    classes[cl] = classes.get(cl, 0) + int(c)
+            report[name] = {
+                "class_counts": dict(sorted(classes.items())),
+                "default_rate": classes.get(pitch_dict["default"], 0) / max(pitch.sum(), 1),
+            }
+
+        # bars with at least k notes (generate_tokenized_data keeps these)
+        per_bar = self.hist["notes_per_bar"]
+        kept = per_bar[::-1].cumsum()[::-1]
+        report["bars_kept"] = {int(k): int(kept[k]) for k in minimal_notes if k < len(kept)}
+        report["max_notes_per_bar"] = int(np.flatnonzero(per_bar)[-1]) if per_bar.any() else 0
+        report["mean_notes_per_bar"] = float((per_bar * np.arange(len(per_bar))).sum()
+                                             / max(per_bar.sum(), 1))
+
+        def quantiles(hist):
+            # bucket boundaries with about equally many values per bucket
+            cdf = hist.cumsum() / max(hist.sum(), 1)
+            return [int(np.searchsorted(cdf, q)) for q in np.arange(1, num_buckets) / num_buckets]
+        report["velocity_buckets"] = quantiles(self.hist["velocity"])
+        report["bpm_buckets"] = quantiles(self.hist["bpm"])
+        report["bpm_range"] = [int(np.flatnonzero(self.hist["bpm"])[0]),
+                               int(np.flatnonzero(self.hist["bpm"])[-1])] \
+            if self.hist["bpm"].any() else None
+        report["beat_type"] = {"beat": int(self.hist["beat_type"][0]),
+                               "fill": int(self.hist["beat_type"][1])}
+
+        # share of onsets on coarser grids, e.g. 16 steps per bar = 16th notes
+        onsets = self.hist["onset_grid"]
+        report["onset_grid"] = {}
+        for steps in (4, 8, 12, 16, 24, 32, 48, 64, 96, 192):
+            if self.grid % steps == 0:
+                on_grid = onsets[::self.grid // steps].sum() / max(onsets.sum(), 1)
+                report["onset_grid"][steps] = float(on_grid)
+        return report
+
+
+def file_stats(files, grid = 192, beats = 4, min_seq_length = 10):
+    # statistics of a list of GrooveFiles, runs in the worker processes
+    stats = CorpusStats(grid, beats)
+    for f in files:
+        seq = f.load(min_seq_length)
+        if seq is not None:
+            stats.add(seq)
+    return stats
+
+
+def corpus_stats(files, grid = 192, beats = 4, min_seq_length = 10, workers = None):
+    """
+    merged CorpusStats of GrooveFile handles, the files are split into 
+    a few chunks per worker process whose summaries are merged
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        return file_stats(files, grid, beats, min_seq_length)
+    chunks = [files[i::4 * workers] for i in range(min(4 * workers, len(files)))]
+    stats = CorpusStats(grid, beats)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        n = len(chunks)
+        for s in executor.map(file_stats, chunks, [grid] * n, [beats] * n, [min_seq_length] * n):
+            stats.merge(s)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Groove corpus statistics")
+    parser.add_argument("--directory", default="./groove-v1.0.0-midionly")
+    parser.add_argument("--out", default="groove_stats",
+                        help="writes OUT.json (report) and OUT.npz (histograms)")
+    parser.add_argument("--style", nargs="+", default=None)
+    parser.add_argument("--split", nargs="+", default=None)
+    parser.add_argument("--drummer", nargs="+", default=None)
+    parser.add_argument("--beat-type", choices=["beat", "fill"], default=None)
+    parser.add_argument("--time-signature", default=None)
+    parser.add_argument("--bpm", type=int, nargs=2, default=None)
+    parser.add_argument("--min-duration", type=float, default=None)
+    parser.add_argument("--min-seq-length", type=int, default=10)
+    parser.add_argument("--grid", type=int, default=192, help="onset grid steps per bar")
+    parser.add_argument("--beats", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    catalog = GrooveCatalog(args.directory)
+    files = catalog.select(style=args.style, split=args.split, drummer=args.drummer,
+                           beat_type=args.beat_type, time_signature=args.time_signature,
+                           bpm=args.bpm, min_duration=args.min_duration)
+    start = time.perf_counter()
+    stats = corpus_stats(files, args.grid, args.beats, args.min_seq_length, args.workers)
+    elapsed = time.perf_counter() - start
+
+    report = stats.report()
+    with open(args.out + ".json", "w") as fh:
+        json.dump(report, fh, indent=1)
+    stats.save(args.out + ".npz")
+    totals = stats.totals
+    print(f"{totals['files']} files, {totals['notes']} notes, {totals['bars']} bars "
+          f"in {elapsed:.2f} s")
+    print("bars kept per minimal_notes:", report["bars_kept"])
+    print(f"wrote {args.out}.json and {args.out}.npz")
+
+
+if __name__ == "__main__":
+    main()
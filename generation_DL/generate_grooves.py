@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""
+Generates many drum grooves with a trained drum Transformer and
+writes them as MIDI files.
+
+Run from this folder, e.g.:
+
+    python generate_grooves.py Drum_Transformer_Checkpoint_0.pt \
+        --num-grooves 2000 --batch-size 256 --bpm 120 --beat-type beat
+
+--strategy best-of keeps the most likely of --best-of samples per groove,
+--strategy beam searches the most likely grooves with --beam-width
+hypotheses each:
+
+    python generate_grooves.py Drum_Transformer_Checkpoint_0.pt \
+        --num-grooves 64 --strategy beam --beam-width 8
+
+With --style, every batch mixes the given styles, each prompted with
+a bar of that style from the dataset:
+
+    python generate_grooves.py Drum_Transformer_Checkpoint_0.pt \
+        --style funk rock jazz --bpm 120
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from generation_helpers import (
+    FusedMultiEmbedding,
+    StageProfiler,
+    TokenConstraints,
+    beam_search,
+    decode_tokens,
+    generate,
+    generate_best_of,
+    generate_conditioned,
+    load_model,
+    quantize_model,
+    tempo_DEcoder,
+    tempo_encoder,
+    write_drum_midi
+    )
+from groove_corpus import GrooveCatalog, TokenCache, style_prompts
+
+
+def pad_sequences(sequences, pad_value=-1):
+    # ragged (length, 11) token arrays to one (batch, max length, 11) array
+    max_len = max(max(len(seq) for seq in sequences), 1)
+    padded = np.full((len(sequences), max_len, 11), pad_value, dtype=np.int64)
+    for i, seq in enumerate(sequences):
+        padded[i, :len(seq)] = seq
+    return padded
+
+
+def write_batch(sequences, lengths, out_dir, first_no, prefix, executor, labels=None):
+    """
+    decodes a batch of generated sequences at once and submits
+    one MIDI file per sequence to the executor, labels (e.g. the
+    styles) are added to the file names
+    """
+    tokens = pad_sequences(sequences)
+    onset, pitch, velocity, valid = decode_tokens(tokens, lengths)
+    futures = []
+    for i in range(len(sequences)):
+        notes = valid[i]
+        # tempo class of the first note, 60 bpm (one quarter per second) otherwise
+        bpm = tempo_DEcoder(tokens[i, 0, 9]) if notes.any() and tokens[i, 0, 9] < 8 else 60
+        label = f"{labels[i]}_" if labels is not None else ""
+        fn = os.path.join(out_dir, f"{prefix}{label}{first_no + i}.mid")
+        futures.append(executor.submit(write_drum_midi, fn,
+                                       onset[i][notes], pitch[i][notes], velocity[i][notes],
+                                       bpm))
+    return futures, int(valid.any(-1).sum())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="generate drum grooves as MIDI files")
+    parser.add_argument("checkpoint", help="checkpoint with model_state_dict and model_spec")
+    parser.add_argument("--out-dir", default="generated_grooves")
+    parser.add_argument("--prefix", default="groove_")
+    parser.add_argument("--num-grooves", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--max-len", type=int, default=64,
+                        help="maximal number of tokens per groove")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--tempo-class", type=int, default=None, choices=range(8))
+    group.add_argument("--bpm", type=float, default=None,
+                       help="tempo in bpm, converted to the tempo class")
+    parser.add_argument("--beat-type", choices=["beat", "fill"], default=None)
+    parser.add_argument("--style", nargs="+", default=None,
+                        help="styles to mix in every batch, prompted from the dataset")
+    parser.add_argument("--dataset", default="./groove-v1.0.0-midionly",
+                        help="Groove dataset for the style prompts")
+    parser.add_argument("--token-cache", default="./token_cache")
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--top-k", type=int, default=None)
+    parser.add_argument("--top-p", type=float, default=None)
+    parser.add_argument("--strategy", choices=["sample", "best-of", "beam"], default="sample")
+    parser.add_argument("--best-of", type=int, default=4,
+                        help="samples per groove to pick the most likely from")
+    parser.add_argument("--beam-width", type=int, default=4)
+    parser.add_argument("--length-penalty", type=float, default=1.0,
+                        help="likelihoods are divided by length ** this to compare grooves")
+    parser.add_argument("--no-constraints", action="store_true",
+                        help="sample without the TokenConstraints masks")
+    parser.add_argument("--quantize", action="store_true",
+                        help="int8 dynamic quantization of the model (cpu only)")
+    parser.add_argument("--profile", action="store_true",
+                        help="report the time per stage, tokens/s and peak memory")
+    parser.add_argument("--trace", default=None,
+                        help="record with torch.profiler and write a Chrome trace to this file")
+    parser.add_argument("--trace-steps", type=int, default=None,
+                        help="only trace this many decoding steps")
+    parser.add_argument("--workers", type=int, default=8, help="MIDI writer threads")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="number of torch intra-op threads")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    if args.seed is not None:
+        torch.manual_seed(args.seed)
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    tempo = args.tempo_class
+    if args.bpm is not None:
+        tempo = int(tempo_encoder(args.bpm))
+    beat = None if args.beat_type is None else int(args.beat_type == "fill")
+    if args.no_constraints and (tempo is not None or beat is not None):
+        parser.error("conditioning on tempo or beat type requires the constraints")
+    if args.style is not None and args.strategy != "sample":
+        parser.error("--style only works with --strategy sample")
+
+    model = load_model(args.checkpoint, args.device, FusedMultiEmbedding)
+    if args.quantize:
+        if args.device != "cpu":
+            parser.error("--quantize only works on the cpu")
+        model = quantize_model(model)
+    constraints = None
+    if not args.no_constraints:
+        constraints = TokenConstraints(model.tokens2dims, device=args.device)
+    prompts = None
+    if args.style is not None:
+        prompts = style_prompts(GrooveCatalog(args.dataset), args.style,
+                                TokenCache(args.token_cache), seed=args.seed or 0)
+    profiler = None
+    if args.profile or args.trace:
+        profiler = StageProfiler(args.device, args.trace, args.trace_steps).start()
+
+    start = time.perf_counter()
+    generation_time = 0.0
+    num_written = 0
+    num_non_empty = 0
+    log_likelihoods = []
+    futures = []
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for first_no in range(0, args.num_grooves, args.batch_size):
+            batch_size = min(args.batch_size, args.num_grooves - first_no)
+            batch_start = time.perf_counter()
+            styles = None
+            if args.strategy == "best-of":
+                sequences, lengths, scores = generate_best_of(model, model.tokens2dims, args.device,
+                                                              num_samples=batch_size,
+                                                              best_of=args.best_of,
+                                                              max_len=args.max_len,
+                                                              temperature=args.temperature,
+                                                              top_k=args.top_k,
+                                                              top_p=args.top_p,
+                                                              constraints=constraints,
+                                                              tempo=tempo,
+                                                              beat=beat,
+                                                              length_penalty=args.length_penalty,
+                                                              profiler=profiler)
+                log_likelihoods += list(scores / np.maximum(lengths, 1))
+            elif args.strategy == "beam":
+                sequences, lengths, scores = beam_search(model, model.tokens2dims, args.device,
+                                                         num_samples=batch_size,
+                                                         beam_width=args.beam_width,
+                                                         max_len=args.max_len,
+                                                         constraints=constraints,
+                                                         tempo=tempo,
+                                                         beat=beat,
+                                                         length_penalty=args.length_penalty,
+                                                         profiler=profiler)
+                log_likelihoods += list(scores / np.maximum(lengths, 1))
+            elif prompts is None:
+                sequences, lengths = generate(model, model.tokens2dims, args.device,
+                                              num_samples=batch_size,
+                                              max_len=args.max_len,
+                                              temperature=args.temperature,
+                                              top_k=args.top_k,
+                                              top_p=args.top_p,
+                                              constraints=constraints,
+                                              tempo=tempo,
+                                              beat=beat,
+                                              profiler=profiler)
+            else:
+                styles = [args.style[(first_no + i) % len(args.style)] for i in range(batch_size)]
+                sequences, lengths = generate_conditioned(model, model.tokens2dims, args.device,
+                                                          styles=styles,
+                                                          tempo=None if constraints is None
+                                                          else [tempo] * batch_size,
+                                                          beat=None if constraints is None
+                                                          else [beat] * batch_size,
+                                                          prompts=prompts,
+                                                          max_len=args.max_len,
+                                                          temperature=args.temperature,
+                                                          top_k=args.top_k,
+                                                          top_p=args.top_p,
+                                                          constraints=constraints,
+                                                          profiler=profiler)
+            generation_time += time.perf_counter() - batch_start
+            batch_futures, non_empty = write_batch(sequences, lengths, args.out_dir,
+                                                   first_no, args.prefix, executor, styles)
+            futures += batch_futures
+            num_non_empty += non_empty
+            num_written += batch_size
+            print(f"{num_written}/{args.num_grooves} grooves, "
+                  f"{num_written / (time.perf_counter() - start):.1f} grooves/s")
+        for future in futures:
+            future.result()
+    total_time = time.perf_counter() - start
+
+    print(f"generated {args.num_grooves} grooves ({num_non_empty} with notes) "
+          f"in {total_time:.2f} s")
+    print(f"generation: {args.num_grooves / generation_time:.1f} grooves/s, "
+          f"overall: {args.num_grooves / total_time:.1f} grooves/s")
+    if log_likelihoods:
+        print(f"mean log likelihood per token: {np.mean(log_likelihoods):.3f}")
+    if profiler is not None:
+        profiler.stop()
+        print(profiler.report())
+        if profiler.traces:
+            print("wrote", ", ".join(profiler.traces))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Generates a long drum track bar by bar with a sliding context window
+and writes it progressively to a MIDI file.
+
+Run from this folder, e.g. for three minutes at 100 bpm:
+
+    python generate_track.py Drum_Transformer_Checkpoint_0.pt --minutes 3 --bpm 100
+"""
+
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from generation_helpers import (
+    FusedMultiEmbedding,
+    MidiStreamWriter,
+    TokenConstraints,
+    decode_tokens,
+    generate_bars,
+    load_model,
+    tempo_DEcoder,
+    tempo_encoder
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="generate a long drum track as a MIDI file")
+    parser.add_argument("checkpoint", help="checkpoint or exported .safetensors model")
+    parser.add_argument("--out", default="drum_track.mid")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--bars", type=int, default=None)
+    group.add_argument("--minutes", type=float, default=None)
+    parser.add_argument("--bpm", type=float, default=100.0)
+    parser.add_argument("--beat-type", choices=["beat", "fill"], default="beat")
+    parser.add_argument("--context-bars", type=int, default=2,
+                        help="number of previous bars the model sees")
+    parser.add_argument("--max-bar-len", type=int, default=64)
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--top-k", type=int, default=None)
+    parser.add_argument("--top-p", type=float, default=None)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        torch.manual_seed(args.seed)
+    tempo = int(tempo_encoder(args.bpm))
+    beat = int(args.beat_type == "fill")
+    num_bars = args.bars
+    if num_bars is None:
+        minutes = args.minutes if args.minutes is not None else 3.0
+        num_bars = int(np.ceil(minutes * args.bpm / 4))
+
+    model = load_model(args.checkpoint, args.device, FusedMultiEmbedding)
+    constraints = TokenConstraints(model.tokens2dims, device=args.device)
+
+    latencies = []
+    with MidiStreamWriter(args.out, bpm=args.bpm) as writer:
+        bars = generate_bars(model, model.tokens2dims, args.device,
+                             num_bars=num_bars,
+                             context_bars=args.context_bars,
+                             max_bar_len=args.max_bar_len,
+                             temperature=args.temperature,
+                             top_k=args.top_k,
+                             top_p=args.top_p,
+                             constraints=constraints,
+                             tempo=tempo,
+                             beat=beat)
+        start = time.perf_counter()
+        for bar_idx, bar in enumerate(bars):
+            latencies.append(time.perf_counter() - start)
+            onset, pitch, velocity, valid = decode_tokens(bar[None])
+            writer.write_bar(onset[0][valid[0]], pitch[0][valid[0]], velocity[0][valid[0]])
+            if (bar_idx + 1) % 16 == 0:
+                print(f"{bar_idx + 1}/{num_bars} bars, "
+                      f"last bar {latencies[-1] * 1e3:.1f} ms")
+            start = time.perf_counter()
+
+    latencies = np.array(latencies) * 1e3
+    bar_ms = 4 * 60000 / tempo_DEcoder(tempo)
+    print(f"wrote {num_bars} bars to {args.out}")
+    print(f"per bar latency: mean {latencies.mean():.1f} ms, max {latencies.max():.1f} ms "
+          f"(a bar lasts {bar_ms:.0f} ms at the tempo class)")
+
+
+if __name__ == "__main__":
+    main()
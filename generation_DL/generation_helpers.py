@@ -1,11 +1,24 @@
 #!/usr/bin/env python
 
+import collections
+import contextlib
+import copy
+import inspect
+import json
+import os
+import random
+import struct
+import sys
+import time
 import numpy as np
 import partitura as pt
 from torch import nn
 import torch
 from torch.nn import TransformerEncoder, TransformerEncoderLayer
 
+# TransformerEncoder takes an is_causal hint in newer PyTorch versions
+ENCODER_IS_CAUSAL = "is_causal" in inspect.signature(TransformerEncoder.forward).parameters
+
 
 ########################################## TOKENIZATION ##########################################
 
@@ -71,6 +84,225 @@ def tempo_DEcoder(tmp):
     # 8 classes of tempo between 60 and 180
     return np.clip(tmp*15 + 60, 60, 179) 
 
+def tempo_encoder(tmp):
+    # 8 classes of tempo between 60 and 180
+    return (np.clip(tmp, 60, 179) - 60) // 15
+
+
+PITCH_DICT_SIMPLE = {
+    36:0, #Kick
+    38:1, #Snare (Head)
+    40:1, #Snare (Rim)
+    37:1, #Snare X-Stick
+    48:2, #Tom 1
+    50:2, #Tom 1 (Rim)
+    45:2, #Tom 2
+    47:2, #Tom 2 (Rim)
+    43:2, #Tom 3
+    58:2, #Tom 3 (Rim)
+    46:3, #HH Open (Bow)
+    26:3, #HH Open (Edge)
+    42:3, #HH Closed (Bow)
+    22:3, #HH Closed (Edge)
+    44:3, #HH Pedal
+    49:4, #Crash 1
+    55:4, #Crash 1
+    57:4, #Crash 2
+    52:4, #Crash 2
+    51:5, #Ride (Bow)
+    59:5, #Ride (Edge)
+    53:5, #Ride (Bell)
+    'default':6
+}
+
+
+def tokenizer_config(pitch_dict = PITCH_DICT_SIMPLE,
+                     num_time_fields = 7,
+                     velocity_bins = 8,
+                     tempo_range = (60, 180),
+                     tempo_bins = 8,
+                     beats = 4,
+                     minimal_notes = 1,
+                     min_seq_length = 10):
+    """
+    everything that determines the tokens of a corpus, the defaults
+    are the notebook's tokenizer, measure_segmentation and load_data
+    """
+    return {
+        "pitch_dict": {str(k): int(v) for k, v in pitch_dict.items()},
+        "num_time_fields": num_time_fields,
+        "velocity_bins": velocity_bins,
+        "tempo_range": list(tempo_range),
+        "tempo_bins": tempo_bins,
+        "beats": beats,
+        "minimal_notes": minimal_notes,
+        "min_seq_length": min_seq_length,
+    }
+
+TOKENIZER_CONFIG = tokenizer_config()
+
+
+def _note_fields(seq, config):
+    # pitch class, velocity, tempo and beat type columns (notes, 4)
+    na = seq["na"]
+    pitch_dict = config["pitch_dict"]
+    lut = np.full(128, pitch_dict["default"])
+    for k, v in pitch_dict.items():
+        if k != "default":
+            lut[int(k)] = v
+    low, high = config["tempo_range"]
+    step = (high - low) // config["tempo_bins"]
+    fields = np.zeros((len(na), 4), dtype=np.int64)
+    fields[:, 0] = lut[na["pitch"]]
+    fields[:, 1] = na["velocity"] * config["velocity_bins"] // 128
+    fields[:, 2] = (np.clip(seq["tempo"], low, high - 1) - low) // step
+    fields[:, 3] = int(seq["beat_type"] == "fill")
+    return fields
+
+def tokenize(seq, config = TOKENIZER_CONFIG):
+    """
+    vectorized version of the notebook's tokenizer: tokens (notes, 11)
+    of a sequence dict for a tokenizer_config, or the tokens of the
+    MicrotimingCodec of a codec config
+    """
+    if config.get("codec") == "microtiming":
+        return MicrotimingCodec.from_config(config).encode(seq)
+    na = seq["na"]
+    ppq = seq["ppq"]
+    num_time_fields = config["num_time_fields"]
+    tokens = np.zeros((len(na), num_time_fields + 4), dtype=np.int64)
+
+    # base 2 encoding of time, starting at half note
+    time_div = (na["onset_tick"] % (ppq * config["beats"])).astype(float)
+    for i in range(num_time_fields):
+        unit = ppq * 2.0 **(1-i)
+        tokens[:, i] = time_div // unit
+        time_div = time_div % unit
+    tokens[:, num_time_fields:] = _note_fields(seq, config)
+    return tokens
+
+def sos_token(config = TOKENIZER_CONFIG):
+    # the SOS row of a tokenizer or codec config, EOS is SOS + 1
+    if config.get("codec") == "microtiming":
+        return MicrotimingCodec.from_config(config).sos_token()
+    return np.array([[2] * config["num_time_fields"] +
+                     [config["pitch_dict"]["default"], config["velocity_bins"],
+                      config["tempo_bins"], 2]])
+
+
+class MicrotimingCodec(object):
+    """
+    token codec that keeps the feel and the note lengths of a groove.
+    The onset is the nearest step of a grid with grid steps per bar, 
+    offset_bins > 0 adds a field with the offset from that step (bins 
+    over +-half a step) and duration_bins > 0 a field with the duration
+    (log spaced bins between min_duration and max_duration quarters).
+
+    Fields: position, [offset], [duration], pitch, velocity, tempo, beat,
+    each with SOS = vocab - 2 and EOS = vocab - 1. encode and decode 
+    work on whole note and token arrays.
+    """
+    def __init__(self, grid = 16, offset_bins = 0, duration_bins = 0,
+                 min_duration = 1 / 32, max_duration = 4, beats = 4,
+                 pitch_dict = PITCH_DICT_SIMPLE, velocity_bins = 8,
+                 tempo_range = (60, 180), tempo_bins = 8, minimal_notes = 1,
+                 min_seq_length = 10):
+        self.grid = grid
+        self.offset_bins = offset_bins
+        self.duration_bins = duration_bins
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+        self.beats = beats
+        # the note fields and segmentation as in tokenizer_config
+        self.note_config = tokenizer_config(pitch_dict, 0, velocity_bins, tempo_range,
+                                            tempo_bins, beats, minimal_notes, min_seq_length)
+        self.duration_edges = np.geomspace(min_duration, max_duration, duration_bins + 1)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(**{k: v for k, v in config.items() if k not in ("codec", "num_time_fields")})
+
+    def config(self):
+        """
+        JSON serializable config, usable with tokenize, sos_token and TokenCache
+        """
+        config = dict(self.note_config, codec = "microtiming", grid = self.grid, 
+                      offset_bins = self.offset_bins, duration_bins = self.duration_bins,
+                      min_duration = self.min_duration, max_duration = self.max_duration)
+        return config
+
+    def fields(self):
+        names = ["position"]
+        if self.offset_bins:
+            names.append("offset")
+        if self.duration_bins:
+            names.append("duration")
+        return names + ["pitch", "velocity", "tempo", "beat"]
+
+    def vocab_sizes(self):
+        # number of values + SOS and EOS per field
+        values = [self.grid + 1]
+        if self.offset_bins:
+            values.append(self.offset_bins)
+        if self.duration_bins:
+            values.append(self.duration_bins)
+        values += [self.note_config["pitch_dict"]["default"] + 1, 
+                   self.note_config["velocity_bins"], self.note_config["tempo_bins"], 2]
+        return [v + 2 for v in values]
+
+    def sos_token(self):
+        return np.array([self.vocab_sizes()]) - 2
+
+    def encode(self, seq):
+        """
+        tokens (notes, fields) of a sequence dict, onsets within their bar
+        """
+        na = seq["na"]
+        ticks_per_bar = seq["ppq"] * self.beats
+        x = (na["onset_tick"] % ticks_per_bar) * self.grid / ticks_per_bar
+        # nearest step, a note just before the next bar gets step grid
+        step = np.floor(x + 0.5)
+        columns = [step]
+        if self.offset_bins:
+            offset = np.floor((x - step + 0.5) * self.offset_bins)
+            columns.append(np.clip(offset, 0, self.offset_bins - 1))
+        if self.duration_bins:
+            quarters = na["duration_tick"] / seq["ppq"]
+            bins = np.searchsorted(self.duration_edges, quarters, side="right") - 1
+            columns.append(np.clip(bins, 0, self.duration_bins - 1))
+        tokens = np.concatenate((np.stack(columns, axis=1).astype(np.int64), 
+                                 _note_fields(seq, self.note_config)), axis=1)
+        return tokens
+
+    def decode(self, tokens, ppq = 480, inv_dict = INV_PITCH_DICT_SIMPLE):
+        """
+        onsets within the bar and durations in ticks (float), midi pitches
+        (-1 for unknown classes) and velocities of tokens (..., fields)
+        """
+        tokens = np.asarray(tokens)
+        ticks_per_step = ppq * self.beats / self.grid
+        x = tokens[..., 0].astype(float)
+        k = 1
+        if self.offset_bins:
+            x += (tokens[..., k] + 0.5) / self.offset_bins - 0.5
+            k += 1
+        if self.duration_bins:
+            b = np.clip(tokens[..., k], 0, self.duration_bins - 1)
+            # geometric bin centers
+            duration = np.sqrt(self.duration_edges[b] * self.duration_edges[b + 1]) * ppq
+            k += 1
+        else:
+            duration = np.full(x.shape, 0.25 * ppq)
+        pitch_lut = np.full(max(inv_dict.keys()) + 1, -1)
+        for c, v in inv_dict.items():
+            pitch_lut[c] = v
+        pitch_class = tokens[..., k]
+        in_lut = (pitch_class >= 0) & (pitch_class < len(pitch_lut))
+        pitch = np.where(in_lut, pitch_lut[np.where(in_lut, pitch_class, 0)], -1)
+        velocity_bins = self.note_config["velocity_bins"]
+        velocity = ((tokens[..., k + 1] + 0.5) * 128 / velocity_bins).astype(int)
+        return x * ticks_per_step, duration, pitch, velocity
+
 def DEtokenizer(token):
     
     onset_time = time_DEcoder(token[:7], ppq= 1 )
@@ -98,6 +330,148 @@ def tokens_2_notearray(tokens):
 def save_notearray_2_midifile(na, no=0, fn = "test_beat"):
     pp = pt.performance.PerformedPart.from_note_array(na)
     pt.save_performance_midi(pp, fn+str(no)+".mid", mpq = 1000000)
+
+def decode_tokens(tokens, lengths=None, inv_dict = INV_PITCH_DICT_SIMPLE):
+    """
+    vectorized tokens_2_notearray for a padded batch of token sequences 
+    (batch, sequence, 11) without SOS.
+
+    Returns onsets (in quarters), midi pitches, velocities and a 
+    boolean mask of the notes before the first unknown instrument, 
+    each of size (batch, sequence)
+    """
+    tokens = np.asarray(tokens)
+    # base 2 encoding of time, starting at half note, only the first 5 levels are used
+    time_code = tokens[..., :5]
+    onset = ((time_code == 1) * 2.0 ** (1 - np.arange(5))).sum(-1)
+
+    pitch_lut = np.full(max(inv_dict.keys()) + 1, -1)
+    for k, v in inv_dict.items():
+        pitch_lut[k] = v
+    pitch_class = tokens[..., 7]
+    in_lut = (pitch_class >= 0) & (pitch_class < len(pitch_lut))
+    pitch = np.where(in_lut, pitch_lut[np.where(in_lut, pitch_class, 0)], -1)
+    valid = np.cumprod(pitch >= 0, axis=-1).astype(bool)
+    if lengths is not None:
+        valid &= np.arange(tokens.shape[1])[None, :] < np.asarray(lengths)[:, None]
+
+    velocity = velocity_DEcoder(tokens[..., 8]).astype(int)
+    return onset, pitch, velocity, valid
+
+def _vlq(value):
+    # MIDI variable length quantity
+    out = [value & 0x7F]
+    value >>= 7
+    while value:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    return bytes(reversed(out))
+
+def note_events(onset, pitch, velocity, duration = 0.25, ppq = 480, channel = 9):
+    """
+    note on and note off events (ticks, status, note, velocity arrays)
+    of notes with onsets and duration in quarters, sorted by time 
+    with note offs before note ons
+    """
+    onset_tick = np.round(np.asarray(onset) * ppq).astype(np.int64)
+    offset_tick = onset_tick + max(int(round(duration * ppq)), 1)
+    n = len(onset_tick)
+    ticks = np.concatenate((offset_tick, onset_tick))
+    status = np.concatenate((np.full(n, 0x80 | channel), np.full(n, 0x90 | channel)))
+    notes = np.concatenate((pitch, pitch)).astype(int)
+    # note on with velocity 0 would be a note off
+    velocities = np.concatenate((np.zeros(n, dtype=int), np.clip(velocity, 1, 127))).astype(int)
+    order = np.lexsort((status, ticks))
+    return ticks[order], status[order], notes[order], velocities[order]
+
+def encode_events(ticks, status, notes, velocities, start_tick = 0):
+    # track chunk bytes of sorted events, delta times relative to start_tick
+    deltas = np.diff(ticks, prepend=start_tick)
+    track = bytearray()
+    for delta, st, note, vel in zip(deltas, status, notes, velocities):
+        track += _vlq(int(delta)) + bytes((int(st), int(note), int(vel)))
+    return track
+
+def _tempo_event(bpm):
+    mpq = int(round(60000000 / bpm))
+    return b"\x00\xff\x51\x03" + mpq.to_bytes(3, "big")
+
+def write_drum_midi(fn, onset, pitch, velocity, bpm = 60, duration = 0.25, 
+                    ppq = 480, channel = 9):
+    """
+    writes notes (onsets and duration in quarters) straight to a type 0 
+    MIDI file, without building a partitura performance. The default 
+    channel 9 is the General MIDI drum channel.
+    """
+    events = note_events(onset, pitch, velocity, duration, ppq, channel)
+    track = bytearray(_tempo_event(bpm)) + encode_events(*events)
+    track += b"\x00\xff\x2f\x00"
+
+    with open(fn, "wb") as fh:
+        fh.write(b"MThd" + struct.pack(">IHHH", 6, 0, 1, ppq))
+        fh.write(b"MTrk" + struct.pack(">I", len(track)) + track)
+
+
+class MidiStreamWriter(object):
+    """
+    writes a type 0 MIDI file bar by bar while it is generated: events 
+    are appended and flushed per bar, note offs reaching into the next 
+    bar are held back, and the track length is patched on close.
+    """
+    def __init__(self, fn, bpm = 60, beats_per_bar = 4, duration = 0.25, 
+                 ppq = 480, channel = 9):
+        self.fh = open(fn, "wb")
+        self.ticks_per_bar = beats_per_bar * ppq
+        self.duration = duration
+        self.ppq = ppq
+        self.channel = channel
+        self.num_bars = 0
+        self.last_tick = 0
+        self.pending = None
+        self.fh.write(b"MThd" + struct.pack(">IHHH", 6, 0, 1, ppq))
+        self.length_pos = self.fh.tell() + 4
+        self.fh.write(b"MTrk" + struct.pack(">I", 0))
+        self.track_length = self._write(_tempo_event(bpm))
+
+    def _write(self, data):
+        self.fh.write(data)
+        return len(data)
+
+    def _merge(self, events):
+        if self.pending is None:
+            return events
+        merged = [np.concatenate((a, b)) for a, b in zip(self.pending, events)]
+        order = np.lexsort((merged[1], merged[0]))
+        return [a[order] for a in merged]
+
+    def write_bar(self, onset, pitch, velocity):
+        # onsets in quarters from the start of the bar
+        bar_start = self.num_bars * self.ticks_per_bar
+        events = note_events(bar_start / self.ppq + np.asarray(onset, dtype=float), 
+                             pitch, velocity, self.duration, self.ppq, self.channel)
+        events = self._merge(events)
+        now = events[0] < bar_start + self.ticks_per_bar
+        self.pending = [a[~now] for a in events]
+        events = [a[now] for a in events]
+        self.track_length += self._write(encode_events(*events, start_tick=self.last_tick))
+        if len(events[0]):
+            self.last_tick = int(events[0][-1])
+        self.num_bars += 1
+        self.fh.flush()
+
+    def close(self):
+        if self.pending is not None and len(self.pending[0]):
+            self.track_length += self._write(encode_events(*self.pending, start_tick=self.last_tick))
+        self.track_length += self._write(b"\x00\xff\x2f\x00")
+        self.fh.seek(self.length_pos)
+        self.fh.write(struct.pack(">I", self.track_length))
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
     
     
     
@@ -129,6 +503,63 @@ def generate_tokenized_data(seqs,
     return data
 
 
+def segment_bars(na, ppq, beats = 4, beat_unit = 4, window = 1, hop = 1,
+                 minimal_notes = 1, num_bars = None):
+    """
+    splits a note array into windows of window bars every hop bars
+    (e.g. window = 2, hop = 1 for overlapping two bar windows) in one
+    pass: the bar boundaries are found by searchsorted on the onsets.
+
+    Returns a list of note array views (no copies if na is sorted by
+    onset) and a structured array with the first bar, start tick and
+    note index range of every window with at least minimal_notes notes.
+    """
+    onset = na["onset_tick"]
+    if len(onset) > 1 and (np.diff(onset) < 0).any():
+        na = na[np.argsort(onset, kind="stable")]
+        onset = na["onset_tick"]
+    ticks_per_bar = int(round(beats * ppq * 4 / beat_unit))
+    if num_bars is None:
+        num_bars = int(onset.max() // ticks_per_bar + 1) if len(onset) else 0
+
+    bounds = np.searchsorted(onset, np.arange(num_bars + 1) * ticks_per_bar)
+    first_bar = np.arange(0, max(num_bars - window, 0) + 1, hop)
+    first_bar = first_bar[first_bar < num_bars]
+    start = bounds[first_bar]
+    stop = bounds[np.minimum(first_bar + window, num_bars)]
+    keep = stop - start >= minimal_notes
+
+    bars = np.zeros(keep.sum(), dtype=[("bar", int), ("start_tick", int),
+                                       ("start", int), ("stop", int)])
+    bars["bar"] = first_bar[keep]
+    bars["start_tick"] = first_bar[keep] * ticks_per_bar
+    bars["start"] = start[keep]
+    bars["stop"] = stop[keep]
+    return [na[a:b] for a, b in zip(bars["start"], bars["stop"])], bars
+
+
+def measure_segmentation(seq, beats = 4, minimal_notes = 1, beat_unit = 4,
+                         window = 1, hop = 1):
+    """
+    single pass version of the notebook's measure_segmentation: one
+    sequence dict per window with at least minimal_notes notes, the
+    note arrays are views of seq["na"], the first bar and its start
+    tick are added as "bar" and "start_tick"
+    """
+    mod = int(round(beats * seq['ppq'] * 4 / beat_unit))
+    num_bars = int(seq["namax"] // mod + 1) if "namax" in seq else None
+    views, bars = segment_bars(seq["na"], seq['ppq'], beats, beat_unit, window, hop,
+                               minimal_notes, num_bars)
+    segmented_seq = list()
+    for new_na, bar, start_tick in zip(views, bars["bar"], bars["start_tick"]):
+        new_seq = copy.copy(seq)
+        new_seq["na"] = new_na
+        new_seq["bar"] = int(bar)
+        new_seq["start_tick"] = int(start_tick)
+        segmented_seq.append(new_seq)
+    return segmented_seq
+
+
 def batch_data(data, batch_size=16, padding=True, padding_token=-1):
     batches = []
     for idx in range(0, len(data), batch_size):
@@ -162,16 +593,24 @@ def batch_data(data, batch_size=16, padding=True, padding_token=-1):
 
 
 class PositionalEncoding(nn.Module):
-    def __init__(self, dim_model, dropout_p, max_len):
+    def __init__(self, dim_model, dropout_p, max_len=None):
         super().__init__()
         
         # Info
         self.dropout = nn.Dropout(dropout_p)
-        
+        self.dim_model = dim_model
+        # max_len is no limit anymore, only the initial size of the table
+        self.initial_len = max_len if max_len is not None else 64
+
+        # Encoding tables per (dtype, device), size (cached length, 1, dim_model).
+        # Computed on demand and grown geometrically, not part of the state_dict
+        self.tables = dict()
+
+    def compute(self, length):
         # Encoding - From formula
-        pos_encoding = torch.zeros(max_len, dim_model)
-        positions_list = torch.arange(0, max_len, dtype=torch.float).view(-1, 1) # 0, 1, 2, 3, 4, 5
-        division_term = torch.exp(torch.arange(0, dim_model, 2).float() * (-np.log(10000.0)) / dim_model) # 1000^(2i/dim_model)
+        pos_encoding = torch.zeros(length, self.dim_model)
+        positions_list = torch.arange(0, length, dtype=torch.float).view(-1, 1) # 0, 1, 2, 3, 4, 5
+        division_term = torch.exp(torch.arange(0, self.dim_model, 2).float() * (-np.log(10000.0)) / self.dim_model) # 1000^(2i/dim_model)
         
         # PE(pos, 2i) = sin(pos/1000^(2i/dim_model))
         pos_encoding[:, 0::2] = torch.sin(positions_list * division_term)
@@ -179,13 +618,208 @@ class PositionalEncoding(nn.Module):
         # PE(pos, 2i + 1) = cos(pos/1000^(2i/dim_model))
         pos_encoding[:, 1::2] = torch.cos(positions_list * division_term)
         
-        # Saving buffer (same as parameter without gradients needed)
-        pos_encoding = pos_encoding.unsqueeze(0).transpose(0, 1)
-        self.register_buffer("pos_encoding",pos_encoding)
+        return pos_encoding.unsqueeze(1)
+
+    def encoding(self, length, dtype=torch.float, device="cpu"):
+        # encoding of the first length positions
+        key = (dtype, torch.device(device))
+        table = self.tables.get(key)
+        if table is None or table.size(0) < length:
+            size = max(length, 2 * table.size(0) if table is not None else self.initial_len)
+            table = self.compute(size).to(device=device, dtype=dtype)
+            self.tables[key] = table
+        return table[:length]
         
-    def forward(self, token_embedding: torch.tensor) -> torch.tensor:
+    def forward(self, token_embedding: torch.tensor, offset: int = 0, 
+                positions: torch.tensor = None) -> torch.tensor:
         # Residual connection + pos encoding
-        return self.dropout(token_embedding + self.pos_encoding[:token_embedding.size(0), :])
+        # offset: position of the first element, used by incremental decoding
+        # positions: alternatively the position of every element (seq, batch)
+        if positions is not None:
+            pos_encoding = self.encoding(int(positions.max()) + 1, token_embedding.dtype, 
+                                         token_embedding.device)[:, 0]
+            return self.dropout(token_embedding + pos_encoding[positions])
+        length = offset + token_embedding.size(0)
+        pos_encoding = self.encoding(length, token_embedding.dtype, token_embedding.device)
+        return self.dropout(token_embedding + pos_encoding[offset:length])
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints hold the fixed (5000, 1, dim_model) buffer
+        state_dict.pop(prefix + "pos_encoding", None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+class MultiEmbedding(nn.Module):
+    '''A Multiembedding'''
+    # Initialization
+    def __init__(self, tokens2dims):
+        super().__init__()
+        self.em_time0 = nn.Embedding(tokens2dims[0][0], tokens2dims[0][1])
+        self.em_time1 = nn.Embedding(tokens2dims[1][0], tokens2dims[1][1])
+        self.em_time2 = nn.Embedding(tokens2dims[2][0], tokens2dims[2][1])
+        self.em_time3 = nn.Embedding(tokens2dims[3][0], tokens2dims[3][1])
+        self.em_time4 = nn.Embedding(tokens2dims[4][0], tokens2dims[4][1])
+        self.em_time5 = nn.Embedding(tokens2dims[5][0], tokens2dims[5][1])
+        self.em_time6 = nn.Embedding(tokens2dims[6][0], tokens2dims[6][1])
+        self.em_pitch = nn.Embedding(tokens2dims[7][0], tokens2dims[7][1])
+        self.em_velocity = nn.Embedding(tokens2dims[8][0], tokens2dims[8][1])
+        self.em_tempo = nn.Embedding(tokens2dims[9][0], tokens2dims[9][1])
+        self.em_beat = nn.Embedding(tokens2dims[10][0], tokens2dims[10][1])
+
+    def forward(self, x):
+        '''Update Function and predict function of the model'''
+        
+        output = torch.cat((
+        self.em_time0(x[:,:,0]),
+        self.em_time1(x[:,:,1]),
+        self.em_time2(x[:,:,2]),
+        self.em_time3(x[:,:,3]),
+        self.em_time4(x[:,:,4]),
+        self.em_time5(x[:,:,5]),
+        self.em_time6(x[:,:,6]),
+        self.em_pitch(x[:,:,7]),
+        self.em_velocity(x[:,:,8]),
+        self.em_tempo(x[:,:,9]),
+        self.em_beat(x[:,:,10])),
+        dim=-1)
+        return output
+
+
+# attribute names of the per field embeddings in MultiEmbedding
+EMBEDDING_NAMES = [
+    "em_time0", "em_time1", "em_time2", "em_time3", "em_time4", "em_time5", "em_time6",
+    "em_pitch", "em_velocity", "em_tempo", "em_beat"
+]
+
+
+class FusedMultiEmbedding(nn.Module):
+    '''
+    MultiEmbedding as a single table: row offsets[k] + i holds the 
+    embedding of value i of field k (zero padded to the largest 
+    embedding dim), so the forward pass is one lookup of x + offsets 
+    and one column selection into the concatenated layout.
+    Loads MultiEmbedding weights (em_time0.weight, ...) as well.
+    '''
+    def __init__(self, tokens2dims):
+        super().__init__()
+        t2d = np.array(tokens2dims)
+        self.tokens2dims = tokens2dims
+        self.max_dim = int(t2d[:,1].max())
+        offsets = np.concatenate(([0], np.cumsum(t2d[:,0])[:-1]))
+        # columns of the (fields x max_dim) lookup which make up the output
+        columns = np.concatenate([k * self.max_dim + np.arange(d) for k, d in enumerate(t2d[:,1])])
+
+        self.weight = nn.Parameter(torch.zeros(int(t2d[:,0].sum()), self.max_dim))
+        self.register_buffer("offsets", torch.as_tensor(offsets, dtype=torch.long), persistent=False)
+        self.register_buffer("columns", torch.as_tensor(columns, dtype=torch.long), persistent=False)
+        # same initialization as nn.Embedding, padding columns stay zero
+        with torch.no_grad():
+            for k, (num, dim) in enumerate(tokens2dims):
+                self.weight[offsets[k]:offsets[k] + num, :dim].normal_()
+
+    def forward(self, x):
+        # batch / sequence / fields / max_dim
+        output = nn.functional.embedding(x + self.offsets, self.weight)
+        return output.flatten(-2).index_select(-1, self.columns)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # convert the weights of the 11 module MultiEmbedding
+        if prefix + EMBEDDING_NAMES[0] + ".weight" in state_dict:
+            weight = torch.zeros_like(self.weight)
+            for k, name in enumerate(EMBEDDING_NAMES):
+                w = state_dict.pop(prefix + name + ".weight")
+                weight[self.offsets[k]:self.offsets[k] + w.size(0), :w.size(1)] = w
+            state_dict[prefix + "weight"] = weight
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    @classmethod
+    def from_multiembedding(cls, multiembedding, tokens2dims):
+        fused = cls(tokens2dims)
+        fused.load_state_dict(multiembedding.state_dict())
+        return fused
+
+
+# default (vocabulary size, embedding dim) per token field, as used in the notebook
+TOKENS2DIMS = [ 
+    (4, 8),
+    (4, 8),
+    (4, 8),
+    (4, 4),
+    (4, 4),
+    (4, 4),
+    (4, 4),
+    (8, 16),
+    (10, 12),
+    (10, 12),
+    (4, 4)
+]
+
+
+class KVCache(object):
+    """
+    per layer keys and values of all positions seen so far,
+    each of size (batch_size, num_heads, sequence length, head_dim)
+    """
+    def __init__(self, num_layers):
+        self.keys = [None] * num_layers
+        self.values = [None] * num_layers
+        # number of positions already in the cache
+        self.length = 0
+        # padded positions (batch_size, length) and padded positions per 
+        # row, only set once rows of different lengths were padded
+        self.pad = None
+        self.shift = None
+
+    def index_select(self, idx):
+        # keep (or repeat) only the batch rows in idx
+        for i in range(len(self.keys)):
+            if self.keys[i] is not None:
+                self.keys[i] = self.keys[i].index_select(0, idx)
+                self.values[i] = self.values[i].index_select(0, idx)
+        if self.pad is not None:
+            self.pad = self.pad.index_select(0, idx)
+            self.shift = self.shift.index_select(0, idx)
+        return self
+
+
+def cached_self_attention(mha, x, cache, layer_idx):
+    """
+    self attention of the new positions x (new_length, batch_size, dim_model)
+    against all cached positions plus themselves. The new keys and values
+    are appended to the cache.
+    """
+    new_length, batch_size, dim_model = x.shape
+    num_heads = mha.num_heads
+    head_dim = dim_model // num_heads
+
+    q, k, v = nn.functional.linear(x, mha.in_proj_weight, mha.in_proj_bias).chunk(3, dim=-1)
+    # seq / batch / dim  ->  batch / heads / seq / head_dim
+    q, k, v = [t.reshape(new_length, batch_size, num_heads, head_dim).permute(1, 2, 0, 3) 
+               for t in (q, k, v)]
+
+    if cache.keys[layer_idx] is not None:
+        k = torch.cat((cache.keys[layer_idx], k), dim=2)
+        v = torch.cat((cache.values[layer_idx], v), dim=2)
+    cache.keys[layer_idx] = k
+    cache.values[layer_idx] = v
+
+    scores = torch.matmul(q, k.transpose(-2, -1)) / np.sqrt(head_dim)
+    if new_length > 1 or cache.pad is not None:
+        # causal mask: new position j may only see cached positions and new positions <= j
+        total_length = k.size(2)
+        query_pos = torch.arange(total_length - new_length, total_length, device=x.device)
+        key_pos = torch.arange(total_length, device=x.device)
+        mask = key_pos[None, :] > query_pos[:, None]
+        if cache.pad is not None:
+            # padded positions are only seen by themselves
+            mask = mask | (cache.pad[:, None, None, :] & (key_pos[None, :] != query_pos[:, None]))
+        scores = scores.masked_fill(mask, float('-inf'))
+    attn = nn.functional.softmax(scores, dim=-1)
+    attn = nn.functional.dropout(attn, p=mha.dropout, training=mha.training)
+
+    # batch / heads / seq / head_dim  ->  seq / batch / dim
+    out = torch.matmul(attn, v).permute(2, 0, 1, 3).reshape(new_length, batch_size, dim_model)
+    return mha.out_proj(out)
 
     
 class Transformer(nn.Module):
@@ -199,6 +833,7 @@ class Transformer(nn.Module):
         num_heads,
         num_decoder_layers,
         dropout_p,
+        max_len=512,
     ):
         super().__init__()
         
@@ -208,12 +843,13 @@ class Transformer(nn.Module):
 
         # LAYERS
         self.positional_encoder = PositionalEncoding(
-            dim_model=self.tokennumber_totaldim[1], dropout_p=dropout_p, max_len=5000
+            dim_model=self.tokennumber_totaldim[1], dropout_p=dropout_p
         )
         self.embedding = MultiEmbedding(tokens2dims) # multiembedding with dim 22
         
         # DECODER LAYERS
-        D_layers = TransformerEncoderLayer(self.tokennumber_totaldim[1], 
+        # plain int, a numpy embed_dim makes nn.MultiheadAttention branch on a numpy bool
+        D_layers = TransformerEncoderLayer(int(self.tokennumber_totaldim[1]), 
                                          nhead = num_heads, 
                                          dim_feedforward = self.tokennumber_totaldim[1], 
                                          dropout=dropout_p)
@@ -223,8 +859,20 @@ class Transformer(nn.Module):
             num_layers = num_decoder_layers,
         )
         self.out = nn.Linear(self.tokennumber_totaldim[1], self.tokennumber_totaldim[0])
+
+        # MASK CACHE - built once for max_len and sliced per length, moves with the model
+        self.register_buffer("causal_mask", 
+                             torch.full((max_len, max_len), float('-inf')).triu(1), 
+                             persistent=False)
         
-    def forward(self, src, tgt_mask=None, tgt_pad_mask=None):
+    def forward(self, src, tgt_mask=None, tgt_pad_mask=None, causal=False):
+        # causal: use the cached causal mask (tgt_mask is ignored)
+
+        encoder_kwargs = dict()
+        if causal:
+            tgt_mask = self.get_tgt_mask(src.size(1))
+            if ENCODER_IS_CAUSAL:
+                encoder_kwargs["is_causal"] = True
 
         src = self.embedding(src)
         # to obtain size (sequence length, batch_size, dim_model),
@@ -234,17 +882,73 @@ class Transformer(nn.Module):
         # Transformer blocks - Out size = (sequence length, batch_size, num_tokens)
         transformer_out = self.transformerDECODER(src=src, 
                                                   mask=tgt_mask, 
-                                                  src_key_padding_mask = tgt_pad_mask)
+                                                  src_key_padding_mask = tgt_pad_mask,
+                                                  **encoder_kwargs)
         out = self.out(transformer_out)
         
         return out
+
+    def init_cache(self):
+        return KVCache(len(self.transformerDECODER.layers))
+
+    def decode_step(self, src, cache, pad = None):
+        """
+        incremental forward pass: only the new positions src 
+        (batch_size, new_length, 11) are processed, all previous positions
+        are read from the cache. Equivalent to the causally masked forward 
+        over the full sequence.
+
+        pad (batch_size, new_length) marks padding positions, e.g. to prefill 
+        left padded prompts of different lengths at once: they are not 
+        attended to and the positions of every row count without them.
+
+        Returns logits of size (batch_size, new_length, num_tokens)
+        """
+        offset = cache.length
+        x = self.embedding(src)
+        x = x.permute(1,0,2)
+        if pad is not None and cache.pad is None:
+            cache.pad = torch.zeros(src.size(0), offset, dtype=torch.bool, device=src.device)
+            cache.shift = torch.zeros(src.size(0), dtype=torch.long, device=src.device)
+        if cache.pad is None:
+            x = self.positional_encoder(x, offset=offset)
+        else:
+            if pad is None:
+                pad = torch.zeros(src.shape[:2], dtype=torch.bool, device=src.device)
+            positions = (offset + torch.arange(src.size(1), device=src.device)[None, :]
+                         - cache.shift[:, None] - pad.long().cumsum(1))
+            x = self.positional_encoder(x, positions=positions.clamp(min=0).t())
+            cache.pad = torch.cat((cache.pad, pad), dim=1)
+            cache.shift = cache.shift + pad.sum(1)
+
+        for layer_idx, layer in enumerate(self.transformerDECODER.layers):
+            if getattr(layer, "norm_first", False):
+                x = x + layer.dropout1(cached_self_attention(layer.self_attn, layer.norm1(x), 
+                                                             cache, layer_idx))
+                x = x + layer.dropout2(self._feed_forward(layer, layer.norm2(x)))
+            else:
+                x = layer.norm1(x + layer.dropout1(cached_self_attention(layer.self_attn, x, 
+                                                                         cache, layer_idx)))
+                x = layer.norm2(x + layer.dropout2(self._feed_forward(layer, x)))
+        if self.transformerDECODER.norm is not None:
+            x = self.transformerDECODER.norm(x)
+
+        cache.length += src.size(1)
+        out = self.out(x)
+        # batch / sequence / logits
+        return out.permute(1,0,2)
+
+    @staticmethod
+    def _feed_forward(layer, x):
+        return layer.linear2(layer.dropout(layer.activation(layer.linear1(x))))
       
     def get_tgt_mask(self, size) -> torch.tensor:
         # Generates a squeare matrix where the each row allows one word more to be seen
-        mask = torch.tril(torch.ones(size, size) == 1) # Lower triangular matrix
-        mask = mask.float()
-        mask = mask.masked_fill(mask == 0, float('-inf')) # Convert zeros to -inf
-        mask = mask.masked_fill(mask == 1, float(0.0)) # Convert ones to 0
+        # Sequences up to max_len slice the cached mask, longer ones get their own 
+        # (the buffer is never reassigned, which would break torch.compile graphs)
+        if self.causal_mask.size(0) < size:
+            return torch.full((size, size), float('-inf'), 
+                              device=self.causal_mask.device).triu(1)
         
         # EX for size=5:
         # [[0., -inf, -inf, -inf, -inf],
@@ -253,71 +957,1428 @@ class Transformer(nn.Module):
         #  [0.,   0.,   0.,   0., -inf],
         #  [0.,   0.,   0.,   0.,   0.]]
         
-        return mask
+        return self.causal_mask[:size, :size]
     
     def create_pad_mask(self, matrix: torch.tensor, pad_token: int = -1) -> torch.tensor:
         # If matrix = [1,2,3,0,0,0] where pad_token=0, the result mask is
         # [False, False, False, True, True, True]
+        # for token tensors (batch, sequence, 11) only the first field is compared
+        if matrix.dim() == 3:
+            matrix = matrix[..., 0]
         return (matrix == pad_token)
     
 
+def load_model(path, device = "cpu", embedding = None):
+    """
+    loads a Transformer from a checkpoint as saved in the notebook
+    (model_state_dict and model_spec) or from an export_inference file
+    (.safetensors). Without embedding class, the one matching the saved 
+    weights is used.
+    """
+    if path.endswith(".safetensors"):
+        return load_inference(path, device)[0]
+    checkpoint = torch.load(path, map_location=torch.device(device), weights_only=False)
+    spec = checkpoint["model_spec"]
+    if embedding is None:
+        fused = "embedding.weight" in checkpoint["model_state_dict"]
+        embedding = FusedMultiEmbedding if fused else MultiEmbedding
+    model = Transformer(
+        tokens2dims = spec["tokens2dims"], 
+        MultiEmbedding = embedding, 
+        num_heads = spec["num_heads"], 
+        num_decoder_layers = spec["num_decoder_layers"], 
+        dropout_p = spec["dropout_p"], 
+    ).to(device)
+    model.load_state_dict(checkpoint["model_state_dict"])
+    model.eval()
+    return model
+
+
+########################################## PROFILING ##########################################
+
+
+_NULL_STAGE = contextlib.nullcontext()
+
+def _no_stage(name):
+    # stage of the loops without a profiler
+    return _NULL_STAGE
+
+
+def peak_rss_mb():
+    # peak resident memory of this process, None where resource is missing (Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+class StageProfiler(object):
+    """
+    wall clock time per stage (data, forward, loss, backward, step, sample, search),
+    tokens/s and peak memory of train_loop and the sampling loops, which 
+    take it as their profiler argument. Without one (the default) the loops 
+    measure nothing.
+
+    On cuda every stage synchronizes, so the times are exact but the run 
+    is slower than without the profiler.
+
+    trace: also record with torch.profiler and write a Chrome trace
+    (chrome://tracing or ui.perfetto.dev) to this file, the stages are 
+    labelled ranges in it
+    trace_steps: only trace this many steps (optimizer steps in train_loop, 
+    decoding steps when sampling) after one wait and one warmup step
+    """
+    def __init__(self, device = "cpu", trace = None, trace_steps = None, 
+                 record_shapes = False, profile_memory = False):
+        self.synchronize = torch.device(device).type == "cuda"
+        self.trace = trace
+        self.trace_steps = trace_steps
+        self.record_shapes = record_shapes
+        self.profile_memory = profile_memory
+        self.torch_profiler = None
+        self.traces = []
+        self._detach = []
+        self.reset()
+
+    def reset(self):
+        # clears the counters, e.g. for every epoch
+        self.seconds = collections.defaultdict(float)
+        self.counts = collections.defaultdict(int)
+        self.tokens = 0
+        self.samples = 0
+        self.start_time = None
+        self.stop_time = None
+
+    def _now(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        if self.start_time is None:
+            self.start_time = now
+        return now
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = self._now()
+        if self.torch_profiler is not None:
+            with torch.profiler.record_function(name):
+                yield
+        else:
+            yield
+        self.seconds[name] += self._now() - start
+        self.counts[name] += 1
+
+    def count(self, tokens = 0, samples = 0):
+        self.tokens += tokens
+        self.samples += samples
+
+    def step(self):
+        # advances the torch.profiler schedule
+        if self.torch_profiler is not None:
+            self.torch_profiler.step()
+
+    def attach(self, model):
+        """
+        times the forward of the parts of a Transformer as nested stages 
+        forward/embedding, forward/positional, forward/mask, forward/attention, 
+        forward/feed_forward and forward/out with module hooks, until detach. 
+        The attention of decode_step reads the weights directly and is not 
+        covered.
+        """
+        parts = [("embedding", model.embedding), ("positional", model.positional_encoder), 
+                 ("out", model.out)]
+        for layer in model.transformerDECODER.layers:
+            parts += [("attention", layer.self_attn), ("feed_forward", layer.linear1), 
+                      ("feed_forward", layer.linear2)]
+        for name, module in parts:
+            self._time_module(module, "forward/" + name)
+
+        get_tgt_mask = model.get_tgt_mask
+        def timed_mask(size):
+            with self.stage("forward/mask"):
+                return get_tgt_mask(size)
+        model.get_tgt_mask = timed_mask
+        self._detach.append(lambda: delattr(model, "get_tgt_mask"))
+        return self
+
+    def _time_module(self, module, name):
+        starts = []
+        def pre_hook(module, inputs):
+            starts.append(self._now())
+        def hook(module, inputs, output):
+            self.seconds[name] += self._now() - starts.pop()
+            self.counts[name] += 1
+        self._detach += [module.register_forward_pre_hook(pre_hook).remove,
+                         module.register_forward_hook(hook).remove]
+
+    def detach(self):
+        for remove in self._detach:
+            remove()
+        self._detach = []
+
+    def _export_trace(self, prof):
+        fn = self.trace
+        if self.trace_steps is not None:
+            root, ext = os.path.splitext(self.trace)
+            fn = f"{root}_step{prof.step_num}{ext or '.json'}"
+        prof.export_chrome_trace(fn)
+        self.traces.append(fn)
+
+    def start(self):
+        self._now()
+        if self.trace is not None and self.torch_profiler is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            schedule = None
+            if self.trace_steps is not None:
+                schedule = torch.profiler.schedule(wait=1, warmup=1, active=self.trace_steps, 
+                                                   repeat=1)
+            self.torch_profiler = torch.profiler.profile(activities=activities, 
+                                                         schedule=schedule,
+                                                         on_trace_ready=self._export_trace,
+                                                         record_shapes=self.record_shapes,
+                                                         profile_memory=self.profile_memory)
+            self.torch_profiler.start()
+        return self
+
+    def stop(self):
+        self.stop_time = self._now()
+        if self.torch_profiler is not None:
+            self.torch_profiler.stop()
+            self.torch_profiler = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def summary(self):
+        """
+        JSON serializable dict: wall clock seconds, seconds, calls, mean ms 
+        and share of the wall clock time per stage, tokens, samples and their 
+        rates, peak resident and cuda memory (MB)
+        """
+        if self.start_time is None:
+            elapsed = 0.0
+        else:
+            end = self.stop_time if self.stop_time is not None else time.perf_counter()
+            elapsed = end - self.start_time
+        stages = {}
+        for name, seconds in self.seconds.items():
+            stages[name] = {"seconds": seconds, 
+                            "calls": self.counts[name],
+                            "mean_ms": seconds * 1e3 / max(self.counts[name], 1),
+                            "share": seconds / elapsed if elapsed > 0 else 0.0}
+        summary = {"seconds": elapsed, 
+                   "stages": stages,
+                   "tokens": self.tokens, 
+                   "samples": self.samples,
+                   "tokens_per_second": self.tokens / elapsed if elapsed > 0 else 0.0,
+                   "samples_per_second": self.samples / elapsed if elapsed > 0 else 0.0,
+                   "peak_rss_mb": peak_rss_mb()}
+        if self.synchronize:
+            summary["peak_cuda_mb"] = torch.cuda.max_memory_allocated() / 2**20
+        if self.traces:
+            summary["traces"] = list(self.traces)
+        return summary
+
+    def log(self, fn, **fields):
+        # appends the summary and fields (e.g. epoch) as one JSON line to fn
+        with open(fn, "a") as fh:
+            fh.write(json.dumps(dict(fields, **self.summary())) + "\n")
+
+    def report(self):
+        summary = self.summary()
+        lines = [f"{'stage':>22} {'seconds':>9} {'calls':>7} {'mean ms':>9} {'share':>7}"]
+        for name, stage in sorted(summary["stages"].items()):
+            lines.append(f"{name:>22} {stage['seconds']:>9.3f} {stage['calls']:>7} "
+                         f"{stage['mean_ms']:>9.3f} {stage['share']:>7.1%}")
+        lines.append(f"{summary['seconds']:.2f} s, {summary['tokens_per_second']:.0f} tokens/s, "
+                     f"{summary['samples_per_second']:.1f} samples/s")
+        if summary["peak_rss_mb"] is not None:
+            memory = f"peak RSS {summary['peak_rss_mb']:.0f} MB"
+            if "peak_cuda_mb" in summary:
+                memory += f", peak cuda {summary['peak_cuda_mb']:.0f} MB"
+            lines.append(memory)
+        return "\n".join(lines)
+
+
+########################################## TRAINING ##########################################
+
+
+def loss_mask(y_expected, pred_dims):
+    """
+    True for the target positions (batch, sequence) which count for the loss:
+    the notes and the first EOS token. batch_data pads with EOS tokens, so 
+    every position after the first EOS is padding, as are -1 padded positions.
+    """
+    eos_token = torch.as_tensor(np.diff(pred_dims) - 1, device=y_expected.device)
+    is_eos = (y_expected == eos_token).all(-1)
+    after_eos = (torch.cumsum(is_eos.long(), dim=1) - is_eos.long()) > 0
+    return ~after_eos & (y_expected >= 0).all(-1)
+
+def multi_field_loss(pred, y_expected, pred_dims, field_weights = None):
+    """
+    cross entropy of all token fields in one log softmax over the padded
+    (fields x max width) view of pred (sequence, batch, logits), 
+    y_expected: (batch, sequence, 11). Padding positions (see loss_mask) 
+    are ignored.
+
+    Returns the sum of the per field mean losses, weighted by 
+    field_weights if given, and the per field losses (detached)
+    """
+    # batch / sequence / fields / max width
+    logits = pad_field_logits(pred.permute(1, 0, 2), pred_dims)
+    log_probs = nn.functional.log_softmax(logits.float(), dim=-1)
+    nll = -log_probs.gather(-1, y_expected.clamp(min=0).unsqueeze(-1)).squeeze(-1)
+
+    valid = loss_mask(y_expected, pred_dims)
+    field_losses = (nll * valid.unsqueeze(-1)).sum((0, 1)) / valid.sum().clamp(min=1)
+    if field_weights is None:
+        loss = field_losses.sum()
+    else:
+        loss = (field_losses * torch.as_tensor(field_weights, dtype=field_losses.dtype, 
+                                               device=field_losses.device)).sum()
+    return loss, field_losses.detach()
+
+def batches_to_tensors(batches, device, pin_memory = False):
+    """
+    converts numpy batches (batch, sequence, 11) to int64 tensors once before 
+    training. On cpu they are returned as they are, on cuda either moved to 
+    the device or, with pin_memory, kept in page locked host memory
+    """
+    tensors = []
+    for batch in batches:
+        y = torch.from_numpy(np.ascontiguousarray(batch, dtype=np.int64))
+        if pin_memory and torch.cuda.is_available():
+            y = y.pin_memory()
+        elif torch.device(device).type != "cpu":
+            y = y.to(device)
+        tensors.append(y)
+    return tensors
+
+def train_loop(model, 
+               opt, 
+               dataloader, 
+               tokens2dims, 
+               device = "cpu", 
+               accum_steps = 1, 
+               autocast_dtype = None,
+               forward = None,
+               field_weights = None,
+               start_batch = 0,
+               on_step = None,
+               profiler = None):
+    """
+    one epoch over the batches in dataloader (numpy arrays or tensors), 
+    the optimizer steps every accum_steps batches. 
+    autocast_dtype: e.g. torch.bfloat16 for mixed precision
+    forward: the model itself, a compiled version or a 
+    DistributedDataParallel wrapper of it 
+    field_weights: per field loss weights, see multi_field_loss
+    start_batch: skip the first batches, to resume an epoch
+    on_step: called with the number of batches done after every optimizer step
+    profiler: a StageProfiler timing the stages of every batch
+
+    Returns the mean loss and the mean per field losses
+    """
+    t2d = np.array(tokens2dims)
+    pred_dims = np.concatenate(([0],np.cumsum(t2d[:,0])))
+    forward = model if forward is None else forward
+    device_type = torch.device(device).type
+    model.train()
+    total_loss = torch.zeros((), device=device)
+    total_field_losses = torch.zeros(len(t2d), device=device)
+    opt.zero_grad()
+    stage = _no_stage if profiler is None else profiler.stage
+    # target tokens without padding, read once after the epoch
+    total_tokens = torch.zeros((), dtype=torch.long, device=device)
+    batches = iter(dataloader)
+    
+    for batch_idx in range(len(dataloader)):
+        # loading and moving to the device
+        with stage("data"):
+            batch = next(batches)
+            if batch_idx < start_batch:
+                continue
+            y = torch.as_tensor(batch).to(device, non_blocking=True)
+
+        # Now we shift the tgt by one so with the <SOS> we predict the token at pos 1
+        y_input = y[:,:-1,:]
+        y_expected = y[:,1:,:]
+        
+        step = (batch_idx + 1) % accum_steps == 0 or batch_idx + 1 == len(dataloader)
+        # DistributedDataParallel: only all-reduce gradients on the stepping batch
+        sync = contextlib.nullcontext() if step or not hasattr(forward, "no_sync") else forward.no_sync()
+        with sync:
+            with torch.autocast(device_type=device_type, 
+                                dtype=autocast_dtype, 
+                                enabled=autocast_dtype is not None):
+                with stage("forward"):
+                    pred = forward(y_input, causal=True)
+                with stage("loss"):
+                    loss, field_losses = multi_field_loss(pred, y_expected, pred_dims, field_weights)
+
+            with stage("backward"):
+                (loss / accum_steps).backward()
+        # no .item() per batch, it would synchronize every step
+        total_loss += loss.detach().float()
+        total_field_losses += field_losses
+
+        if profiler is not None:
+            total_tokens += loss_mask(y_expected, pred_dims).sum()
+            profiler.count(samples=len(y))
+
+        if step:
+            with stage("step"):
+                opt.step()
+                opt.zero_grad()
+            if profiler is not None:
+                profiler.step()
+            if on_step is not None:
+                on_step(batch_idx + 1)
+    
+    if profiler is not None:
+        profiler.count(int(total_tokens))
+    num_batches = max(len(dataloader) - start_batch, 1)
+    return total_loss.item() / num_batches, (total_field_losses / num_batches).cpu().numpy()
+
+
+def evaluate_loss(model, dataloader, tokens2dims, device = "cpu"):
+    """
+    mean loss and mean per field negative log likelihood (nats per token) 
+    over the non padding positions of the batches in dataloader
+    """
+    t2d = np.array(tokens2dims)
+    pred_dims = np.concatenate(([0],np.cumsum(t2d[:,0])))
+    model.eval()
+    total_field_losses = torch.zeros(len(t2d))
+    total_positions = 0
+    with torch.no_grad():
+        for batch in dataloader:
+            y = torch.as_tensor(batch).to(device)
+            y_input = y[:,:-1,:]
+            y_expected = y[:,1:,:]
+            pred = model(y_input, causal=True)
+            _, field_losses = multi_field_loss(pred, y_expected, pred_dims)
+            positions = int(loss_mask(y_expected, pred_dims).sum())
+            total_field_losses += field_losses.float().cpu() * positions
+            total_positions += positions
+    field_nll = (total_field_losses / max(total_positions, 1)).numpy()
+    return field_nll.sum(), field_nll
+
+def quantize_model(model):
+    """
+    int8 dynamic quantization for CPU inference: the weights of the 
+    nn.Linear layers (feed forward blocks and output layer) are stored in 
+    int8, activations are quantized on the fly. The attention projections 
+    stay in float. Returns a quantized copy, usable with decode_step.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+########################################## CHECKPOINTS ##########################################
+
+
+def get_rng_state():
+    # only tensors and python builtins, so that torch.load(weights_only=True) works
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {
+        "torch": torch.get_rng_state(),
+        "numpy": (name, torch.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian),
+        "python": random.getstate(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    torch.set_rng_state(state["torch"])
+    name, keys, pos, has_gauss, cached_gaussian = state["numpy"]
+    np.random.set_state((name, keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    random.setstate(state["python"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+def save_checkpoint(path, model, opt, model_spec, epoch, batch = 0, step = 0, 
+                    loss = None, train_loss_list = None):
+    """
+    saves model, optimizer, RNG states and the position in the data 
+    (epoch, batch within the epoch, optimizer steps). The file is written 
+    next to path and renamed, so path always holds a complete checkpoint.
+    The keys of the notebook checkpoints are kept.
+    """
+    checkpoint = {
+        'epoch': epoch,
+        'batch': batch,
+        'step': step,
+        'model_state_dict': model.state_dict(),
+        'optimizer_state_dict': opt.state_dict(),
+        'loss': loss,
+        'train_loss_list': train_loss_list,
+        'model_spec': model_spec,
+        'rng_state': get_rng_state(),
+    }
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as fh:
+        torch.save(checkpoint, fh)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp_path, path)
+
+def load_checkpoint(path, model, opt = None, device = "cpu"):
+    """
+    restores model, optimizer and RNG states from save_checkpoint, 
+    returns the checkpoint dict (epoch, batch, step, ...)
+    """
+    checkpoint = torch.load(path, map_location=torch.device(device), weights_only=False)
+    model.load_state_dict(checkpoint["model_state_dict"])
+    if opt is not None:
+        opt.load_state_dict(checkpoint["optimizer_state_dict"])
+    if "rng_state" in checkpoint:
+        set_rng_state(checkpoint["rng_state"])
+    return checkpoint
+
+
+# safetensors dtype names
+_EXPORT_DTYPES = {
+    torch.float32: ("F32", np.float32),
+    torch.float16: ("F16", np.float16),
+    torch.float64: ("F64", np.float64),
+    torch.int64: ("I64", np.int64),
+    torch.int32: ("I32", np.int32),
+    torch.bool: ("BOOL", np.bool_),
+}
+
+def export_inference(path, model, model_spec, 
+                     config = TOKENIZER_CONFIG, inv_pitch_dict = INV_PITCH_DICT_SIMPLE):
+    """
+    writes the model weights in the safetensors layout (8 byte header size, 
+    JSON header, raw little endian tensor data) with the model_spec, the 
+    embedding type, the tokenizer config the model was trained with and 
+    its pitch dicts as metadata. bfloat16 weights are stored as float32. 
+    Loaded by load_inference without unpickling.
+    """
+    pitch_dict = {(k if k == "default" else int(k)): v for k, v in config["pitch_dict"].items()}
+    header = {"__metadata__": {
+        "model_spec": json.dumps(model_spec),
+        "embedding": type(model.embedding).__name__,
+        "tokenizer_config": json.dumps(config),
+        "pitch_dict": json.dumps([[k, v] for k, v in pitch_dict.items()]),
+        "inv_pitch_dict": json.dumps([[k, v] for k, v in inv_pitch_dict.items()]),
+    }}
+    arrays = []
+    offset = 0
+    for name, tensor in model.state_dict().items():
+        tensor = tensor.detach().cpu()
+        if tensor.dtype == torch.bfloat16:
+            tensor = tensor.float()
+        dtype_name, np_dtype = _EXPORT_DTYPES[tensor.dtype]
+        array = np.ascontiguousarray(tensor.numpy(), dtype=np.dtype(np_dtype).newbyteorder("<"))
+        header[name] = {"dtype": dtype_name, 
+                        "shape": list(array.shape), 
+                        "data_offsets": [offset, offset + array.nbytes]}
+        arrays.append(array)
+        offset += array.nbytes
+    header_bytes = json.dumps(header).encode("utf-8")
+    # data starts 8 byte aligned
+    header_bytes += b" " * (-len(header_bytes) % 8)
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as fh:
+        fh.write(struct.pack("<Q", len(header_bytes)))
+        fh.write(header_bytes)
+        for array in arrays:
+            fh.write(array.tobytes())
+    os.replace(tmp_path, path)
+
+def load_inference(path, device = "cpu"):
+    """
+    loads an export_inference file: the tensors are memory mapped (copy on
+    write) instead of read and unpickled. 
+    Returns the model in eval mode and the metadata (model_spec, 
+    pitch dicts and the tokenizer config, None for older exports)
+    """
+    with open(path, "rb") as fh:
+        header_size = struct.unpack("<Q", fh.read(8))[0]
+        header = json.loads(fh.read(header_size))
+    metadata = header.pop("__metadata__")
+    data = np.memmap(path, dtype=np.uint8, mode="c", offset=8 + header_size)
+    np_dtypes = {name: np_dtype for name, np_dtype in _EXPORT_DTYPES.values()}
+    state_dict = dict()
+    for name, info in header.items():
+        start, end = info["data_offsets"]
+        array = data[start:end].view(np.dtype(np_dtypes[info["dtype"]]).newbyteorder("<"))
+        state_dict[name] = torch.from_numpy(array.reshape(info["shape"]))
+
+    spec = json.loads(metadata["model_spec"])
+    spec["tokens2dims"] = [tuple(t) for t in spec["tokens2dims"]]
+    embedding = FusedMultiEmbedding if metadata["embedding"] == "FusedMultiEmbedding" else MultiEmbedding
+    model = Transformer(
+        tokens2dims = spec["tokens2dims"], 
+        MultiEmbedding = embedding, 
+        num_heads = spec["num_heads"], 
+        num_decoder_layers = spec["num_decoder_layers"], 
+        dropout_p = spec["dropout_p"], 
+    )
+    model.load_state_dict(state_dict)
+    model.to(device)
+    model.eval()
+    vocab = {
+        "model_spec": spec,
+        "pitch_dict": {k: v for k, v in json.loads(metadata["pitch_dict"])},
+        "inv_pitch_dict": {k: v for k, v in json.loads(metadata["inv_pitch_dict"])},
+        "tokenizer_config": json.loads(metadata["tokenizer_config"]) 
+                            if "tokenizer_config" in metadata else None,
+    }
+    return model, vocab
+
+
 ########################################## SAMPLING ##########################################
 
     
-def sample_from_logits(pred, pred_dims):
-    """
-    """
-    # print(pred.shape)
-    out = list()
-    for k in range(11):
-        # batch / sequence / logits /
-        # out.append(torch.argmax(pred[:,:,pred_dims[k]:pred_dims[k+1]], dim = -1, keepdim = True))
-        out.append(
-            torch.reshape(
-                torch.multinomial(
-                nn.functional.softmax(pred[:,-1,pred_dims[k]:pred_dims[k+1]], dim = -1),
-                1),(-1, 1, 1)
-            )
-        ) 
-    o = torch.cat(out, dim=-1)
-    # print(o.shape)
-
-    return o
+# padded (fields x max width) layout of the concatenated logits, per pred_dims and device
+_FIELD_LAYOUTS = dict()
+
+def field_layout(pred_dims, device):
+    """
+    returns a (num_fields, max_width) index into the concatenated logits
+    and a boolean mask of the valid (non-padding) entries
+    """
+    key = (tuple(int(d) for d in pred_dims), str(device))
+    if key not in _FIELD_LAYOUTS:
+        pred_dims = np.asarray(pred_dims)
+        widths = np.diff(pred_dims)
+        slots = np.arange(widths.max())
+        valid = slots[None, :] < widths[:, None]
+        idx = np.where(valid, pred_dims[:-1, None] + slots[None, :], 0)
+        _FIELD_LAYOUTS[key] = (torch.as_tensor(idx, dtype=torch.long, device=device),
+                               torch.as_tensor(valid, device=device))
+    return _FIELD_LAYOUTS[key]
+
+def pad_field_logits(logits, pred_dims):
+    """
+    gathers concatenated logits (..., num_tokens) into a padded 
+    (..., num_fields, max_width) view, padding entries are -inf
+    """
+    idx, valid = field_layout(pred_dims, logits.device)
+    padded = logits[..., idx]
+    return padded.masked_fill(~valid, float('-inf'))
+
+def _per_field(value, num_fields, dtype, device):
+    value = torch.as_tensor(value, dtype=dtype, device=device)
+    if value.dim() == 0:
+        value = value.expand(num_fields)
+    return value
+    
+def sample_fields(logits, temperature=1.0, top_k=None, top_p=None):
+    """
+    draws one value per field from padded field logits 
+    (batch, num_fields, max_width) with a single Gumbel-max draw.
+    temperature, top_k and top_p are either scalars or one value per 
+    field, top_k <= 0 and top_p >= 1 disable the filter for a field.
+
+    Returns a tensor of size (batch, num_fields)
+    """
+    num_fields, width = logits.shape[-2:]
+
+    if not (isinstance(temperature, (int, float)) and temperature == 1.0):
+        logits = logits / _per_field(temperature, num_fields, 
+                                     logits.dtype, logits.device)[:, None]
+
+    order = None
+    if top_k is not None or top_p is not None:
+        logits, order = torch.sort(logits, dim=-1, descending=True)
+        if top_k is not None:
+            k = _per_field(top_k, num_fields, torch.long, logits.device)
+            k = torch.where(k > 0, k, torch.full_like(k, width))
+            ranks = torch.arange(width, device=logits.device)
+            logits = logits.masked_fill(ranks[None, :] >= k[:, None], float('-inf'))
+        if top_p is not None:
+            p = _per_field(top_p, num_fields, logits.dtype, logits.device)
+            probs = nn.functional.softmax(logits, dim=-1)
+            # drop a token if the tokens ranked before it already cover p
+            logits = logits.masked_fill(probs.cumsum(-1) - probs > p[:, None], float('-inf'))
+
+    # Gumbel-max: argmax(logits + Gumbel noise) ~ categorical(softmax(logits))
+    sample = (logits - torch.empty_like(logits).exponential_().log()).argmax(-1)
+    if order is not None:
+        sample = order.gather(-1, sample.unsqueeze(-1)).squeeze(-1)
+    return sample
+
+def sample_from_logits(pred, pred_dims, temperature=1.0, top_k=None, top_p=None):
+    """
+    samples all 11 token fields of the next token at once from the 
+    logits of the last step of pred (batch / sequence / logits).
+    The field logits are padded to a common width and drawn together,
+    see sample_fields for temperature, top_k and top_p.
+
+    Returns a tensor of size (batch, 1, num_fields)
+    """
+    # batch / fields / max width
+    logits = pad_field_logits(pred[:, -1], pred_dims)
+    return sample_fields(logits, temperature, top_k, top_p).unsqueeze(1)
+
+def token_log_prob(pred, tokens, pred_dims):
+    """
+    model log likelihood of the tokens (batch, num_fields) under the logits 
+    of the last step of pred (batch / sequence / logits): the sum of the 
+    per field log probabilities, without temperature or filters.
+
+    Returns a tensor of size (batch)
+    """
+    field_lp = nn.functional.log_softmax(pad_field_logits(pred[:, -1], pred_dims), dim=-1)
+    return field_lp.gather(-1, tokens.unsqueeze(-1)).squeeze(-1).sum(-1)
+
+
+def top_joint(first_lp, rest_lp, k):
+    """
+    the k best combinations of a value of a first field (batch, width) and 
+    one value of every field of rest_lp (batch, num_fields, width) by the 
+    sum of their log probabilities. Exact without enumerating all 
+    combinations: the fields are merged one at a time, keeping the k best 
+    partial combinations.
+
+    Returns the log probabilities (batch, k) and the values (batch, k, 1 + num_fields)
+    """
+    lp, values = first_lp.topk(min(k, first_lp.size(-1)), dim=-1)
+    values = values.unsqueeze(-1)
+    for field in range(rest_lp.size(1)):
+        field_lp, field_values = rest_lp[:, field].topk(min(k, rest_lp.size(-1)), dim=-1)
+        width = field_lp.size(-1)
+        lp, idx = (lp[:, :, None] + field_lp[:, None, :]).flatten(1).topk(
+            min(k, lp.size(1) * width), dim=-1)
+        prefix = torch.div(idx, width, rounding_mode="floor")
+        values = torch.cat((values.gather(1, prefix.unsqueeze(-1).expand(-1, -1, values.size(-1))),
+                            field_values.gather(1, idx % width).unsqueeze(-1)), dim=-1)
+    return lp, values
+
+
+def _fields_from(value, first_field):
+    # per field values for the fields from first_field on, scalars pass through
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return list(value)[first_field:]
+
+
+class ConstraintState(object):
+    """
+    per sequence decoding state for TokenConstraints
+    """
+    def __init__(self, onset, fixed, finished):
+        # onset of the last note on the 128th grid
+        self.onset = onset
+        # value of the tempo and beat fields for the sequence, -1 if not yet known
+        self.fixed = fixed
+        # EOS has been emitted
+        self.finished = finished
+
+    def index_select(self, idx):
+        self.onset = self.onset.index_select(0, idx)
+        self.fixed = self.fixed.index_select(0, idx)
+        self.finished = self.finished.index_select(0, idx)
+        return self
+
+
+class TokenConstraints(object):
+    """
+    sampling masks which only allow well-formed drum tokens:
+
+    - a token is either a note or the EOS token (all fields EOS),
+      EOS is final
+    - the 7 time fields are binary digits, and the onset they 
+      encode never goes back in the bar
+    - the instrument is one of inv_pitch_dict, velocity is a 
+      velocity class (no SOS/EOS)
+    - tempo and beat/fill stay those of the first note (or of the 
+      conditioning given to initial_state)
+
+    The onset is drawn jointly over all 2**7 grid positions (plus EOS), 
+    using the sum of the per-field log probabilities, the other fields 
+    are drawn with sample_fields. All masks are precomputed.
+    """
+    def __init__(self, 
+                 tokens2dims, 
+                 inv_pitch_dict = INV_PITCH_DICT_SIMPLE, 
+                 device = "cpu",
+                 num_time_fields = 7):
+        t2d = np.array(tokens2dims)
+        self.vocab_sizes = t2d[:,0]
+        self.pred_dims = np.concatenate(([0],np.cumsum(t2d[:,0])))
+        self.num_time_fields = num_time_fields
+        self.device = device
+        width = self.vocab_sizes.max()
+        
+        # onset grid: binary digits of every grid position, half note first
+        grid = np.arange(2 ** num_time_fields)
+        bits = (grid[:, None] >> np.arange(num_time_fields - 1, -1, -1)[None, :]) & 1
+        self.grid = torch.as_tensor(grid, dtype=torch.long, device=device)
+        # time fields / grid positions, for gathering the per field log probs
+        self.onset_bits = torch.as_tensor(bits.T, dtype=torch.long, device=device)
+
+        # EOS is the last class of every field, SOS the one before
+        self.eos_token = torch.as_tensor(self.vocab_sizes - 1, dtype=torch.long, device=device)
+
+        # additive masks (0 / -inf) for the fields after the time code in a note token
+        note_mask = np.full((len(self.vocab_sizes) - num_time_fields, width), -np.inf)
+        for i, vocab_size in enumerate(self.vocab_sizes[num_time_fields:]):
+            note_mask[i, :vocab_size - 2] = 0.0
+        pitch_mask = np.full(width, -np.inf)
+        pitch_mask[list(inv_pitch_dict.keys())] = 0.0
+        note_mask[0] = pitch_mask
+        self.note_mask = torch.as_tensor(note_mask, dtype=torch.float, device=device)
+
+    def initial_state(self, batch_size, tempo = None, beat = None):
+        """
+        tempo / beat: optional class (or one class per sequence) to condition on
+        """
+        fixed = torch.full((batch_size, 2), -1, dtype=torch.long, device=self.device)
+        if tempo is not None:
+            fixed[:, 0] = torch.as_tensor(tempo, dtype=torch.long, device=self.device)
+        if beat is not None:
+            fixed[:, 1] = torch.as_tensor(beat, dtype=torch.long, device=self.device)
+        return ConstraintState(
+            onset = torch.zeros(batch_size, dtype=torch.long, device=self.device),
+            fixed = fixed,
+            finished = torch.zeros(batch_size, dtype=torch.bool, device=self.device))
+
+    def sample(self, pred, state, temperature=1.0, top_k=None, top_p=None, allow_eos=True):
+        """
+        samples the next token of every sequence from the logits of the 
+        last step of pred (batch / sequence / logits) and updates state.
+        top_k and top_p only apply to the fields after the time code.
+
+        Returns a tensor of size (batch, 1, num_fields)
+        """
+        logits = pad_field_logits(pred[:, -1], self.pred_dims)
+        batch_size = logits.size(0)
+        n_time = self.num_time_fields
+
+        time_logits = logits[:, :n_time]
+        if not (isinstance(temperature, (int, float)) and temperature == 1.0):
+            t = _per_field(temperature, logits.size(1), logits.dtype, logits.device)
+            time_logits = time_logits / t[:n_time, None]
+        time_lp = nn.functional.log_softmax(time_logits, dim=-1)
+
+        # joint log prob of every onset on the grid (batch, 2**n_time) and of EOS
+        onset_lp = time_lp.gather(-1, self.onset_bits.expand(batch_size, -1, -1)).sum(1)
+        eos_lp = time_lp[:, :, int(self.vocab_sizes[0]) - 1].sum(1, keepdim=True)
+        onset_lp = onset_lp.masked_fill(self.grid[None, :] < state.onset[:, None], float('-inf'))
+        if not allow_eos:
+            eos_lp = torch.full_like(eos_lp, float('-inf'))
+        choice = sample_fields(torch.cat((onset_lp, eos_lp), dim=-1).unsqueeze(1)).squeeze(1)
+        eos = (choice == self.grid.size(0)) | state.finished
+        onset = torch.where(eos, state.onset, choice)
+
+        # remaining fields, tempo and beat restricted to the fixed values
+        fixed = state.fixed >= 0
+        rest = sample_fields(logits[:, n_time:] + self.note_fields_mask(state), 
+                             _fields_from(temperature, n_time),
+                             _fields_from(top_k, n_time),
+                             _fields_from(top_p, n_time))
+
+        token = torch.cat((self.onset_bits.t()[onset], rest), dim=-1)
+        token = torch.where(eos.unsqueeze(-1), self.eos_token.expand(batch_size, -1), token)
+
+        state.onset = onset
+        state.fixed = torch.where(fixed | eos.unsqueeze(-1), state.fixed, rest[:, -2:])
+        state.finished = eos
+        return token.unsqueeze(1)
+
+    def note_fields_mask(self, state):
+        """
+        additive mask (batch, num_fields - num_time_fields, width) of the 
+        fields after the time code of a note, with tempo and beat 
+        restricted to the fixed values of state
+        """
+        mask = self.note_mask.expand(state.fixed.size(0), -1, -1).clone()
+        fixed_mask = torch.full_like(mask[:, -2:], float('-inf'))
+        fixed_mask.scatter_(-1, state.fixed.clamp(min=0).unsqueeze(-1), 0.0)
+        mask[:, -2:] = torch.where((state.fixed >= 0).unsqueeze(-1), fixed_mask, mask[:, -2:])
+        return mask
+
+    def candidates(self, field_lp, state, k):
+        """
+        the k most likely well-formed notes and the EOS token for every 
+        sequence, from per field log probabilities (batch, num_fields, width).
+        Returns the joint log probabilities (batch, k + 1), the tokens 
+        (batch, k + 1, num_fields) and their onsets on the grid (batch, k + 1), 
+        EOS is the last candidate.
+        """
+        batch_size = field_lp.size(0)
+        n_time = self.num_time_fields
+        onset_lp = field_lp[:, :n_time].gather(-1, self.onset_bits.expand(batch_size, -1, -1)).sum(1)
+        onset_lp = onset_lp.masked_fill(self.grid[None, :] < state.onset[:, None], float('-inf'))
+        lp, values = top_joint(onset_lp, field_lp[:, n_time:] + self.note_fields_mask(state), k)
+        tokens = torch.cat((self.onset_bits.t()[values[..., 0]], values[..., 1:]), dim=-1)
+
+        eos = self.eos_token.expand(batch_size, -1)
+        eos_lp = field_lp.gather(-1, eos.unsqueeze(-1)).squeeze(-1).sum(-1)
+        return (torch.cat((lp, eos_lp.unsqueeze(1)), dim=1),
+                torch.cat((tokens, eos.unsqueeze(1)), dim=1),
+                torch.cat((values[..., 0], state.onset.unsqueeze(1)), dim=1))
+
+
+def is_valid_tokens(tokens, inv_pitch_dict = INV_PITCH_DICT_SIMPLE, num_time_fields = 7):
+    """
+    checks a generated sequence (without SOS, size (sequence, 11)) for 
+    well-formed notes with non-decreasing onsets terminated by EOS
+    """
+    tokens = np.asarray(tokens)
+    eos_rows = np.nonzero((tokens[:, :num_time_fields] == 3).all(-1))[0]
+    if len(eos_rows) == 0:
+        return False
+    notes = tokens[:eos_rows[0]]
+    if len(notes) == 0:
+        return False
+    time_code = notes[:, :num_time_fields]
+    if not np.isin(time_code, [0, 1]).all():
+        return False
+    if not np.isin(notes[:, num_time_fields], list(inv_pitch_dict.keys())).all():
+        return False
+    onsets = (time_code * 2 ** np.arange(num_time_fields - 1, -1, -1)).sum(-1)
+    return bool((np.diff(onsets) >= 0).all())
 
 def sample_loop(model, 
                 tokens2dims,
-                device):
+                device,
+                num_samples=16,
+                num_steps=31,
+                use_cache=True,
+                temperature=1.0,
+                top_k=None,
+                top_p=None,
+                constraints=None,
+                profiler=None):
     """
+    autoregressively samples num_steps tokens for num_samples sequences 
+    starting from a SOS token. With use_cache only the newest token is 
+    passed through the model at each step (see Transformer.decode_step),
+    otherwise the full sequence is recomputed with a causal mask.
+    temperature, top_k and top_p are passed to sample_from_logits, 
+    or to constraints.sample if TokenConstraints are given.
+    profiler: a StageProfiler timing the forward and sample stages
     """
     t2d = np.array(tokens2dims)
     pred_dims = np.concatenate(([0],np.cumsum(t2d[:,0])))
     model.eval()
 
-    dataloader = [np.array([[[2,2,2,2,2,2,2, # time encoding
-                             6,8,8,2]
-                             #,
-                             #[0,1,0,0,0,0,0, # time encoding
-                             #0,8,3,1]
-                            ]]) * np.ones((16,1,1))]
-      
-    for batch in dataloader:
-        y = batch
-        y = torch.LongTensor(y).to(device)
+    y = np.repeat(sos_token()[None], num_samples, axis=0)
+    y = torch.LongTensor(y).to(device)
 
-        # seq / batch / logits
-        pred = model(y)
-        # batch / sequence / logits
-        pred = pred.permute(1, 0, 2) 
-        sample = sample_from_logits(pred, pred_dims)
-        prevY = y
-        y = torch.cat((y,sample), dim=1)
-        
-        for i in range(30):
-            pred = model(y)
-            pred = pred.permute(1, 0, 2) 
-            sample = sample_from_logits(pred, pred_dims)
-            prevX = y
-            # print(sample[0,:,:])
-            y = torch.cat((y,sample[:,-1:,:]), dim=1)
+    if constraints is not None:
+        state = constraints.initial_state(num_samples)
+        sample_next = lambda pred: constraints.sample(pred, state, temperature, top_k, top_p)
+    else:
+        sample_next = lambda pred: sample_from_logits(pred, pred_dims, temperature, top_k, top_p)
+    stage = _no_stage if profiler is None else profiler.stage
+
+    with torch.no_grad():
+        if use_cache:
+            cache = model.init_cache()
+            new_tokens = y
+            for i in range(num_steps):
+                # batch / sequence / logits
+                with stage("forward"):
+                    pred = model.decode_step(new_tokens, cache)
+                with stage("sample"):
+                    new_tokens = sample_next(pred)
+                y = torch.cat((y, new_tokens), dim=1)
+                if profiler is not None:
+                    profiler.count(num_samples)
+                    profiler.step()
+        else:
+            for i in range(num_steps):
+                # seq / batch / logits
+                with stage("forward"):
+                    pred = model(y, causal=True)
+                # batch / sequence / logits
+                pred = pred.permute(1, 0, 2) 
+                with stage("sample"):
+                    sample = sample_next(pred)
+                y = torch.cat((y,sample), dim=1)
+                if profiler is not None:
+                    profiler.count(num_samples)
+                    profiler.step()
+        if profiler is not None:
+            profiler.count(samples=num_samples)
         
-    return y
\ No newline at end of file
+    return y
+
+def _decode_loop(model, pred, cache, max_len, pred_dims, eos_field, eos_value,
+                 temperature=1.0, top_k=None, top_p=None, constraints=None, state=None,
+                 profiler=None, return_scores=False, min_notes=0):
+    # samples from the first logits pred (batch, 1, num_tokens) on, with compaction,
+    # EOS can only be sampled after min_notes notes
+    num_samples = pred.size(0)
+    eos_logit = int(pred_dims[eos_field]) + eos_value
+    stage = _no_stage if profiler is None else profiler.stage
+    device = pred.device
+    out = torch.full((num_samples, max_len, len(pred_dims) - 1), -1, dtype=torch.long, device=device)
+    lengths = torch.zeros(num_samples, dtype=torch.long, device=device)
+    scores = torch.zeros(num_samples, device=device)
+    # original index of every row of the active batch
+    active = torch.arange(num_samples, device=device)
+
+    with torch.no_grad():
+        for step in range(max_len):
+            if step > 0:
+                with stage("forward"):
+                    pred = model.decode_step(new_tokens, cache)
+            with stage("sample"):
+                if constraints is not None:
+                    new_tokens = constraints.sample(pred, state, temperature, top_k, top_p,
+                                                    allow_eos=step >= min_notes)
+                elif step < min_notes:
+                    no_eos = pred.clone()
+                    no_eos[..., eos_logit] = float('-inf')
+                    new_tokens = sample_from_logits(no_eos, pred_dims, temperature, top_k, top_p)
+                else:
+                    new_tokens = sample_from_logits(pred, pred_dims, temperature, top_k, top_p)
+                if return_scores:
+                    scores[active] += token_log_prob(pred, new_tokens[:, 0], pred_dims)
+            if profiler is not None:
+                profiler.count(len(active))
+                profiler.step()
+            out[active, step] = new_tokens[:, 0]
+            lengths[active] = step + 1
+
+            # compaction: keep only unfinished rows
+            running = new_tokens[:, 0, eos_field] != eos_value
+            if not bool(running.all()):
+                keep = running.nonzero().squeeze(1)
+                if keep.numel() == 0:
+                    break
+                active = active[keep]
+                new_tokens = new_tokens[keep]
+                cache.index_select(keep)
+                if constraints is not None:
+                    state.index_select(keep)
+
+    out = out.cpu().numpy()
+    lengths = lengths.cpu().numpy()
+    if profiler is not None:
+        profiler.count(samples=num_samples)
+    sequences = [out[i, :lengths[i]] for i in range(num_samples)]
+    if return_scores:
+        return sequences, lengths, scores.cpu().numpy()
+    return sequences, lengths
+
+
+def generate(model,
+             tokens2dims,
+             device,
+             num_samples=16,
+             max_len=64,
+             temperature=1.0,
+             top_k=None,
+             top_p=None,
+             constraints=None,
+             tempo=None,
+             beat=None,
+             eos_field=7,
+             profiler=None,
+             return_scores=False,
+             min_notes=0):
+    """
+    samples up to max_len tokens for num_samples sequences with the KV cache.
+    A sequence is finished once it samples EOS in the instrument field 
+    (eos_field), finished sequences are dropped from the batch and the cache 
+    so that every step only computes the still active sequences.
+    tempo and beat classes condition the constraints and need them.
+    EOS is only sampled after min_notes notes.
+    profiler: a StageProfiler timing the forward and sample stages
+
+    Returns a list of num_samples token arrays (length, 11) without SOS, 
+    ending with the EOS token unless max_len was reached, and their lengths.
+    With return_scores also the model log likelihood of every sequence 
+    (see token_log_prob).
+    """
+    if (tempo is not None or beat is not None) and constraints is None:
+        raise ValueError("conditioning on tempo or beat requires the constraints")
+    t2d = np.array(tokens2dims)
+    pred_dims = np.concatenate(([0],np.cumsum(t2d[:,0])))
+    eos_value = int(t2d[eos_field, 0]) - 1
+    model.eval()
+
+    sos_tokens = torch.LongTensor(np.repeat(sos_token()[None], num_samples, axis=0)).to(device)
+    cache = model.init_cache()
+    state = None
+    if constraints is not None:
+        state = constraints.initial_state(num_samples, tempo, beat)
+    stage = _no_stage if profiler is None else profiler.stage
+    with torch.no_grad(), stage("forward"):
+        pred = model.decode_step(sos_tokens, cache)
+    return _decode_loop(model, pred, cache, max_len, pred_dims, eos_field, eos_value,
+                        temperature, top_k, top_p, constraints, state, profiler, return_scores,
+                        min_notes)
+
+
+def conditioning_prefix(prompt=None):
+    """
+    prefix tokens of a generation: SOS, or with a prompt bar (n, 11) or a 
+    list of bars SOS, bar, EOS for every bar and the SOS of the new bar, 
+    the sliding window of generate_bars
+    """
+    sos = sos_token()
+    if prompt is None or len(prompt) == 0:
+        return sos
+    bars = [prompt] if np.ndim(prompt[0]) == 1 else prompt
+    window = [sos]
+    for bar in bars:
+        window += [np.asarray(bar).reshape(-1, sos.shape[1]), sos + 1, sos]
+    return np.concatenate(window, axis=0)
+
+
+def prefill_prefixes(model, prefixes, device):
+    """
+    runs the prefix token arrays (length, 11) of different lengths as one 
+    left padded batch through the model. Returns the cache and the logits 
+    of the last prefix position, one row per prefix.
+    """
+    max_len = max(len(p) for p in prefixes)
+    tokens = np.repeat(sos_token()[None], len(prefixes), axis=0).repeat(max_len, axis=1)
+    pad = np.ones((len(prefixes), max_len), dtype=bool)
+    for i, p in enumerate(prefixes):
+        tokens[i, max_len - len(p):] = p
+        pad[i, max_len - len(p):] = False
+    cache = model.init_cache()
+    pad = torch.as_tensor(pad, device=device) if pad.any() else None
+    with torch.no_grad():
+        pred = model.decode_step(torch.as_tensor(tokens, dtype=torch.long, device=device), 
+                                 cache, pad)
+    return cache, pred[:, -1:]
+
+
+def generate_conditioned(model,
+                         tokens2dims,
+                         device,
+                         styles=None,
+                         tempo=None,
+                         beat=None,
+                         prompts=None,
+                         max_len=64,
+                         temperature=1.0,
+                         top_k=None,
+                         top_p=None,
+                         constraints=None,
+                         eos_field=7,
+                         profiler=None,
+                         return_scores=False):
+    """
+    one sample per request for a batch of differently conditioned requests:
+    styles[i] (a key of prompts, or None), tempo[i] and beat[i] (classes, 
+    None or -1 for any) of request i, at least one of them is given. prompts maps a style to a prompt bar 
+    (n, 11), e.g. from style_prompts in groove_corpus.
+
+    Every distinct prefix (conditioning_prefix of the style's prompt) is 
+    run through the model once, its cached keys and values are broadcast 
+    to the requests with KVCache.index_select, and the whole batch then 
+    samples with one forward per step. Tempo and beat need the constraints.
+    profiler: a StageProfiler, the prefill is timed as the prefill stage
+
+    Returns the sequences and lengths (and the scores) as generate
+    """
+    if styles is None and tempo is None and beat is None:
+        raise ValueError("generate_conditioned needs styles, tempo or beat per request, "
+                         "use generate for unconditioned samples")
+    num_samples = len(styles) if styles is not None else len(tempo if tempo is not None else beat)
+    if styles is None:
+        styles = [None] * num_samples
+    prompts = prompts or {}
+    if (tempo is not None or beat is not None) and constraints is None:
+        raise ValueError("conditioning on tempo or beat requires the constraints")
+    t2d = np.array(tokens2dims)
+    pred_dims = np.concatenate(([0],np.cumsum(t2d[:,0])))
+    eos_value = int(t2d[eos_field, 0]) - 1
+    model.eval()
+
+    # distinct prefixes and the prefix of every request
+    keys = sorted(set(styles), key=str)
+    prefix_idx = torch.as_tensor([keys.index(style) for style in styles], device=device)
+    prefixes = [conditioning_prefix(prompts[style]) if style is not None 
+                else conditioning_prefix() for style in keys]
+    stage = _no_stage if profiler is None else profiler.stage
+    with stage("prefill"):
+        cache, pred = prefill_prefixes(model, prefixes, device)
+    cache.index_select(prefix_idx)
+    pred = pred.index_select(0, prefix_idx)
+
+    state = None
+    if constraints is not None:
+        def per_request(values):
+            if values is None:
+                return None
+            return [-1 if v is None else int(v) for v in values]
+        state = constraints.initial_state(num_samples, per_request(tempo), per_request(beat))
+    return _decode_loop(model, pred, cache, max_len, pred_dims, eos_field, eos_value,
+                        temperature, top_k, top_p, constraints, state, profiler, return_scores)
+
+
+def _per_row(value, num_requests, repeats):
+    # scalar or per request conditioning, repeated for the candidates of every request
+    if value is None:
+        return None
+    return np.repeat(np.broadcast_to(np.asarray(value), (num_requests,)), repeats)
+
+
+def _normalized_scores(scores, notes, length_penalty):
+    # log likelihood / notes ** length_penalty, the EOS token is not counted
+    # so that its cheap log probability does not favour short sequences
+    return scores / notes.clip(1) ** length_penalty
+
+
+def generate_best_of(model,
+                     tokens2dims,
+                     device,
+                     num_samples=16,
+                     best_of=4,
+                     max_len=64,
+                     temperature=1.0,
+                     top_k=None,
+                     top_p=None,
+                     constraints=None,
+                     tempo=None,
+                     beat=None,
+                     length_penalty=1.0,
+                     min_notes=1,
+                     eos_field=7,
+                     profiler=None):
+    """
+    samples best_of candidates per request, all num_samples * best_of in 
+    one batch of generate, and keeps the most likely candidate of every 
+    request by log likelihood / notes ** length_penalty 
+    (0: total log likelihood, 1: per note). Candidates have at least 
+    min_notes notes. tempo and beat are a class or one class per request.
+
+    Returns the sequences and lengths as generate and the log likelihoods
+    """
+    sequences, lengths, scores = generate(model, tokens2dims, device,
+                                          num_samples=num_samples * best_of,
+                                          max_len=max_len,
+                                          temperature=temperature,
+                                          top_k=top_k,
+                                          top_p=top_p,
+                                          constraints=constraints,
+                                          tempo=_per_row(tempo, num_samples, best_of),
+                                          beat=_per_row(beat, num_samples, best_of),
+                                          eos_field=eos_field,
+                                          profiler=profiler,
+                                          return_scores=True,
+                                          min_notes=min_notes)
+    eos_value = int(tokens2dims[eos_field][0]) - 1
+    ended = np.array([len(s) > 0 and s[-1, eos_field] == eos_value for s in sequences])
+    normalized = _normalized_scores(scores, lengths - ended, length_penalty)
+    best = normalized.reshape(num_samples, best_of).argmax(1) + np.arange(num_samples) * best_of
+    return [sequences[i] for i in best], lengths[best], scores[best]
+
+
+def beam_search(model,
+                tokens2dims,
+                device,
+                num_samples=1,
+                beam_width=4,
+                max_len=64,
+                constraints=None,
+                tempo=None,
+                beat=None,
+                length_penalty=1.0,
+                min_notes=1,
+                eos_field=7,
+                profiler=None):
+    """
+    beam search for likely sequences: every request keeps beam_width 
+    hypotheses, scored by their log likelihood (the sum of the per field 
+    log probabilities of their tokens). At every step the hypotheses of all 
+    requests go through one batched decode_step, the beam_width best next 
+    tokens of each are found with top_joint and the beam_width best 
+    extensions per request are kept. With constraints only well-formed 
+    tokens are considered and tempo and beat condition the search as in 
+    generate. EOS only extends hypotheses with at least min_notes notes.
+    A request is done once all its hypotheses ended with EOS 
+    (or at max_len), its best hypothesis by log likelihood / 
+    notes ** length_penalty is returned.
+
+    Returns the sequences and lengths as generate and the log likelihoods
+    """
+    if (tempo is not None or beat is not None) and constraints is None:
+        raise ValueError("conditioning on tempo or beat requires the constraints")
+    t2d = np.array(tokens2dims)
+    pred_dims = np.concatenate(([0],np.cumsum(t2d[:,0])))
+    eos_value = int(t2d[eos_field, 0]) - 1
+    eos_token = torch.as_tensor(t2d[:, 0] - 1, dtype=torch.long, device=device)
+    stage = _no_stage if profiler is None else profiler.stage
+    model.eval()
+
+    # one SOS forward, broadcast to all hypotheses
+    rows = num_samples * beam_width
+    cache = model.init_cache()
+    with torch.no_grad(), stage("forward"):
+        pred = model.decode_step(torch.as_tensor(conditioning_prefix()[None], dtype=torch.long, 
+                                                 device=device), cache)
+    first = torch.zeros(rows, dtype=torch.long, device=device)
+    cache.index_select(first)
+    pred = pred.index_select(0, first)
+    state = None
+    if constraints is not None:
+        state = constraints.initial_state(rows, _per_row(tempo, num_samples, beam_width),
+                                          _per_row(beat, num_samples, beam_width))
+
+    # only the first hypothesis of a request is alive at the start
+    scores = torch.full((num_samples, beam_width), float('-inf'), device=device)
+    scores[:, 0] = 0.0
+    scores = scores.flatten()
+    out = torch.full((rows, max_len, len(t2d)), -1, dtype=torch.long, device=device)
+    lengths = torch.zeros(rows, dtype=torch.long, device=device)
+    finished = torch.zeros(rows, dtype=torch.bool, device=device)
+    # original index of every active request
+    requests = torch.arange(num_samples, device=device)
+    best_tokens = [None] * num_samples
+    best_lengths = np.zeros(num_samples, dtype=int)
+    best_scores = np.zeros(num_samples)
+
+    def keep_best(done):
+        # the best hypothesis of the done requests
+        normalized = _normalized_scores(scores, lengths - finished.long(), length_penalty)
+        best = normalized.view(-1, beam_width).argmax(1) + torch.arange(
+            len(requests), device=device) * beam_width
+        for r in done.nonzero().squeeze(1).tolist():
+            i = int(requests[r])
+            best_lengths[i] = int(lengths[best[r]])
+            best_scores[i] = float(scores[best[r]])
+            best_tokens[i] = out[best[r], :best_lengths[i]].cpu().numpy()
+
+    with torch.no_grad():
+        for step in range(max_len):
+            if step > 0:
+                with stage("forward"):
+                    pred = model.decode_step(new_tokens, cache)
+            with stage("search"):
+                field_lp = nn.functional.log_softmax(pad_field_logits(pred[:, -1], pred_dims), dim=-1)
+                if constraints is not None:
+                    lp, tokens, onset = constraints.candidates(field_lp, state, beam_width)
+                    eos = torch.zeros_like(lp, dtype=torch.bool)
+                    eos[:, -1] = True
+                    if step < min_notes:
+                        lp[:, -1] = float('-inf')
+                else:
+                    if step < min_notes:
+                        field_lp[:, eos_field, eos_value] = float('-inf')
+                    lp, tokens = top_joint(field_lp[:, 0], field_lp[:, 1:], beam_width)
+                    eos = tokens[..., eos_field] == eos_value
+                num_candidates = lp.size(1)
+                # finished hypotheses only continue with EOS at no cost
+                keep_lp = torch.full((num_candidates,), float('-inf'), device=device)
+                keep_lp[0] = 0.0
+                lp = torch.where(finished[:, None], keep_lp, lp)
+                tokens = torch.where(finished[:, None, None], eos_token, tokens)
+                eos = eos | finished[:, None]
+
+                # the beam_width best extensions of every request
+                total = (scores[:, None] + lp).view(len(requests), beam_width * num_candidates)
+                scores, idx = total.topk(beam_width, dim=-1)
+                scores = scores.flatten()
+                parent = (torch.div(idx, num_candidates, rounding_mode="floor") 
+                          + torch.arange(len(requests), device=device)[:, None] * beam_width).flatten()
+                candidate = (idx % num_candidates).flatten()
+                new_tokens = tokens[parent, candidate].unsqueeze(1)
+                running = ~finished[parent]
+                finished = eos[parent, candidate]
+                out = out[parent]
+                out[:, step] = new_tokens[:, 0]
+                lengths = lengths[parent] + running.long()
+                cache.index_select(parent)
+                if constraints is not None:
+                    state.index_select(parent)
+                    state.fixed = torch.where((state.fixed >= 0) | finished[:, None], 
+                                              state.fixed, new_tokens[:, 0, -2:])
+                    state.onset = torch.where(finished, state.onset, onset[parent, candidate])
+                    state.finished = finished
+            if profiler is not None:
+                profiler.count(int(running.sum()))
+                profiler.step()
+
+            # requests whose hypotheses all ended (or died) are done
+            done = (finished | torch.isinf(scores)).view(-1, beam_width).all(1)
+            if step == max_len - 1:
+                done = torch.ones_like(done)
+            if bool(done.any()):
+                keep_best(done)
+                if bool(done.all()):
+                    break
+                keep = (~done).nonzero().squeeze(1)
+                rows = (keep[:, None] * beam_width 
+                        + torch.arange(beam_width, device=device)[None, :]).flatten()
+                requests = requests[keep]
+                scores, out, lengths, finished = scores[rows], out[rows], lengths[rows], finished[rows]
+                new_tokens = new_tokens[rows]
+                cache.index_select(rows)
+                if constraints is not None:
+                    state.index_select(rows)
+
+    if profiler is not None:
+        profiler.count(samples=num_samples)
+    return best_tokens, best_lengths, best_scores
+
+
+def generate_bars(model,
+                  tokens2dims,
+                  device,
+                  num_bars=None,
+                  context_bars=2,
+                  max_bar_len=64,
+                  min_notes=1,
+                  temperature=1.0,
+                  top_k=None,
+                  top_p=None,
+                  constraints=None,
+                  tempo=None,
+                  beat=None):
+    """
+    generator for long drum tracks, yields the note tokens (length, 11) 
+    of one bar after the other (num_bars, or endlessly if None).
+
+    Every bar is sampled after re-encoding a sliding window of the last 
+    context_bars bars, each as SOS, notes, EOS, followed by the SOS of 
+    the new bar. The window is prefilled in one decode_step and the bar 
+    is sampled with the KV cache, so memory and time per bar are bounded 
+    by the window, not by the length of the track. A bar ends with EOS 
+    only after min_notes notes. With constraints, the tempo and beat type 
+    of the first bar are kept for the whole track.
+    """
+    t2d = np.array(tokens2dims)
+    pred_dims = np.concatenate(([0],np.cumsum(t2d[:,0])))
+    eos_value = int(t2d[7, 0]) - 1
+    model.eval()
+
+    context = collections.deque(maxlen=context_bars)
+    bar_idx = 0
+    while num_bars is None or bar_idx < num_bars:
+        window = torch.LongTensor(conditioning_prefix(list(context))[None]).to(device)
+
+        cache = model.init_cache()
+        state = None
+        if constraints is not None:
+            state = constraints.initial_state(1, tempo, beat)
+        with torch.no_grad():
+            pred = model.decode_step(window, cache)
+        sequences, _ = _decode_loop(model, pred[:, -1:], cache, max_bar_len, pred_dims, 7, eos_value,
+                                    temperature, top_k, top_p, constraints, state,
+                                    min_notes=min_notes)
+        tokens = sequences[0]
+        if len(tokens) and tokens[-1, 7] == eos_value:
+            tokens = tokens[:-1]
+
+        bar = tokens.astype(np.int64).reshape(-1, len(t2d))
+        if constraints is not None and bar_idx == 0 and len(bar):
+            # keep the tempo and beat type of the first bar
+            tempo, beat = int(state.fixed[0, 0]), int(state.fixed[0, 1])
+        context.append(bar)
+        bar_idx += 1
+        yield bar
@@ -0,0 +1,494 @@
+#!/usr/bin/env python
+"""
+Groove MIDI dataset access without globbing and parsing file names:
+a catalog of groove/info.csv with indexed queries, lazy handles to
+the matching files and a MIDI reader that builds the note arrays
+without partitura.
+
+    catalog = GrooveCatalog("./groove-v1.0.0-midionly")
+    files = catalog.select(style="funk", bpm=(90, 130), split="train",
+                           time_signature="4-4", min_duration=10)
+    seqs = load_sequences(files)
+
+The token sequences of the files are cached on disk per tokenizer
+configuration, only new or changed files are tokenized again:
+
+    data = TokenCache("./token_cache", tokenizer_config(minimal_notes=20)).load(files)
+    train_dataloader = batch_data(data, batch_size=128)
+"""
+
+import csv
+import hashlib
+import json
+import os
+
+import numpy as np
+import partitura as pt
+
+from generation_helpers import (
+    TOKENIZER_CONFIG,
+    measure_segmentation,
+    sos_token,
+    tokenize
+    )
+
+
+########################################## MIDI FILES ##########################################
+
+
+# version of the note arrays midi_note_array returns, part of the token
+# cache key: increase it whenever its output changes
+NATIVE_LOADER_VERSION = 2
+
+# data bytes per channel message type (status >> 4)
+_DATA_BYTES = {0x8: 2, 0x9: 2, 0xA: 2, 0xB: 2, 0xC: 1, 0xD: 1, 0xE: 2}
+
+# fields and order of partitura's performance note arrays
+NOTE_ARRAY_FIELDS = [
+    ("onset_sec", "f4"),
+    ("duration_sec", "f4"),
+    ("onset_tick", "i4"),
+    ("duration_tick", "i4"),
+    ("pitch", "i4"),
+    ("velocity", "i4"),
+    ("track", "i4"),
+    ("channel", "i4"),
+    ("id", "U256")
+    ]
+
+
+def _read_vlq(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, pos
+
+
+def read_midi_events(fn):
+    """
+    channel and tempo events of a standard MIDI file as arrays, in one
+    pass over the bytes. Returns ppq and a dict of arrays: tick (absolute
+    per track), track, status, data1, data2 for channel messages and
+    tempo_tick, tempo (microseconds per quarter) for set tempo events.
+    """
+    with open(fn, "rb") as fh:
+        data = fh.read()
+    if data[:4] != b"MThd":
+        raise ValueError(f"{fn} is not a standard MIDI file")
+    header_length = int.from_bytes(data[4:8], "big")
+    num_tracks = int.from_bytes(data[10:12], "big")
+    ppq = int.from_bytes(data[12:14], "big")
+    if ppq & 0x8000:
+        raise ValueError(f"{fn}: SMPTE time division is not supported")
+
+    deltas, tracks, status, data1, data2 = [], [], [], [], []
+    tempo_tick, tempo = [], []
+    pos = 8 + header_length
+    for track in range(num_tracks):
+        if data[pos:pos + 4] != b"MTrk":
+            break
+        end = pos + 8 + int.from_bytes(data[pos + 4:pos + 8], "big")
+        pos += 8
+        tick = 0
+        pending = 0
+        running = 0
+        while pos < end:
+            delta, pos = _read_vlq(data, pos)
+            tick += delta
+            pending += delta
+            byte = data[pos]
+            if byte == 0xFF:
+                kind = data[pos + 1]
+                length, pos = _read_vlq(data, pos + 2)
+                if kind == 0x51:
+                    tempo_tick.append(tick)
+                    tempo.append(int.from_bytes(data[pos:pos + 3], "big"))
+                pos += length
+                continue
+            if byte in (0xF0, 0xF7):
+                length, pos = _read_vlq(data, pos + 1)
+                pos += length
+                continue
+            if byte & 0x80:
+                running = byte
+                pos += 1
+            n = _DATA_BYTES[running >> 4]
+            deltas.append(pending)
+            tracks.append(track)
+            status.append(running)
+            data1.append(data[pos])
+            data2.append(data[pos + 1] if n == 2 else 0)
+            pending = 0
+            pos += n
+        pos = end
+
+    tracks = np.array(tracks, dtype=np.int64)
+    deltas = np.array(deltas, dtype=np.int64)
+    # absolute ticks, restarting in every track
+    ticks = np.cumsum(deltas)
+    if len(ticks):
+        first = np.flatnonzero(np.diff(tracks, prepend=-1))
+        ticks -= np.repeat(ticks[first] - deltas[first], np.diff(np.append(first, len(ticks))))
+    return ppq, {
+        "tick": ticks,
+        "track": tracks,
+        "status": np.array(status, dtype=np.int64),
+        "data1": np.array(data1, dtype=np.int64),
+        "data2": np.array(data2, dtype=np.int64),
+        "tempo_tick": np.array(tempo_tick, dtype=np.int64),
+        "tempo": np.array(tempo, dtype=np.int64),
+        }
+
+
+def ticks_to_seconds(ticks, ppq, tempo_tick, tempo):
+    # piecewise linear time map of the set tempo events (120 bpm before the first)
+    order = np.argsort(tempo_tick, kind="stable")
+    seg_tick = np.concatenate(([0], tempo_tick[order]))
+    seg_tempo = np.concatenate(([500000], tempo[order]))
+    seg_sec = np.concatenate(([0.0], np.cumsum(np.diff(seg_tick) * seg_tempo[:-1] / (1e6 * ppq))))
+    k = np.searchsorted(seg_tick, ticks, side="right") - 1
+    return seg_sec[k] + (ticks - seg_tick[k]) * seg_tempo[k] / (1e6 * ppq)
+
+
+def midi_note_array(fn):
+    """
+    performance note array of a MIDI file and its ppq, equal to
+    pt.load_performance_midi(fn)[0].note_array() and .ppq, with the
+    note ons and offs paired vectorized instead of per message.
+
+    As in partitura, a note off (or note on with velocity 0) ends the
+    last note on of the same track, channel and pitch if it is still
+    sounding, other note offs are ignored and a repeated note on
+    replaces a sounding one. Only the first track with notes, controls
+    or programs is kept (the first PerformedPart), its notes are sorted
+    by onset, pitch, offset and channel and numbered in that order.
+    """
+    ppq, ev = read_midi_events(fn)
+    kind = ev["status"] >> 4
+    is_on = (kind == 0x9) & (ev["data2"] > 0)
+    is_off = (kind == 0x8) | ((kind == 0x9) & (ev["data2"] == 0))
+    idx = np.flatnonzero(is_on | is_off)
+    key = (ev["track"][idx] * 16 + (ev["status"][idx] & 0xF)) * 128 + ev["data1"][idx]
+
+    # group the note events by key, in file order within a group
+    order = idx[np.argsort(key, kind="stable")]
+    key = np.sort(key, kind="stable")
+    same = np.zeros(len(order), dtype=bool)
+    same[1:] = key[1:] == key[:-1]
+    # an off closes the note if the previous event of its group is an on
+    closes = np.zeros(len(order), dtype=bool)
+    closes[1:] = same[1:] & is_off[order[1:]] & is_on[order[:-1]]
+    off = order[closes]
+    on = order[np.flatnonzero(closes) - 1]
+
+    # the first part, as Performance[0]
+    parts = np.concatenate((ev["track"][on], ev["track"][(kind == 0xB) | (kind == 0xC)]))
+    if len(parts):
+        first_part = ev["track"][on] == parts.min()
+        on, off = on[first_part], off[first_part]
+    # partitura's note order (onset, pitch, offset, channel)
+    by_note = np.lexsort((ev["status"][on] & 0xF, ev["tick"][off], ev["data1"][on], ev["tick"][on]))
+    on, off = on[by_note], off[by_note]
+
+    na = np.zeros(len(on), dtype=NOTE_ARRAY_FIELDS)
+    onset_sec = ticks_to_seconds(ev["tick"][on], ppq, ev["tempo_tick"], ev["tempo"])
+    offset_sec = ticks_to_seconds(ev["tick"][off], ppq, ev["tempo_tick"], ev["tempo"])
+    na["onset_sec"] = onset_sec
+    na["duration_sec"] = offset_sec - onset_sec
+    na["onset_tick"] = ev["tick"][on]
+    na["duration_tick"] = ev["tick"][off] - ev["tick"][on]
+    na["pitch"] = ev["data1"][on]
+    na["velocity"] = ev["data2"][on]
+    na["track"] = ev["track"][on]
+    na["channel"] = ev["status"][on] & 0xF
+    na["id"] = [f"n{i}" for i in range(len(on))]
+    return na, ppq
+
+
+########################################## LOADING ##########################################
+
+
+def load_groove_file(fn, tempo, beat_type, min_seq_length = 10, backend = "native"):
+    """
+    one sequence dict as in the notebook's load_data, None if the
+    performance has min_seq_length notes or less. The native backend
+    reads the note array with midi_note_array, "partitura" builds the
+    partitura performance as the notebook does.
+    """
+    if backend == "native":
+        na, ppq = midi_note_array(fn)
+    elif backend == "partitura":
+        seq = pt.load_performance_midi(fn)[0]
+        na, ppq = seq.note_array(), seq.ppq
+    else:
+        raise ValueError(f"unknown backend {backend!r}")
+    if len(na) <= min_seq_length:
+        return None
+    namax = (na['onset_tick'] + na['duration_tick']).max()
+    namin = (na['onset_tick']).min()
+    return {
+        "id": os.path.basename(fn),
+        "na": na,
+        "ppq": ppq,
+        "tempo": tempo,
+        "beat_type": beat_type,
+        "namax": namax,
+        "namin": namin,
+        "dur_in_q": (namax - namin)/ppq
+    }
+
+
+def load_sequences(files, min_seq_length = 10, backend = "native"):
+    # parses the files (GrooveFile handles), skipping too short performances
+    sequences = []
+    for f in files:
+        seq = f.load(min_seq_length, backend)
+        if seq is not None:
+            sequences.append(seq)
+    return sequences
+
+
+########################################## CATALOG ##########################################
+
+
+class GrooveFile(object):
+    """
+    lazy handle to one performance of the catalog, nothing is parsed
+    before load
+    """
+    def __init__(self, path, **meta):
+        self.path = path
+        self.meta = meta
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__["meta"][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __repr__(self):
+        return f"GrooveFile({self.meta['midi_filename']!r})"
+
+    def load(self, min_seq_length = 10, backend = "native"):
+        return load_groove_file(self.path, self.meta["bpm"], self.meta["beat_type"],
+                                min_seq_length, backend)
+
+
+class GrooveCatalog(object):
+    """
+    the rows of groove/info.csv as columns (numpy arrays), sorted by
+    file name as the notebook's load_data. Categorical columns get an
+    index (value to sorted row numbers), bpm and duration a sorted
+    order for range queries, so a query never scans the table.
+    """
+    CATEGORICAL = ("drummer", "session", "style", "genre", "beat_type",
+                   "time_signature", "split")
+    NUMERIC = ("bpm", "duration")
+
+    def __init__(self, directory = "./groove-v1.0.0-midionly"):
+        self.directory = directory
+        self.root = os.path.join(directory, "groove")
+        with open(os.path.join(self.root, "info.csv"), newline="") as fh:
+            rows = sorted(csv.DictReader(fh), key=lambda r: r["midi_filename"])
+
+        self.columns = {name: np.array([r[name] for r in rows]) for name in rows[0]}
+        self.columns["bpm"] = self.columns["bpm"].astype(int)
+        self.columns["duration"] = self.columns["duration"].astype(float)
+        # main style without the sub style, e.g. "funk" of "funk/groove1"
+        self.columns["genre"] = np.array([s.split("/")[0] for s in self.columns["style"]])
+
+        self.index = {}
+        for name in self.CATEGORICAL:
+            values, inverse = np.unique(self.columns[name], return_inverse=True)
+            order = np.argsort(inverse, kind="stable")
+            bounds = np.searchsorted(inverse[order], np.arange(len(values) + 1))
+            self.index[name] = {v: order[bounds[i]:bounds[i + 1]] for i, v in enumerate(values)}
+        self.sorted = {}
+        for name in self.NUMERIC:
+            order = np.argsort(self.columns[name], kind="stable")
+            self.sorted[name] = (self.columns[name][order], order)
+
+    def __len__(self):
+        return len(self.columns["midi_filename"])
+
+    def _lookup(self, name, value):
+        # rows of one or several values of a categorical column
+        index = self.index[name]
+        if isinstance(value, str):
+            value = [value]
+        rows = [index[v] for v in value if v in index]
+        return np.sort(np.concatenate(rows)) if rows else np.zeros(0, dtype=int)
+
+    def _range(self, name, low = None, high = None):
+        # rows with low <= value <= high
+        values, order = self.sorted[name]
+        a = 0 if low is None else np.searchsorted(values, low, side="left")
+        b = len(values) if high is None else np.searchsorted(values, high, side="right")
+        return np.sort(order[a:b])
+
+    def query(self, style = None, bpm = None, split = None, drummer = None,
+              beat_type = None, time_signature = None, min_duration = None,
+              session = None):
+        """
+        row numbers matching all given filters, each categorical filter
+        is a value or a list of values. style matches the main style
+        ("funk") or the full style ("funk/groove1"), bpm is a (low, high)
+        range (inclusive) and min_duration in seconds.
+        """
+        selections = []
+        if style is not None:
+            styles = [style] if isinstance(style, str) else list(style)
+            selections.append(np.union1d(self._lookup("genre", styles),
+                                         self._lookup("style", styles)))
+        for name, value in (("split", split), ("drummer", drummer), ("session", session),
+                            ("beat_type", beat_type), ("time_signature", time_signature)):
+            if value is not None:
+                selections.append(self._lookup(name, value))
+        if bpm is not None:
+            selections.append(self._range("bpm", *bpm))
+        if min_duration is not None:
+            selections.append(self._range("duration", min_duration))
+
+        if not selections:
+            return np.arange(len(self))
+        # smallest selection first
+        selections.sort(key=len)
+        rows = selections[0]
+        for s in selections[1:]:
+            rows = np.intersect1d(rows, s, assume_unique=True)
+        return rows
+
+    def file(self, row):
+        meta = {name: column[row].item() for name, column in self.columns.items()}
+        return GrooveFile(os.path.join(self.root, meta["midi_filename"]), **meta)
+
+    def select(self, **filters):
+        """
+        GrooveFile handles of the rows matching the filters of query
+        """
+        return [self.file(row) for row in self.query(**filters)]
+
+    def load(self, min_seq_length = 10, backend = "native", **filters):
+        """
+        the notebook's load_data restricted to the rows matching the
+        filters, e.g. load(time_signature = "4-4", beat_type = "beat")
+        """
+        return load_sequences(self.select(**filters), min_seq_length, backend)
+
+
+########################################## TOKENIZATION CACHE ##########################################
+
+
+def _hash(text):
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+def config_hash(config):
+    return _hash(json.dumps(config, sort_keys=True))
+
+def loader_version(backend = "native"):
+    # what the note arrays of a backend depend on
+    if backend == "native":
+        return f"native-{NATIVE_LOADER_VERSION}"
+    if backend == "partitura":
+        return f"partitura-{pt.__version__}"
+    raise ValueError(f"unknown backend {backend!r}")
+
+def _save_npy(fn, array):
+    # atomic, a crashed run leaves no half written array behind
+    with open(fn + ".tmp", "wb") as fh:
+        np.save(fh, array)
+    os.replace(fn + ".tmp", fn)
+
+
+def tokenize_groove_file(f, config = TOKENIZER_CONFIG, backend = "native"):
+    """
+    the token sequences (SOS, notes, EOS) of the bars of one GrooveFile,
+    as generate_tokenized_data with tokenize and measure_segmentation
+    """
+    seq = f.load(config["min_seq_length"], backend)
+    if seq is None:
+        return []
+    sos = sos_token(config)
+    return [np.concatenate((sos, tokenize(s, config), sos + 1))
+            for s in measure_segmentation(seq, config["beats"], 
+                                          minimal_notes = config["minimal_notes"])]
+
+
+class TokenCache(object):
+    """
+    token sequences of sets of Groove files, cached in a directory per
+    tokenizer configuration and loader (config_hash of both): every file is tokenized once
+    into its own shard, keyed on its name, size and modification time,
+    and every file set is concatenated once into a tokens array that is
+    memory mapped on later loads.
+    """
+    def __init__(self, cache_dir = "./token_cache", config = TOKENIZER_CONFIG,
+                 backend = "native"):
+        self.config = config
+        self.backend = backend
+        key = {"tokenizer": config, "loader": loader_version(backend)}
+        self.dir = os.path.join(cache_dir, config_hash(key))
+        os.makedirs(os.path.join(self.dir, "files"), exist_ok=True)
+        with open(os.path.join(self.dir, "config.json"), "w") as fh:
+            json.dump(key, fh, indent=1, sort_keys=True)
+        # number of files tokenized by this object
+        self.num_tokenized = 0
+
+    def file_key(self, f):
+        st = os.stat(f.path)
+        return _hash(f"{f.midi_filename}:{st.st_size}:{st.st_mtime_ns}")
+
+    def file_tokens(self, f, key = None):
+        """
+        concatenated token sequences and their lengths of one file
+        """
+        base = os.path.join(self.dir, "files", key or self.file_key(f))
+        if os.path.exists(base + ".lengths.npy"):
+            return np.load(base + ".tokens.npy"), np.load(base + ".lengths.npy")
+        seqs = tokenize_groove_file(f, self.config, self.backend)
+        width = sos_token(self.config).shape[1]
+        tokens = np.concatenate(seqs).astype(np.int16) if seqs else np.zeros((0, width), np.int16)
+        lengths = np.array([len(s) for s in seqs], dtype=np.int64)
+        # lengths last, they mark a complete shard
+        _save_npy(base + ".tokens.npy", tokens)
+        _save_npy(base + ".lengths.npy", lengths)
+        self.num_tokenized += 1
+        return tokens, lengths
+
+    def load(self, files):
+        """
+        token sequences of the files (GrooveFile handles) as views of a
+        memory mapped array, a list like generate_tokenized_data's
+        """
+        keys = [self.file_key(f) for f in files]
+        base = os.path.join(self.dir, _hash("\n".join(keys)))
+        if not os.path.exists(base + ".lengths.npy"):
+            shards = [self.file_tokens(f, key) for f, key in zip(files, keys)]
+            width = sos_token(self.config).shape[1]
+            _save_npy(base + ".tokens.npy",
+                      np.concatenate([np.zeros((0, width), np.int16)] + [t for t, _ in shards]))
+            _save_npy(base + ".lengths.npy",
+                      np.concatenate([np.zeros(0, np.int64)] + [l for _, l in shards]))
+        tokens = np.load(base + ".tokens.npy", mmap_mode="r")
+        offsets = np.concatenate(([0], np.cumsum(np.load(base + ".lengths.npy"))))
+        return [tokens[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+
+
+def style_prompts(catalog, styles, cache = None, split = "train", min_notes = 8, seed = 0):
+    """
+    one tokenized bar (notes, 11) without SOS and EOS per style, picked at
+    random from the 4-4 bars of that style, as prompts for generate_conditioned
+    """
+    cache = cache if cache is not None else TokenCache()
+    rng = np.random.default_rng(seed)
+    prompts = {}
+    for style in styles:
+        files = catalog.select(style=style, split=split, time_signature="4-4")
+        bars = [bar for bar in cache.load(files) if len(bar) - 2 >= min_notes]
+        if not bars:
+            raise ValueError(f"no bars of style {style!r} with {min_notes} notes")
+        prompts[style] = np.array(bars[rng.integers(len(bars))][1:-1], dtype=np.int64)
+    return prompts
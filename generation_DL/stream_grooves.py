@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+"""
+Streams an endless drum groove to a MIDI port in real time, e.g. to
+the USB MIDI input of one of the synchronization players.
+
+The next bar is generated by the drum Transformer while the current
+bar plays (double buffering), so the generation latency is hidden as
+long as one bar is generated faster than it plays. A deadline monitor
+reports every bar that was not ready at its start time.
+
+Run from this folder, e.g.:
+
+    python stream_grooves.py Drum_Transformer_Checkpoint_0.pt --port "CircuitPython" --bpm 100
+    python stream_grooves.py Drum_Transformer_Checkpoint_0.pt --bars 8   # virtual port
+
+mido (with python-rtmidi) is only needed for real ports.
+"""
+
+import argparse
+import collections
+import heapq
+import queue
+import threading
+import time
+
+import numpy as np
+import torch
+
+from generation_helpers import (
+    FusedMultiEmbedding,
+    TokenConstraints,
+    decode_tokens,
+    generate_bars,
+    load_model,
+    note_events,
+    tempo_encoder
+    )
+
+
+# MIDI real time messages
+CLOCK = 0xF8
+START = 0xFA
+STOP = 0xFC
+# clock pulses per quarter, as STEPS_PER_QUARTER in the players
+CLOCKS_PER_QUARTER = 24
+
+
+########################################## PORTS ##########################################
+
+
+class MidiPort(object):
+    """
+    output port interface, messages are tuples of MIDI bytes
+    """
+    def send(self, message):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class VirtualPort(MidiPort):
+    """
+    local stub port, records (time, message) of every sent message
+    """
+    def __init__(self, clock = time.perf_counter):
+        self.clock = clock
+        self.messages = []
+
+    def send(self, message):
+        self.messages.append((self.clock(), tuple(message)))
+
+    def notes(self):
+        # (time, note, velocity) of the note ons
+        return [(t, m[1], m[2]) for t, m in self.messages
+                if m[0] & 0xF0 == 0x90 and m[2] > 0]
+
+
+class MidoPort(MidiPort):
+    """
+    hardware or OS port opened with mido, by (part of) its name
+    """
+    def __init__(self, name = None):
+        try:
+            import mido
+        except ImportError:
+            raise ImportError("real MIDI ports require mido and python-rtmidi")
+        self.mido = mido
+        if name is not None:
+            matches = [n for n in mido.get_output_names() if name in n]
+            if not matches:
+                raise ValueError(f"no MIDI output matching {name!r}, "
+                                 f"available: {mido.get_output_names()}")
+            name = matches[0]
+        self.port = mido.open_output(name)
+
+    def send(self, message):
+        self.port.send(self.mido.Message.from_bytes(list(message)))
+
+    def close(self):
+        self.port.close()
+
+
+########################################## SCHEDULING ##########################################
+
+
+def bar_events(bar, bpm, beats_per_bar = 4, duration = 0.25, channel = 9, clock = False):
+    """
+    (seconds from the start of the bar, message) of the notes of one bar
+    of generated tokens (n, 11), note offs may reach into the next bar.
+    With clock, the 24 per quarter MIDI clock pulses of the bar are added.
+    """
+    sec_per_quarter = 60 / bpm
+    onset, pitch, velocity, valid = decode_tokens(np.asarray(bar).reshape(1, -1, 11))
+    ticks, status, notes, velocities = note_events(onset[0][valid[0]], pitch[0][valid[0]],
+                                                   velocity[0][valid[0]], duration,
+                                                   ppq=480, channel=channel)
+    times = ticks * sec_per_quarter / 480
+    events = [(float(t), (int(s), int(n), int(v)))
+              for t, s, n, v in zip(times, status, notes, velocities)]
+    if clock:
+        pulses = np.arange(beats_per_bar * CLOCKS_PER_QUARTER) * sec_per_quarter / CLOCKS_PER_QUARTER
+        # pulses before notes at the same time
+        events = [(float(t), (CLOCK,)) for t in pulses] + events
+        events.sort(key=lambda e: e[0])
+    return events
+
+
+class DeadlineMonitor(object):
+    """
+    records how late every bar was ready relative to its start time,
+    bars later than tolerance seconds count as missed
+    """
+    def __init__(self, tolerance = 0.002):
+        self.tolerance = tolerance
+        self.lateness = []
+        self.missed = []
+
+    def record(self, bar_idx, deadline, ready):
+        late = ready - deadline
+        self.lateness.append(late)
+        if late > self.tolerance:
+            self.missed.append((bar_idx, late))
+        return late
+
+    def report(self):
+        if not self.lateness:
+            return "no bars played"
+        lines = [f"{len(self.lateness)} bars, {len(self.missed)} missed their start time"]
+        for bar_idx, late in self.missed:
+            lines.append(f"  bar {bar_idx}: {late * 1e3:.1f} ms late")
+        return "\n".join(lines)
+
+
+class GrooveStreamer(object):
+    """
+    plays bars from a bar iterator (e.g. generate_bars) on a port,
+    with a producer thread generating up to buffers bars ahead of
+    the playing one. A late bar stays on the original grid: its notes
+    that are already past are dropped (note on and note off), its clock
+    pulses are sent at once (as the players catch up on missed pulses).
+    """
+    def __init__(self, bars, port, bpm, beats_per_bar = 4, buffers = 1,
+                 duration = 0.25, channel = 9, clock = False, monitor = None):
+        self.bars = bars
+        self.port = port
+        self.bpm = bpm
+        self.bar_seconds = beats_per_bar * 60 / bpm
+        self.beats_per_bar = beats_per_bar
+        self.duration = duration
+        self.channel = channel
+        self.clock = clock
+        self.monitor = monitor if monitor is not None else DeadlineMonitor()
+        self.queue = queue.Queue(maxsize=buffers)
+        self.stopping = threading.Event()
+        self.error = None
+
+    def _produce(self):
+        try:
+            for bar in self.bars:
+                events = bar_events(bar, self.bpm, self.beats_per_bar,
+                                    self.duration, self.channel, self.clock)
+                while not self.stopping.is_set():
+                    try:
+                        self.queue.put(events, timeout=0.05)
+                        break
+                    except queue.Full:
+                        pass
+                if self.stopping.is_set():
+                    return
+        except Exception as e:
+            self.error = e
+        self.queue.put(None)
+
+    def _next_bar(self):
+        events = self.queue.get()
+        if events is None and self.error is not None:
+            raise self.error
+        return events
+
+    def _play_until(self, pending, end):
+        # sends the pending events due before end, sleeps in between
+        while True:
+            next_time = pending[0][0] if pending else end
+            now = time.perf_counter()
+            if next_time >= end and now >= end:
+                return
+            if next_time > now:
+                time.sleep(min(next_time, end) - now)
+                continue
+            _, _, message = heapq.heappop(pending)
+            self.port.send(message)
+
+    def run(self, num_bars = None, lead_time = 0.1):
+        """
+        plays num_bars bars (or until the bar iterator ends), the first
+        bar starts lead_time seconds after it is generated
+        """
+        producer = threading.Thread(target=self._produce, daemon=True)
+        producer.start()
+        pending = []
+        counter = 0
+        try:
+            # the first bar primes the buffer and has no deadline
+            events = self._next_bar()
+            start = time.perf_counter() + lead_time
+            if self.clock:
+                heapq.heappush(pending, (start, -1, (START,)))
+            bar_idx = 0
+            ready = start
+            while events is not None:
+                bar_start = start + bar_idx * self.bar_seconds
+                # (channel, note) of dropped note ons, whose note offs are dropped too
+                dropped = collections.Counter()
+                for t, message in events:
+                    kind = message[0] & 0xF0
+                    if kind in (0x80, 0x90):
+                        key = (message[0] & 0x0F, message[1])
+                        if kind == 0x90 and bar_start + t < ready - self.monitor.tolerance:
+                            dropped[key] += 1
+                            continue
+                        if kind == 0x80 and dropped[key] > 0:
+                            dropped[key] -= 1
+                            continue
+                    heapq.heappush(pending, (bar_start + t, counter, message))
+                    counter += 1
+                bar_idx += 1
+                if num_bars is not None and bar_idx >= num_bars:
+                    break
+                self._play_until(pending, start + bar_idx * self.bar_seconds)
+                events = self._next_bar()
+                ready = time.perf_counter()
+                if events is not None:
+                    self.monitor.record(bar_idx, start + bar_idx * self.bar_seconds, ready)
+            # to the end of the last bar and its last note off
+            end = start + bar_idx * self.bar_seconds
+            self._play_until(pending, max([end] + [t + 1e-3 for t, _, _ in pending]))
+            if self.clock:
+                self.port.send((STOP,))
+        finally:
+            # no hanging notes if interrupted
+            for _, _, message in sorted(pending):
+                if message[0] & 0xF0 == 0x80:
+                    self.port.send(message)
+            self.stopping.set()
+            # unblock the producer
+            while producer.is_alive():
+                try:
+                    self.queue.get(timeout=0.05)
+                except queue.Empty:
+                    pass
+        return self.monitor
+
+
+def main():
+    parser = argparse.ArgumentParser(description="stream generated drum bars to a MIDI port")
+    parser.add_argument("checkpoint", help="checkpoint or exported .safetensors model")
+    parser.add_argument("--port", default=None,
+                        help="name of the MIDI output (substring), virtual port if not given")
+    parser.add_argument("--list-ports", action="store_true")
+    parser.add_argument("--bars", type=int, default=None, help="play endlessly if not given")
+    parser.add_argument("--bpm", type=float, default=100.0)
+    parser.add_argument("--beat-type", choices=["beat", "fill"], default="beat")
+    parser.add_argument("--context-bars", type=int, default=2)
+    parser.add_argument("--max-bar-len", type=int, default=64)
+    parser.add_argument("--buffers", type=int, default=1,
+                        help="bars generated ahead of the playing bar")
+    parser.add_argument("--clock", action="store_true",
+                        help="also send MIDI start, clock and stop messages")
+    parser.add_argument("--channel", type=int, default=9)
+    parser.add_argument("--tolerance", type=float, default=2.0,
+                        help="lateness in ms before a bar counts as missed")
+    parser.add_argument("--temperature", type=float, default=1.0)
+    parser.add_argument("--top-k", type=int, default=None)
+    parser.add_argument("--top-p", type=float, default=None)
+    parser.add_argument("--threads", type=int, default=None,
+                        help="number of torch intra-op threads")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.list_ports:
+        import mido
+        print("\n".join(mido.get_output_names()))
+        return
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    if args.seed is not None:
+        torch.manual_seed(args.seed)
+
+    model = load_model(args.checkpoint, args.device, FusedMultiEmbedding)
+    constraints = TokenConstraints(model.tokens2dims, device=args.device)
+    bars = generate_bars(model, model.tokens2dims, args.device,
+                         num_bars=args.bars,
+                         context_bars=args.context_bars,
+                         max_bar_len=args.max_bar_len,
+                         temperature=args.temperature,
+                         top_k=args.top_k,
+                         top_p=args.top_p,
+                         constraints=constraints,
+                         tempo=int(tempo_encoder(args.bpm)),
+                         beat=int(args.beat_type == "fill"))
+
+    port = VirtualPort() if args.port is None else MidoPort(args.port)
+    monitor = DeadlineMonitor(args.tolerance / 1000)
+    streamer = GrooveStreamer(bars, port, args.bpm, buffers=args.buffers,
+                              channel=args.channel, clock=args.clock, monitor=monitor)
+    with port:
+        try:
+            streamer.run(args.bars)
+        except KeyboardInterrupt:
+            port.send((STOP,))
+    print(monitor.report())
+    if isinstance(port, VirtualPort):
+        print(f"virtual port received {len(port.notes())} notes")
+
+
+if __name__ == "__main__":
+    main()
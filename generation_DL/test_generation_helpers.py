@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+import torch
+
+from generation_helpers import (
+    TOKENS2DIMS,
+    FusedMultiEmbedding,
+    Transformer,
+    generate,
+    generate_bars,
+    generate_best_of,
+    )
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    return Transformer(TOKENS2DIMS, FusedMultiEmbedding, 6, 2, 0.1).eval()
+
+
+@pytest.fixture
+def eager_eos_model():
+    # untrained model that (almost) always predicts EOS in the pitch field
+    torch.manual_seed(0)
+    model = Transformer(TOKENS2DIMS, FusedMultiEmbedding, 6, 2, 0.1).eval()
+    t2d = np.array(TOKENS2DIMS)
+    pred_dims = np.concatenate(([0], np.cumsum(t2d[:, 0])))
+    with torch.no_grad():
+        model.out.bias[int(pred_dims[7]) + int(t2d[7, 0]) - 1] = 100.0
+    return model
+
+
+def test_generate_bars_unconstrained_min_notes(eager_eos_model):
+    bars = list(generate_bars(eager_eos_model, TOKENS2DIMS, "cpu", num_bars=4,
+                              max_bar_len=8, constraints=None, min_notes=1))
+    assert len(bars) == 4
+    assert all(len(bar) >= 1 for bar in bars)
+
+
+@pytest.mark.parametrize("sampler", [generate, generate_best_of])
+@pytest.mark.parametrize("conditioning", [{"tempo": 3}, {"beat": 1}])
+def test_conditioning_requires_constraints(model, sampler, conditioning):
+    with pytest.raises(ValueError, match="requires the constraints"):
+        sampler(model, TOKENS2DIMS, "cpu", num_samples=2, max_len=4, **conditioning)
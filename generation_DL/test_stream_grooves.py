@@ -0,0 +1,32 @@
+import time
+
+import numpy as np
+
+from stream_grooves import DeadlineMonitor, GrooveStreamer, VirtualPort
+
+
+def sixteenths_bar(pitch = 1):
+    # tokens (16, 11) of a bar of sixteenth notes
+    bar = np.zeros((16, 11), dtype=int)
+    for k in range(16):
+        bar[k, :4] = [(k >> 3) & 1, (k >> 2) & 1, (k >> 1) & 1, k & 1]
+    bar[:, 7:10] = [pitch, 4, 3]
+    return bar
+
+
+def test_late_bar_drops_note_pairs():
+    # at 480 bpm a bar takes 0.5 s, the second bar is ready about 0.2 s late
+    def bars():
+        yield sixteenths_bar()
+        time.sleep(0.8)
+        yield sixteenths_bar()
+        yield sixteenths_bar()
+
+    port = VirtualPort()
+    # generous tolerance, only the second bar is late
+    monitor = GrooveStreamer(bars(), port, bpm=480, monitor=DeadlineMonitor(0.05)).run(3)
+    note_ons = [m for _, m in port.messages if m[0] & 0xF0 == 0x90]
+    note_offs = [m for _, m in port.messages if m[0] & 0xF0 == 0x80]
+    assert [bar_idx for bar_idx, _ in monitor.missed] == [1]
+    assert len(note_ons) < 3 * 16
+    assert len(note_ons) == len(note_offs)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+Data parallel training of the drum Transformer on a CPU node, with one
+process per rank (gloo backend).
+
+Run from this folder with torchrun, e.g. for 4 local processes:
+
+    torchrun --standalone --nproc_per_node 4 train_ddp.py dataset129.pyc \
+        --epochs 50 --threads-per-rank 4
+"""
+
+import argparse
+import os
+import pickle
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+from generation_helpers import (
+    TOKENS2DIMS,
+    batches_to_tensors,
+    save_checkpoint,
+    train_loop
+    )
+from train_drums import build_training
+
+
+def setup(rank=None, world_size=None, init_method=None):
+    # rank and world size from the torchrun environment unless given
+    if rank is None:
+        rank = int(os.environ["RANK"])
+        world_size = int(os.environ["WORLD_SIZE"])
+    dist.init_process_group("gloo", init_method=init_method, rank=rank, world_size=world_size)
+    return rank, world_size
+
+
+def shard_batches(batches, rank, world_size, epoch, seed=0):
+    """
+    the batches of this rank for an epoch: all ranks shuffle with the
+    same seed, drop the remainder and take every world_size-th batch,
+    so every rank runs the same number of steps
+    """
+    order = np.random.default_rng(seed + epoch).permutation(len(batches))
+    order = order[:len(order) - len(order) % world_size]
+    return [batches[i] for i in order[rank::world_size]]
+
+
+def train(rank, world_size, batches, model_spec, epochs, lr=0.002, accum_steps=1,
+          autocast_dtype=None, threads=None, seed=0, out=None, log=True):
+    """
+    trains on this rank's shards, returns the samples/s over all ranks
+    """
+    if threads is not None:
+        torch.set_num_threads(threads)
+    # same initial weights everywhere (DDP broadcasts rank 0 anyway),
+    # different dropout per rank
+    torch.manual_seed(seed)
+    model, opt, _ = build_training(model_spec, "cpu", lr)
+    ddp_model = DistributedDataParallel(model)
+    torch.manual_seed(seed + rank)
+    np.random.seed(seed + rank)
+
+    num_samples = 0
+    start = time.perf_counter()
+    for epoch in range(epochs):
+        shard = shard_batches(batches, rank, world_size, epoch, seed)
+        train_loss, _ = train_loop(ddp_model, opt, shard, model_spec["tokens2dims"],
+                                   "cpu", accum_steps, autocast_dtype)
+        num_samples += sum(len(batch) for batch in shard)
+
+        # mean loss over all ranks
+        loss = torch.tensor([train_loss])
+        dist.all_reduce(loss)
+        if log and rank == 0:
+            print(f"Epoch {epoch + 1}: training loss {loss.item() / world_size:.4f}")
+
+        if out is not None and rank == 0:
+            save_checkpoint(out, model, opt, model_spec, epoch + 1, 
+                            loss=loss.item() / world_size)
+    elapsed = time.perf_counter() - start
+
+    throughput = torch.tensor([num_samples / elapsed])
+    dist.all_reduce(throughput)
+    return throughput.item()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="data parallel training (launch with torchrun)")
+    parser.add_argument("data", help="pickled list of token batches (batch, sequence, 11)")
+    parser.add_argument("--out", default="Drum_Transformer_Checkpoint_0.pt")
+    parser.add_argument("--epochs", type=int, default=50)
+    parser.add_argument("--lr", type=float, default=0.002)
+    parser.add_argument("--num-heads", type=int, default=6)
+    parser.add_argument("--num-decoder-layers", type=int, default=6)
+    parser.add_argument("--dropout", type=float, default=0.1)
+    parser.add_argument("--bf16", action="store_true", help="bfloat16 autocast")
+    parser.add_argument("--accum-steps", type=int, default=1)
+    parser.add_argument("--threads-per-rank", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rank, world_size = setup()
+    with open(args.data, "rb") as fh:
+        batches = batches_to_tensors(pickle.load(fh), "cpu")
+
+    model_spec = dict(
+        tokens2dims=TOKENS2DIMS,
+        num_heads=args.num_heads,
+        num_decoder_layers=args.num_decoder_layers,
+        dropout_p=args.dropout
+    )
+    throughput = train(rank, world_size, batches, model_spec, args.epochs, args.lr,
+                       args.accum_steps, torch.bfloat16 if args.bf16 else None,
+                       args.threads_per_rank, args.seed, args.out)
+    if rank == 0:
+        print(f"{world_size} ranks: {throughput:.1f} samples/s")
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+"""
+Trains the drum Transformer on a preprocessed training set
+(the pickled list of batches saved in the notebook).
+
+Run from this folder, e.g.:
+
+    python train_drums.py dataset129.pyc --epochs 50 --bf16 --compile --accum-steps 4
+
+With --checkpoint-every N the run is checkpointed every N optimizer steps
+and can be continued with --resume. --export writes an inference only
+.safetensors file for generate_grooves.py.
+
+--profile prints the time per stage (data, forward, loss, backward, step),
+tokens/s and peak memory after every epoch, e.g.:
+
+    python train_drums.py dataset129.pyc --epochs 1 --profile --profile-modules \
+        --profile-log profile.jsonl --trace train_trace.json --trace-steps 5
+"""
+
+import argparse
+import contextlib
+import pickle
+import time
+
+import numpy as np
+import torch
+
+from generation_helpers import (
+    INV_PITCH_DICT_SIMPLE,
+    TOKENIZER_CONFIG,
+    TOKENS2DIMS,
+    FusedMultiEmbedding,
+    StageProfiler,
+    Transformer,
+    batches_to_tensors,
+    export_inference,
+    load_checkpoint,
+    save_checkpoint,
+    train_loop
+    )
+
+
+def build_training(model_spec, device, lr=0.002, compile_model=False):
+    """
+    model, optimizer and the (optionally compiled) forward function
+    """
+    model = Transformer(
+        tokens2dims = model_spec["tokens2dims"],
+        MultiEmbedding = FusedMultiEmbedding,
+        num_heads = model_spec["num_heads"],
+        num_decoder_layers = model_spec["num_decoder_layers"],
+        dropout_p = model_spec["dropout_p"],
+    ).to(device)
+    opt = torch.optim.Adam(model.parameters(), lr=lr)
+    forward = model
+    if compile_model:
+        if not hasattr(torch, "compile"):
+            raise RuntimeError("torch.compile requires PyTorch 2.0 or newer")
+        forward = torch.compile(model)
+    return model, opt, forward
+
+
+# field names for the loss log
+FIELD_NAMES = ["t2", "t4", "t8", "t16", "t32", "t64", "t128", "pitch", "vel", "tempo", "beat"]
+
+
+def fit(model, opt, train_dataloader, model_spec, epochs, device="cpu",
+        accum_steps=1, autocast_dtype=None, forward=None, field_weights=None,
+        checkpoint_path=None, checkpoint_every=None, resume=None,
+        profiler=None, profile_log=None):
+    """
+    trains for epochs, optionally checkpointing every checkpoint_every
+    optimizer steps to checkpoint_path and resuming from the checkpoint
+    dict resume (see load_checkpoint). With a StageProfiler its report
+    is printed (and appended to profile_log) after every epoch
+    """
+    train_loss_list = []
+    first_epoch, start_batch, step = 0, 0, 0
+    if resume is not None:
+        train_loss_list = resume.get("train_loss_list") or []
+        first_epoch, start_batch, step = resume["epoch"], resume["batch"], resume["step"]
+        if start_batch >= len(train_dataloader):
+            first_epoch, start_batch = first_epoch + 1, 0
+    progress = {"epoch": first_epoch, "step": step}
+
+    def on_step(batch):
+        progress["step"] += 1
+        if checkpoint_every and progress["step"] % checkpoint_every == 0:
+            save_checkpoint(checkpoint_path, model, opt, model_spec, progress["epoch"], 
+                            batch, progress["step"], train_loss_list=train_loss_list)
+
+    print("Training model")
+    for epoch in range(first_epoch, epochs):
+        print("-"*25, f"Epoch {epoch + 1}","-"*25)
+        progress["epoch"] = epoch
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.reset()
+
+        train_loss, field_losses = train_loop(model, opt, train_dataloader, 
+                                              model_spec["tokens2dims"], device,
+                                              accum_steps, autocast_dtype, forward,
+                                              field_weights, start_batch, on_step, profiler)
+        train_loss_list += [train_loss]
+
+        elapsed = time.perf_counter() - start
+        num_samples = sum(len(batch) for batch in train_dataloader[start_batch:])
+        print(f"Training loss: {train_loss:.4f} ({num_samples / elapsed:.1f} samples/s)")
+        print(" ".join(f"{name}: {l:.3f}" for name, l in zip(FIELD_NAMES, field_losses)))
+        if profiler is not None:
+            print(profiler.report())
+            if profile_log is not None:
+                profiler.log(profile_log, epoch=epoch + 1, loss=train_loss)
+        print()
+        start_batch = 0
+
+        if checkpoint_every:
+            # end of epoch
+            save_checkpoint(checkpoint_path, model, opt, model_spec, epoch + 1, 0, 
+                            progress["step"], train_loss, train_loss_list)
+
+    return train_loss_list
+
+
+def main():
+    parser = argparse.ArgumentParser(description="train the drum transformer")
+    parser.add_argument("data", help="pickled list of token batches (batch, sequence, 11)")
+    parser.add_argument("--out", default="Drum_Transformer_Checkpoint_0.pt")
+    parser.add_argument("--checkpoint-every", type=int, default=None,
+                        help="checkpoint to --out every N optimizer steps")
+    parser.add_argument("--resume", default=None, help="checkpoint to continue from")
+    parser.add_argument("--export", default=None,
+                        help="also write an inference only .safetensors file")
+    parser.add_argument("--epochs", type=int, default=50)
+    parser.add_argument("--lr", type=float, default=0.002)
+    parser.add_argument("--num-heads", type=int, default=6)
+    parser.add_argument("--num-decoder-layers", type=int, default=6)
+    parser.add_argument("--dropout", type=float, default=0.1)
+    parser.add_argument("--bf16", action="store_true", help="bfloat16 autocast")
+    parser.add_argument("--compile", action="store_true", help="torch.compile the model")
+    parser.add_argument("--accum-steps", type=int, default=1,
+                        help="batches per optimizer step")
+    parser.add_argument("--field-weights", type=float, nargs=11, default=None,
+                        help="loss weight of each of the 11 token fields")
+    parser.add_argument("--pin-memory", action="store_true",
+                        help="keep batches in pinned host memory (cuda only)")
+    parser.add_argument("--profile", action="store_true",
+                        help="time the training stages and report them after every epoch")
+    parser.add_argument("--profile-modules", action="store_true",
+                        help="also time embedding, mask, attention, feed forward and output "
+                             "(without --compile)")
+    parser.add_argument("--profile-log", default=None,
+                        help="append the profile of every epoch as a JSON line to this file")
+    parser.add_argument("--trace", default=None,
+                        help="record with torch.profiler and write a Chrome trace to this file")
+    parser.add_argument("--trace-steps", type=int, default=None,
+                        help="only trace this many optimizer steps")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="number of torch intra-op threads")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+
+    with open(args.data, "rb") as fh:
+        batches = pickle.load(fh)
+    train_dataloader = batches_to_tensors(batches, args.device, args.pin_memory)
+
+    model_spec = dict(
+        tokens2dims=TOKENS2DIMS,
+        num_heads=args.num_heads,
+        num_decoder_layers=args.num_decoder_layers,
+        dropout_p=args.dropout
+    )
+    model, opt, forward = build_training(model_spec, args.device, args.lr, args.compile)
+    autocast_dtype = torch.bfloat16 if args.bf16 else None
+
+    resume = None
+    if args.resume is not None:
+        # restores the RNG states as well, so this comes last
+        resume = load_checkpoint(args.resume, model, opt, args.device)
+
+    profiler = None
+    if args.profile or args.profile_modules or args.profile_log or args.trace:
+        profiler = StageProfiler(args.device, args.trace, args.trace_steps)
+        if args.profile_modules:
+            profiler.attach(model)
+
+    with profiler if profiler is not None else contextlib.nullcontext():
+        train_loss_list = fit(model, opt, train_dataloader, model_spec,
+                              args.epochs, args.device, args.accum_steps, autocast_dtype, forward,
+                              args.field_weights, args.out, args.checkpoint_every, resume,
+                              profiler, args.profile_log)
+    if profiler is not None:
+        profiler.detach()
+        if profiler.traces:
+            print("wrote", ", ".join(profiler.traces))
+
+    save_checkpoint(args.out, model, opt, model_spec, args.epochs, 
+                    loss=train_loss_list[-1] if train_loss_list else None, 
+                    train_loss_list=train_loss_list)
+    if args.export is not None:
+        # the notebook's tokenizer made the training batches
+        export_inference(args.export, model, model_spec, 
+                         TOKENIZER_CONFIG, INV_PITCH_DICT_SIMPLE)
+
+
+if __name__ == "__main__":
+    main()